@@ -2,5 +2,5 @@
 
 __version__ = '0.13.8'
 
-from .onep import OnepV1, DeferredRequests
+from .onep import OnepV1, DeferredRequests, BatchPolicy, RESULTFORMATS
 from .provision import Provision
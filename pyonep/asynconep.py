@@ -0,0 +1,340 @@
+# ==============================================================================
+# asynconep.py
+# asyncio client for Exosite's One Platform as exposed over HTTP JSON RPC
+# ==============================================================================
+#
+# Requires Python 3.6+ and aiohttp.
+#
+# Copyright (c) 2016, Exosite LLC
+# All rights reserved.
+#
+import asyncio
+import logging
+import sys
+
+import aiohttp
+
+from .onep import OnepV1, ReadPager, RESULTFORMATS
+from .onephttp import logged_body
+from .exceptions import JsonRPCRequestException, OnePlatformException
+
+log = logging.getLogger(__name__)
+
+# log errors stderr, don't log anything else
+h = logging.StreamHandler()
+h.setLevel(logging.ERROR)
+log.addHandler(h)
+
+
+class AsyncOneP_Request:
+    """asyncio counterpart of onephttp.OneP_Request.
+
+    Requests are made over a pool of at most maxsize keep-alive connections
+    to the host. Requests beyond that wait for a free connection, so any
+    number of concurrent calls can share a small number of sockets. The
+    underlying aiohttp session is created on first use so that it is bound
+    to the running event loop.
+
+    Like OneP_Request, at debug level request bodies are cut to logbody
+    characters (None logs them whole), and only a logsample fraction of
+    them is logged.
+    """
+
+    def __init__(self,
+                 host,
+                 https=True,
+                 httptimeout=15,
+                 headers={},
+                 log=None,
+                 maxsize=10,
+                 keepalive=60,
+                 logbody=None,
+                 logsample=1.0):
+        self.host = ('https://' + host) if https else ('http://' + host)
+        self.https = https
+        self.httptimeout = httptimeout
+        self.headers = headers
+        self.log = log
+        self.maxsize = maxsize
+        self.keepalive = keepalive
+        self.logbody = logbody
+        self.logsample = logsample
+        self.session = None
+
+    def _getsession(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.maxsize,
+                                             keepalive_timeout=self.keepalive)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def request(self,
+                      method,
+                      path,
+                      body=None,
+                      headers={},
+                      exception_fn=None,
+                      notimeout=False,
+                      verify=True,
+                      raw=False):
+        """Makes an HTTP request and returns (body, response). On exception
+        it calls exception_fn with the exception object. If exception_fn is
+        None, it re-raises the exception. If notimeout is True, the request
+        does not time out. If raw is True, body is the undecoded bytes."""
+        allheaders = dict(self.headers)
+        allheaders.update(headers)
+        try:
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug("%s %s\nHost: %s\nHeaders: %s",
+                               method,
+                               path,
+                               self.host,
+                               allheaders)
+                logged = logged_body(body, self.logbody, self.logsample)
+                if logged is not None:
+                    self.log.debug("Body: %s", logged)
+            timeout = aiohttp.ClientTimeout(
+                total=None if notimeout else self.httptimeout)
+            async with self._getsession().request(method,
+                                                  self.host + path,
+                                                  data=body,
+                                                  headers=allheaders,
+                                                  timeout=timeout,
+                                                  ssl=None if verify else False) as response:
+                if raw:
+                    text = await response.read()
+                else:
+                    text = await response.text()
+            return text, response
+
+        except Exception:
+            ex = sys.exc_info()[1]
+            if exception_fn is not None:
+                exception_fn(ex)
+            else:
+                raise ex
+
+    async def close(self):
+        """Closes every pooled connection. Connections are reopened by the
+        next request."""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class AsyncOnepV1(OnepV1):
+    """asyncio client for the One Platform RPC API.
+
+    AsyncOnepV1 has the same methods as OnepV1, but every API method
+    (read, write, info, listing, ...), as well as send_deferred() and
+    close(), is a coroutine:
+
+        conn = AsyncOnepV1()
+        ok, result = await conn.read(cik, {'alias': 'temp'}, {'limit': 1})
+
+    Deferred calls are queued exactly like with OnepV1 and sent with
+    `await conn.send_deferred(cik)`.
+
+    Args:
+        maxsize: Maximum number of connections to the host. Concurrent
+            calls beyond this wait for a free connection.
+        keepalive: Seconds an idle connection is kept open.
+        Other arguments are the same as for OnepV1.
+    """
+
+    def __init__(self,
+                 host='m2.exosite.com',
+                 port='443',
+                 url='/onep:v1/rpc/process',
+                 https=True,
+                 httptimeout=10,
+                 agent=None,
+                 logrequests=False,
+                 startid=0,
+                 maxsize=10,
+                 keepalive=60,
+                 codec=None,
+                 logbody=None,
+                 logsample=1.0):
+        self._maxsize = maxsize
+        self._keepalive = keepalive
+        OnepV1.__init__(self,
+                        host=host,
+                        port=port,
+                        url=url,
+                        https=https,
+                        httptimeout=httptimeout,
+                        agent=agent,
+                        logrequests=logrequests,
+                        startid=startid,
+                        codec=codec,
+                        logbody=logbody,
+                        logsample=logsample)
+
+    def _transport(self, host, https=True, httptimeout=15, headers={},
+                   logbody=None, logsample=1.0, **kwargs):
+        """Returns an AsyncOneP_Request. The options of OnepV1's transport
+        that it doesn't support are left at their defaults by __init__."""
+        return AsyncOneP_Request(host,
+                                 https=https,
+                                 httptimeout=httptimeout,
+                                 headers=headers,
+                                 log=log,
+                                 maxsize=self._maxsize,
+                                 keepalive=self._keepalive,
+                                 logbody=logbody,
+                                 logsample=logsample)
+
+    async def close(self):
+        """Closes every pooled connection."""
+        await self.onephttp.close()
+
+    async def _callJsonRPC(self, auth, callrequests, returnreq=False, notimeout=False):
+        """Calls the Exosite One Platform RPC API. See OnepV1._callJsonRPC."""
+        body = self._encodeJsonRPC(auth, callrequests)
+
+        def handle_request_exception(exception):
+            raise JsonRPCRequestException(
+                "Failed to make http request: %s" % str(exception))
+
+        body, response = await self.onephttp.request('POST',
+                                                     self.url,
+                                                     body,
+                                                     self.headers,
+                                                     exception_fn=handle_request_exception,
+                                                     notimeout=notimeout,
+                                                     raw=True)
+        return self._parseJsonRPC(body, callrequests, returnreq)
+
+    async def _call(self, method, auth, arg, defer, notimeout=False, transform=None):
+        """Calls the Exosite One Platform RPC API. See OnepV1._call."""
+        if defer:
+            self.deferred.add(auth, method, arg, notimeout=notimeout)
+            return True
+        else:
+            calls = self._composeCalls([(method, arg)])
+            r = await self._callJsonRPC(auth, calls, notimeout=notimeout)
+            if transform is not None:
+                r = transform(r)
+            return r
+
+    async def iter_read(self, auth, resource, starttime, endtime, page_size=1000, sort='asc',
+                        pages=False, prefetch=True):
+        """Asynchronous generator over all the points of a dataport between
+        starttime and endtime, for use with `async for`. See
+        OnepV1.iter_read."""
+        pager = ReadPager(starttime, endtime, page_size, sort)
+
+        async def readpage(options):
+            success, result = await self.read(auth, resource, options)
+            if not success:
+                raise OnePlatformException(
+                    "Error message from one platform (read): %s" % result)
+            return result
+
+        nextpage = None
+        try:
+            page = await readpage(pager.options())
+            while True:
+                points = pager.advance(page)
+                if not pager.done:
+                    options = pager.options()
+                    if prefetch:
+                        nextpage = asyncio.ensure_future(readpage(options))
+                if points:
+                    if pages:
+                        yield points
+                    else:
+                        for point in points:
+                            yield point
+                if pager.done:
+                    break
+                if nextpage is None:
+                    page = await readpage(options)
+                else:
+                    page = await nextpage
+                    nextpage = None
+        finally:
+            if nextpage is not None:
+                nextpage.cancel()
+
+    async def read_many(self, auth, resources, options, max_calls=100, max_workers=4,
+                        resultformat=RESULTFORMATS.LIST):
+        """Read value(s) from many dataports at once. See OnepV1.read_many."""
+        calls, keys = self._readcalls(resources, options)
+        transform = None
+        if resultformat is not RESULTFORMATS.LIST:
+            transform = self._packread(resultformat)
+        semaphore = asyncio.Semaphore(max_workers)
+        results = {}
+
+        async def send(chunkcalls, chunkkeys):
+            async with semaphore:
+                try:
+                    r = await self._callJsonRPC(auth, chunkcalls, returnreq=True)
+                except Exception:
+                    ex = sys.exc_info()[1]
+                    for key in chunkkeys:
+                        results[key] = (False, ex)
+                    return
+                self._readresults(chunkcalls, chunkkeys, r, results, transform)
+
+        await asyncio.gather(*[send(calls[i:i + max_calls], keys[i:i + max_calls])
+                               for i in range(0, len(calls), max_calls)])
+        return results
+
+    async def resolve(self, auth, alias, forcequery=False):
+        """Returns the resource ID of alias, or None if it doesn't exist.
+        See OnepV1.resolve."""
+        return (await self.resolve_many(auth, [alias], forcequery))[alias]
+
+    async def resolve_many(self, auth, aliases, forcequery=False):
+        """Returns a dict mapping each alias to its resource ID, or None if
+        it doesn't exist. See OnepV1.resolve_many."""
+        rids, calls = self._resolvecalls(auth, aliases, forcequery)
+        if calls:
+            self._resolveresults(auth, calls,
+                                 await self._callJsonRPC(auth, calls, returnreq=True),
+                                 rids)
+        return rids
+
+    async def prefetch_aliases(self, auth, resource={'alias': ''}):
+        """Caches the resource IDs of every alias of a client. See
+        OnepV1.prefetch_aliases."""
+        return self._prefetchresult(auth, await self.info(auth, resource, {'aliases': True}))
+
+    async def send_deferred(self, auth):
+        """Send all deferred requests for a particular CIK/auth."""
+        r = await self._send_deferred(self.deferred._authstr(auth))
+        if r is None:
+            raise JsonRPCRequestException('No deferred requests to send.')
+        return r
+
+    async def send_all_deferred(self, max_workers=10):
+        """Send the deferred requests of every CIK/auth, with up to
+        max_workers requests in flight at once. See
+        OnepV1.send_all_deferred for the result."""
+        semaphore = asyncio.Semaphore(max_workers)
+        results = {}
+        errors = {}
+
+        async def send(authstr):
+            async with semaphore:
+                try:
+                    r = await self._send_deferred(authstr)
+                    if r is not None:
+                        results[authstr] = r
+                except Exception:
+                    errors[authstr] = sys.exc_info()[1]
+
+        await asyncio.gather(*[send(authstr) for authstr, _ in self.deferred.pending()])
+        return results, errors
+
+    async def _send_deferred(self, authstr):
+        """Sends the deferred requests for authstr. Returns None if there
+        was nothing to send."""
+        auth, method_arg_pairs, notimeout, _, _ = self.deferred._pop(authstr)
+        if not method_arg_pairs:
+            return None
+        calls = self._composeCalls(method_arg_pairs)
+        return await self._callJsonRPC(auth, calls, returnreq=True, notimeout=notimeout)
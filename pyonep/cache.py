@@ -0,0 +1,245 @@
+# ==============================================================================
+# cache.py
+# Caches shared by the One Platform clients
+# ==============================================================================
+#
+# Copyright (c) 2016, Exosite LLC
+# All rights reserved.
+#
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def authkey(auth):
+    """Convert auth to str so that it can be hashed"""
+    if type(auth) is dict:
+        return '{' + ','.join(["{0}:{1}".format(k, auth[k]) for k in sorted(auth.keys())]) + '}'
+    return auth
+
+
+class LRUCache(object):
+    """A thread-safe cache of at most maxsize entries. Entries expire ttl
+    seconds after they are stored, and the least recently used entry is
+    evicted to make room for a new one.
+
+    Counters:
+        hits: lookups answered from the cache.
+        misses: lookups of keys that were not cached.
+        stale: lookups of keys whose entry had expired (also misses).
+        evictions: entries dropped to make room.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Returns the value cached for key, or default."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                del self._data[key]
+                self.stale += 1
+                self.misses += 1
+                return default
+            # mark as most recently used
+            del self._data[key]
+            self._data[key] = entry
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        """Like get(), but doesn't count as a use of the entry."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+                return default
+            return entry[0]
+
+    def put(self, key, value, ttl=None):
+        """Caches value for key for ttl seconds (default self.ttl)."""
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._data.pop(key, None)
+            while len(self._data) >= self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            self._data[key] = (value, expires)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Returns a dict of the cache counters."""
+        return {'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'evictions': self.evictions}
+
+
+class AliasCache(object):
+    """Caches the resource IDs of aliases, per auth/CIK.
+
+    Aliases that were looked up and not found are cached too, for the
+    shorter negative_ttl, so that repeated lookups of a missing alias don't
+    each go to the platform, while an alias that gets created soon shows
+    up. An AliasCache may be shared by several OnepV1 instances.
+    """
+    # cached value for aliases that don't exist
+    MISSING = False
+
+    def __init__(self, maxsize=10000, ttl=300, negative_ttl=10):
+        self.negative_ttl = negative_ttl
+        self._cache = LRUCache(maxsize, ttl)
+
+    def get(self, auth, alias):
+        """Returns the cached resource ID of alias, MISSING if the alias is
+        known not to exist, or None if it is not cached."""
+        return self._cache.get((authkey(auth), alias))
+
+    def put(self, auth, alias, rid):
+        """Caches the resource ID of alias."""
+        self._cache.put((authkey(auth), alias), rid)
+
+    def put_missing(self, auth, alias):
+        """Caches that alias does not exist."""
+        self._cache.put((authkey(auth), alias), self.MISSING, self.negative_ttl)
+
+    def invalidate(self, auth, alias):
+        self._cache.pop((authkey(auth), alias))
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        """Returns a dict of cache counters (see LRUCache)."""
+        return self._cache.stats()
+
+
+class _Read(object):
+    """A read in flight, which concurrent readers of an alias wait for."""
+
+    def __init__(self, count):
+        self.count = count
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ReadCache(object):
+    """Caches the latest points read from dataports, by alias.
+
+    Points are cached for ttl seconds, or ttls[alias] for aliases listed
+    in ttls, and the least recently read alias is evicted when there are
+    more than maxsize. The points cached for a read of count points serve
+    later reads of up to count points. When several threads miss the same
+    alias at once, only one of them reads it and the others wait for its
+    result.
+    """
+
+    def __init__(self, maxsize=1024, ttl=5, ttls=None):
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+        self._cache = LRUCache(maxsize, ttl)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        # reads answered by another thread's read
+        self.coalesced = 0
+
+    def get(self, alias, count):
+        """Returns the latest count cached points of alias, or None."""
+        entry = self._cache.get(alias)
+        if entry is None:
+            return None
+        points, cached = entry
+        # a read of cached points that returned fewer has every point
+        if count <= cached or len(points) < cached:
+            return points[:count]
+        return None
+
+    def put(self, alias, points, count):
+        """Caches the result of reading the latest count points of alias,
+        newest first."""
+        self._cache.put(alias, (points, count), self.ttls.get(alias, self.ttl))
+
+    def push(self, alias, points):
+        """Adds points, newest first, that are newer than the ones cached
+        for alias."""
+        with self._lock:
+            entry = self._cache.peek(alias)
+            if entry is None:
+                self.put(alias, points, len(points))
+            else:
+                cached, count = entry
+                self.put(alias, (points + cached)[:max(count, len(points))], count)
+
+    def invalidate(self, alias):
+        self._cache.pop(alias)
+
+    def read(self, alias, count, fetch):
+        """Returns the latest count points of alias, from the cache or by
+        calling fetch(alias, count), whose result is cached. Exceptions
+        raised by fetch are raised to every reader waiting for it."""
+        points = self.get(alias, count)
+        if points is not None:
+            return points
+        with self._lock:
+            read = self._inflight.get(alias)
+            if read is not None and read.count >= count:
+                self.coalesced += 1
+                leader = False
+            else:
+                read = _Read(count)
+                self._inflight[alias] = read
+                leader = True
+        if not leader:
+            read.event.wait()
+            if read.error is not None:
+                raise read.error
+            return read.result[:count]
+        try:
+            read.result = fetch(alias, count)
+            self.put(alias, read.result, count)
+            return read.result
+        except Exception:
+            read.error = sys.exc_info()[1]
+            raise
+        finally:
+            with self._lock:
+                if self._inflight.get(alias) is read:
+                    del self._inflight[alias]
+            read.event.set()
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        """Returns a dict of cache counters (see LRUCache), and the number
+        of coalesced reads."""
+        stats = self._cache.stats()
+        stats['coalesced'] = self.coalesced
+        return stats
@@ -0,0 +1,191 @@
+# ==============================================================================
+# circuit.py
+# Circuit breaking and load shedding for One Platform HTTP requests
+# ==============================================================================
+#
+# Copyright (c) 2016, Exosite LLC
+# All rights reserved.
+#
+import threading
+import time
+from collections import deque
+
+from .exceptions import CircuitOpenException, LoadShedException
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to a host that keeps failing or is too slow.
+
+    The outcomes of the last `window` requests are kept. Once at least
+    min_requests of them are known, the circuit opens when the share of
+    failed requests reaches error_rate, or the share of requests slower
+    than slow_latency seconds reaches slow_rate. While the circuit is open
+    requests fail right away with CircuitOpenException instead of waiting
+    for the platform to time out.
+
+    After reset_timeout seconds the circuit is half open: up to probes
+    requests are let through. If they all succeed the circuit closes,
+    and if any of them fails it opens again for another reset_timeout.
+
+    A request fails if it raises, or if its response status is in
+    failure_statuses (server errors by default).
+
+    A CircuitBreaker may be shared by any number of clients of the same
+    host, see get_breaker().
+    """
+
+    def __init__(self,
+                 window=20,
+                 min_requests=10,
+                 error_rate=0.5,
+                 slow_latency=None,
+                 slow_rate=0.5,
+                 reset_timeout=5.0,
+                 probes=1,
+                 failure_statuses=range(500, 600)):
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.slow_latency = slow_latency
+        self.slow_rate = slow_rate
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.failure_statuses = failure_statuses
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=window)
+        self._openedat = None
+        self._probing = 0
+        self._probed = 0
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self):
+        """Returns whether the request about to be made is a half-open
+        probe, or raises CircuitOpenException if it must not be made."""
+        with self._lock:
+            if self.state == OPEN:
+                if time.time() - self._openedat < self.reset_timeout:
+                    self.rejected += 1
+                    raise CircuitOpenException(
+                        "Circuit open, retrying in %.1fs" %
+                        (self._openedat + self.reset_timeout - time.time()))
+                self.state = HALF_OPEN
+                self._probing = self._probed = 0
+            if self.state == HALF_OPEN:
+                if self._probing + self._probed >= self.probes:
+                    self.rejected += 1
+                    raise CircuitOpenException("Circuit half open, waiting for probes")
+                self._probing += 1
+                return True
+            return False
+
+    def record(self, latency, ok, probe=False):
+        """Records the outcome of a request allowed by allow(). latency is
+        in seconds, ok is False if the request failed, and probe is what
+        allow() returned."""
+        slow = self.slow_latency is not None and latency > self.slow_latency
+        with self._lock:
+            if probe:
+                self._probing -= 1
+                if self.state != HALF_OPEN:
+                    return
+                if not ok or slow:
+                    self._open()
+                    return
+                self._probed += 1
+                if self._probed >= self.probes:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                return
+            if self.state != CLOSED:
+                return
+            self._outcomes.append((not ok, slow))
+            total = len(self._outcomes)
+            if total < self.min_requests:
+                return
+            failed = sum(1 for f, s in self._outcomes if f)
+            slowed = sum(1 for f, s in self._outcomes if s)
+            if failed >= self.error_rate * total or \
+                    (self.slow_latency is not None and slowed >= self.slow_rate * total):
+                self._open()
+
+    def _open(self):
+        # caller holds self._lock
+        self.state = OPEN
+        self._openedat = time.time()
+        self._outcomes.clear()
+        self.opened += 1
+
+    def failed(self, status):
+        """Returns True if a response with status counts as a failure."""
+        return status in self.failure_statuses
+
+    def stats(self):
+        """Returns a dict of the circuit state and counters."""
+        return {'state': self.state,
+                'opened': self.opened,
+                'rejected': self.rejected}
+
+
+class ConcurrencyLimiter(object):
+    """Limits the number of requests in flight at once.
+
+    A request that finds limit requests in flight waits up to timeout
+    seconds for one of them to finish, then is shed with
+    LoadShedException instead of queueing behind a slow platform. The
+    default timeout of 0 sheds it right away.
+
+    A ConcurrencyLimiter may be shared by any number of clients.
+    """
+
+    def __init__(self, limit, timeout=0):
+        self.limit = limit
+        self.timeout = timeout
+        self._semaphore = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self.inflight = 0
+        self.shed = 0
+
+    def acquire(self):
+        """Takes a slot for a request, or raises LoadShedException."""
+        if self.timeout:
+            acquired = self._semaphore.acquire(True, self.timeout)
+        else:
+            acquired = self._semaphore.acquire(False)
+        with self._lock:
+            if not acquired:
+                self.shed += 1
+                raise LoadShedException(
+                    "Shedding request, %d requests in flight" % self.limit)
+            self.inflight += 1
+
+    def release(self):
+        """Gives back a slot taken by acquire()."""
+        with self._lock:
+            self.inflight -= 1
+        self._semaphore.release()
+
+    def stats(self):
+        """Returns a dict of the limit and counters."""
+        return {'limit': self.limit,
+                'inflight': self.inflight,
+                'shed': self.shed}
+
+
+_breakers = {}
+_breakerslock = threading.Lock()
+
+
+def get_breaker(host, https=True, **kwargs):
+    """Returns the process-wide CircuitBreaker for host, creating it with
+    kwargs (see CircuitBreaker) the first time it is requested."""
+    key = (https, host)
+    with _breakerslock:
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker(**kwargs)
+        return _breakers[key]
@@ -0,0 +1,114 @@
+# ==============================================================================
+# codec.py
+# JSON encoders/decoders used for One Platform request and response bodies
+# ==============================================================================
+#
+# The fastest installed of orjson, ujson and python-rapidjson is used by
+# default, falling back to the standard library json module.
+#
+# Copyright (c) 2016, Exosite LLC
+# All rights reserved.
+#
+import sys
+
+if sys.version_info < (2, 6):
+    import simplejson as json
+else:
+    import json
+
+
+class JsonCodec(object):
+    """Encodes and decodes JSON with the standard library json module.
+
+    Codecs encode to str or bytes and decode from str or bytes, so response
+    bodies can be decoded without first converting them to text."""
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, data):
+        if isinstance(data, bytes) and sys.version_info < (3, 6):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """orjson codec. orjson encodes to bytes."""
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj):
+        try:
+            return self._orjson.dumps(obj)
+        except TypeError:
+            # e.g. integers wider than 64 bits or non-str dict keys
+            return JsonCodec.dumps(self, obj)
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+
+class UjsonCodec(JsonCodec):
+    """ujson codec."""
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj, ensure_ascii=False)
+
+    def loads(self, data):
+        return self._ujson.loads(data)
+
+
+class RapidjsonCodec(JsonCodec):
+    """python-rapidjson codec."""
+    name = 'rapidjson'
+
+    def __init__(self):
+        import rapidjson
+        self._rapidjson = rapidjson
+
+    def dumps(self, obj):
+        return self._rapidjson.dumps(obj)
+
+    def loads(self, data):
+        return self._rapidjson.loads(data)
+
+
+# in order of preference
+CODECS = [OrjsonCodec, UjsonCodec, RapidjsonCodec, JsonCodec]
+
+_default = None
+
+
+def get_codec(codec=None):
+    """Returns a codec.
+
+    Args:
+        codec: A codec instance, which is returned as is, the name of a
+            codec ('orjson', 'ujson', 'rapidjson' or 'json'), or None for
+            the fastest one installed.
+    """
+    global _default
+    if codec is None:
+        if _default is None:
+            for cls in CODECS:
+                try:
+                    _default = cls()
+                    break
+                except ImportError:
+                    pass
+        return _default
+    if isinstance(codec, str):
+        for cls in CODECS:
+            if cls.name == codec:
+                return cls()
+        raise ValueError("Unknown JSON codec '%s'" % codec)
+    return codec
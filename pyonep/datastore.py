@@ -12,26 +12,90 @@
 # All rights reserved.
 #
 
+import os
 import threading
 import time
 import sys
 import logging
-from onep import OnepV1
-from exceptions import OneException
+from collections import OrderedDict
+from .onep import OnepV1, ThreadPoolExecutor
+from .cache import ReadCache
+from .exceptions import OneException
+from .scheduler import FlushScheduler
+from .spool import Spool
+from .writebuffer import WriteBuffer, POLICIES, LIVE, RECORD, OFFSET
 
 # setup default configurations
 transport_config = {'host': 'm2.exosite.com',
                     'port': '80',
                     'url': '/onep:v1/rpc/process',
                     'https': False,
-                    'timeout': 3}
+                    'timeout': 3,
+                    # gzip request bodies of at least this many characters,
+                    # None never compresses
+                    'compress': None}
 datastore_config = {'write_buffer_size': 1024,
+                    # what write() and record() do when the write buffer is
+                    # full, see writebuffer.POLICIES
+                    'write_buffer_policy': POLICIES.COALESCE,
+                    # seconds to wait for room with the 'block' policy
+                    'write_buffer_timeout': None,
+                    # bounds of the adaptive flush interval, in seconds
+                    'flush_min_interval': 0.1,
+                    'flush_max_interval': 30,
+                    # flush right away once the write buffer is this full
+                    'flush_high_water': 0.5,
+                    # requests slower than this get fewer calls
+                    'flush_target_latency': 1.0,
+                    # back off while this share of recent flush requests
+                    # failed
+                    'flush_max_errorrate': 0.5,
+                    # live values per writegroup call
+                    'writegroup_max_entries': 500,
+                    # most writegroup and recordbatch calls per flush request
+                    'flush_max_calls': 100,
+                    # directory of a disk spool for points that could not
+                    # be sent, so that they survive restarts, or None
+                    'spool_dir': None,
+                    # points that could not be sent are kept in memory for
+                    # retrying until the buffer holds this many points, and
+                    # spilled to the spool past that
+                    'spool_threshold': 0,
+                    # seconds between syncs of the spool to disk
+                    'spool_fsync_interval': 1.0,
                     'read_cache_size': 1024,
                     'read_cache_expire_time': 5,
+                    # read_cache_expire_time of particular aliases
+                    'read_cache_ttls': {},
+                    # most threads waiting for updates of subscribed aliases
+                    'subscribe_loops': 16,
+                    # seconds each wait for updates lasts (at most 300)
+                    'subscribe_timeout': 30,
                     'log_level': 'debug'}
 
 log = logging.getLogger(__name__)
-lock = threading.Lock()
+
+
+def _flushScheduler(interval, config):
+    size = config.get('write_buffer_size', 1024)
+    highwater = config.get('flush_high_water', 0.5)
+    return FlushScheduler(
+        interval,
+        min_interval=config.get('flush_min_interval', 0.1),
+        max_interval=config.get('flush_max_interval', 30),
+        high_water=None if size is None or highwater is None else int(size * highwater),
+        max_calls=config.get('flush_max_calls', 100),
+        target_latency=config.get('flush_target_latency', 1.0),
+        max_errorrate=config.get('flush_max_errorrate', 0.5))
+
+
+class _WaitLoop(object):
+    """The subscribed aliases one thread waits for."""
+
+    def __init__(self):
+        self.aliases = set()
+        self.stopped = False
+        self.wake = threading.Event()
 
 
 class Datastore():
@@ -40,59 +104,83 @@ class Datastore():
                  interval,
                  autocreate=False,
                  config=datastore_config,
-                 transport=transport_config):
-        self._liveBuffer = dict()
-        self._recordBuffer = dict()
-        self._aliasDict = dict()
-        self._cache = dict()
-        self._cacheCount = 0
-        self._recordCount = 0
+                 transport=transport_config,
+                 conn=None,
+                 scheduler=None):
+        """conn and scheduler, the OnepV1 and FlushScheduler to use,
+        are made from transport and config when None. They are shared by
+        the Datastores of a DatastoreManager."""
+        self._buffer = WriteBuffer(config.get('write_buffer_size', 1024),
+                                   config.get('write_buffer_policy', POLICIES.COALESCE),
+                                   config.get('write_buffer_timeout'))
+        self._spool = None
+        if config.get('spool_dir'):
+            self._spool = Spool(config['spool_dir'],
+                                fsync_interval=config.get('spool_fsync_interval', 1.0))
+        self._cache = ReadCache(config.get('read_cache_size', 1024),
+                                config.get('read_cache_expire_time', 5),
+                                config.get('read_cache_ttls'))
+        self._subscribers = dict()
+        self._waitloops = list()
+        self._sublock = threading.Lock()
+        self._flushlock = threading.Lock()
+        self._abandoned = False
+        self._killed = False
+        self._thread = None
         self._auto = autocreate
         self._config = config
-        if 'https' in transport:
-            transport['https'] = False
-        self._conn = OnepV1(transport['host'],
-                            transport['port'],
-                            transport['url'],
-                            transport['https'],
-                            transport['timeout'])
+        if conn is None:
+            if 'https' in transport:
+                transport['https'] = False
+            conn = OnepV1(transport['host'],
+                          transport['port'],
+                          transport['url'],
+                          transport['https'],
+                          transport['timeout'],
+                          compress=transport.get('compress'))
+        self._conn = conn
         self._cik = cik
-        if interval < 1:
-            interval = 1
         self._interval = interval
+        if scheduler is None:
+            scheduler = _flushScheduler(interval, config)
+        self._scheduler = scheduler
 
     def __bufferCount(self):
-        return len(self._liveBuffer) + self._recordCount
-
-    def __isBufferFull(self):
-        return self.__bufferCount() >= self._config['write_buffer_size']
-
-    def __isLiveBufferEmpty(self):
-        if self._liveBuffer:
-            return False
-        else:
-            return True
+        return len(self._buffer)
 
     def __forceTerminate(self):
         if self._killed and self._forceterminate:
-            self._liveBuffer.clear()
+            self._abandon()
             return True
         else:
             return False
 
+    def _abandon(self):
+        """Spills the buffered points to the spool, if there is one, to
+        keep them for the next start. Otherwise drops the live values."""
+        with self._flushlock:
+            self._abandoned = True
+            if self._spool is not None:
+                items = self._buffer.swap()
+                if items:
+                    self.__spill(items)
+                self._buffer.release(len(items))
+                self._spool.close()
+            else:
+                self._buffer.clear_live()
+
+    def _resume(self):
+        """Undoes _abandon(), so that the next run flushes again."""
+        with self._flushlock:
+            self._abandoned = False
+
     # One platform queries below
 
     def __lookup(self, alias, forcequery=False):
-        if (not forcequery) and alias in self._aliasDict:
-            return self._aliasDict[alias]
-        else:
-            status, res = self._conn.lookup(self._cik, 'alias', alias)
-            if not status:
-                self._aliasDict[alias] = False
-                return False
-            else:
-                self._aliasDict[alias] = res
-                return res
+        rid = self._conn.resolve(self._cik, alias, forcequery)
+        if rid is None:
+            return False
+        return rid
 
     def __read(self,
                alias,
@@ -120,223 +208,381 @@ class Datastore():
                 "Error message from one platform (read): %s" % res)
         return res
 
-    def __record(self, alias, entries):
-        rid = self.__lookup(alias)
-        record_status, record_message = self._conn.record(self._cik,
-                                                          rid,
-                                                          entries)
-        if not (True == record_status and 'ok' == record_message):
-            msg = "Error message from one platform (record): %s"
-            raise OneException(msg % record_message)
-        return True
-
-    def __writegroup(self, entries):
-        data = list()
-        for (alias, value) in entries:
-            rid = self.__lookup(alias)
-            data.append([rid, value])
-        write_status, write_message = self._conn.writegroup(self._cik, data)
-        if not (True == write_status and 'ok' == write_message):
-            msg = "Error message from one platform (write): %s,%s"
-            raise OneException(msg % (value, write_message))
-        return True
-
-    def __createDataport(self,
-                         alias,
-                         name=None,
-                         format="string",
-                         preprocess=[],
-                         count="infinity",
-                         duration="infinity",
-                         visibility='parent'):
-        if None == name:
-            name = alias
-        desc = {"format": format,
-                "name": name,
-                'visibility': visibility,
-                "retention": {"count": count,
-                              "duration": duration},
-                "preprocess": preprocess}
-        create_status, rid = self._conn.create(self._cik, "dataport", desc)
-        if create_status:
-            map_status, map_message = self._conn.map(self._cik, rid, alias)
-            if map_status:
-                self._aliasDict[alias] = rid
-                return True
+    def __callBatch(self, method_args_pairs):
+        """Sends calls in one request and returns the (success, result) of
+        each, in order. Raises OneException if the request fails."""
+        calls = self._conn._composeCalls(method_args_pairs)
+        r = self._conn._callJsonRPC(self._cik, calls, returnreq=True)
+        byid = dict((request['id'], (success, result))
+                    for request, success, result in r if request is not None)
+        return [byid.get(call['id'], (False, 'no response')) for call in calls]
+
+    def __callMany(self, method_args_pairs):
+        """Sends calls config['flush_max_calls'] per request and returns the
+        (success, result) of each, in order. The calls of a request that
+        fails get (False, exception)."""
+        maxcalls = self._config.get('flush_max_calls', 100)
+        results = list()
+        for i in range(0, len(method_args_pairs), maxcalls):
+            chunk = method_args_pairs[i:i + maxcalls]
+            try:
+                results.extend(self.__callBatch(chunk))
+            except OneException:
+                e = sys.exc_info()[1]
+                results.extend([(False, e)] * len(chunk))
+        return results
+
+    def __createDataports(self,
+                          aliases,
+                          name=None,
+                          format="string",
+                          preprocess=[],
+                          count="infinity",
+                          duration="infinity",
+                          visibility='parent'):
+        """Creates a dataport for each alias and maps the alias to it, with
+        a batch of create calls, a batch of map calls, and a batch of drop
+        calls for the dataports whose alias could not be mapped. Returns a
+        dict mapping each alias to (True, rid) or (False, error)."""
+        results = dict()
+        descs = list()
+        for alias in aliases:
+            descs.append({"format": format,
+                          "name": alias if name is None else name,
+                          'visibility': visibility,
+                          "retention": {"count": count,
+                                        "duration": duration},
+                          "preprocess": preprocess})
+        created = list()
+        for alias, (create_status, rid) in zip(
+                aliases, self.__callMany([('create', ['dataport', desc]) for desc in descs])):
+            if create_status:
+                created.append((alias, rid))
             else:
-                self._conn.drop(self._cik, rid)
-                log.error(map_message)
-                return False
-        else:
-            log.error(rid)
-            return False
-
-    def __checkDataportExist(self, alias):
-        if self.__lookup(alias):
-            return True
-        else:
-            if self._auto:
-                if not self.__createDataport(
-                        alias=alias,
-                        format=self._auto['format'],
-                        preprocess=self._auto['preprocess'],
-                        count=self._auto['count'],
-                        duration=self._auto['duration'],
-                        visibility=self._auto['visibility']):
-                    raise OneException("Fail to create dataport.")
-                return True
+                log.error("Failed to create dataport %s: %s", alias, rid)
+                results[alias] = (False, rid)
+        drops = list()
+        for (alias, rid), (map_status, map_message) in zip(
+                created, self.__callMany([('map', ['alias', rid, alias]) for alias, rid in created])):
+            if map_status:
+                self._conn.aliascache.put(self._cik, alias, rid)
+                results[alias] = (True, rid)
             else:
-                m = "Data source does not exist while not in AUTO_CREATE mode."
-                log.warn(m)
-                return False
+                log.error("Failed to map alias %s: %s", alias, map_message)
+                results[alias] = (False, map_message)
+                drops.append(('drop', [rid]))
+        if drops:
+            self.__callMany(drops)
+        return results
 
     # Write buffer processing below
 
     def __processJsonRPC(self):
         while not self.__forceTerminate():
-            time.sleep(self._interval)
-            livedata = list()
-            lock.acquire()
-            try:
-                timestamp = int(time.time())
-                aliases = self._liveBuffer.keys()
-                for alias in aliases:
-                    value = self._liveBuffer[alias]
-                    try:
-                        # create datasource if necessary
-                        if self.__checkDataportExist(alias):
-                            # Move to live data
-                            livedata.append([alias, value])
-                            msg = "Data to be written (alias,value): ('%s',%s)"
-                            log.debug(msg % (alias, value))
-                    except OneException:
-                        # catch exception, add to recordBuffer
-                        if alias not in self._recordBuffer:
-                            self._recordBuffer[alias] = list()
-                        self._recordBuffer[alias].append(
-                            [timestamp, value, True])
-                        self._recordCount += 1
-                    finally:
-                        del self._liveBuffer[alias]
-            finally:
-                self._liveBuffer.clear()
-                lock.release()
-            # write live data
-            if livedata:
-                timestamp = int(time.time())
-                try:
-                    self.__writegroup(livedata)
-                    log.info("[Live] Written to 1p:" + str(livedata))
-                except OneException:
-                    # go to historical data when write live data failure
-                    e = sys.exc_info()[1]
-                    msg = "Exception While Writing Live Data: {0}"
-                    log.error(msg.format(e.message))
-                    log.debug("Previous Exception For: {0}".format(livedata))
-                    lock.acquire()
-                    try:
-                        for (alias, value) in livedata:
-                            if alias not in self._recordBuffer:
-                                self._recordBuffer[alias] = list()
-                            offset = True
-                            self._recordBuffer[alias].append(
-                                [timestamp, value, offset])
-                            self._recordCount += 1
-                    finally:
-                        lock.release()
-                except Exception:
-                    e = sys.exc_info()[1]
-                    log.exception("Unknown Exception While Writing Data")
-            # write historical data
-            lock.acquire()
-            try:
-                aliases = self._recordBuffer.keys()
-                curtime = int(time.time())
-                for alias in aliases:
-                    entries = self._recordBuffer[alias]
-                    try:
-                        if self.__checkDataportExist(alias):
-                            recentry = list()
-                            for entry in entries:
-                                if entry[2] is True:  # offset mode
-                                    offset = entry[0] - curtime
-                                    if offset == 0:
-                                        # Must be a negative number.
-                                        offset = -1
-                                    recentry.append([offset, entry[1]])
-                                else:
-                                    recentry.append([entry[0], entry[1]])
-                            if recentry:
-                                try:
-                                    self.__record(alias, recentry)
-                                    log.info("[Historical] Written to 1p: "
-                                             + alias + ", " + str(recentry))
-                                    self._recordCount -= len(entries)
-                                    del self._recordBuffer[alias]
-                                except OneException:
-                                    e = sys.exc_info()[1]
-                                    if e.message.find("datapoint") != -1:
-                                        log.excption(e.message)
-                                        self._recordCount -= len(entries)
-                                        del self._recordBuffer[alias]
-                        else:
-                            del self._recordBuffer[alias]
-                    except OneException:
-                        e = sys.exc_info()[1]
-                        log.error(e.message)
-                        continue
-            finally:
-                lock.release()
-            if self._killed and not self._recordBuffer:
+            self._scheduler.wait()
+            self._scheduler.observe_flush(*self._flush())
+            if self._killed and not self.__bufferCount():
                 self._forceterminate = True
-
-    # Read cache routines below
-
-    def __addCacheData(self, alias, count, forcequery=False):
-        if self.__isCacheFull():
-            self.__clearCache()
-        self._cache[alias] = dict()
-        data = self.__refreshData(alias, count, forcequery)
-        if data:
-            self._cacheCount += 1
-        return data
-
-    def __isExpired(self, alias):
-        try:
-            expire = self._config['read_cache_expire_time']
-            return int(time.time()) - self._cache[alias]['time'] > expire
-        except:
-            return True
-
-    def __isCacheFull(self):
-        return self._cacheCount >= self._config['read_cache_size']
-
-    def __clearCache(self):
-        self._cache.clear()
-        self._cache = dict()
-        self._cacheCount = 0
-
-    def __refreshData(self, alias, count, forcequery=False):
+        if self._spool is not None:
+            self._spool.close()
+
+    def _flush(self):
+        """Sends the buffered points. The buffer is swapped out first, so
+        producers can keep writing while the points are sent. Points that
+        could not be sent are put back to be retried by the next flush, or
+        spilled to the spool. Spooled points are sent once the platform
+        takes new points again.
+
+        Flushes of the same Datastore are serialized, so the buffer and
+        spool are never sent twice at once from different threads, and
+        nothing is sent once the Datastore was abandoned, until it is
+        started again.
+
+        Returns the number of points taken from the buffer and the number
+        of them that could not be sent."""
+        with self._flushlock:
+            if self._abandoned:
+                return 0, 0
+            items = self._buffer.swap()
+            failed = self.__send(items) if items else []
+            done = len(items)
+            if failed:
+                threshold = self._config.get('spool_threshold', 0)
+                if self._spool is not None and \
+                        self.__bufferCount() + len(failed) > threshold:
+                    self.__spill(failed)
+                else:
+                    self._buffer.restore(failed)
+                    done -= len(failed)
+            self._buffer.release(done)
+            if self._spool is not None:
+                if not failed:
+                    self.__replay()
+                self._spool.sync()
+            return len(items), len(failed)
+
+    def __spill(self, items):
+        """Appends points to the spool. Negative offsets given to record()
+        are turned into local times, since they would be wrong by the time
+        the points are sent; like the other local times they are sent as
+        offsets from the time of sending."""
+        curtime = int(time.time())
+        for item in items:
+            if item[3] == LIVE:
+                item[3] = OFFSET
+            elif item[3] == RECORD and item[1] < 0:
+                item[1] += curtime
+                item[3] = OFFSET
+        self._spool.append(items)
+        log.info("Spilled %s points to the spool", len(items))
+
+    def __replay(self):
+        """Sends the points of the oldest spool segment with recordbatch,
+        then deletes the segment."""
+        segments = self._spool.pending()
+        if not segments:
+            return
+        segment = segments[0]
+        items = self._spool.read(segment)
+        failed = self.__send(items)
+        if items and len(failed) == len(items):
+            # keep the segment for the next flush
+            return
+        if failed:
+            self._spool.append(failed)
+        self._spool.ack(segment)
+
+    def __send(self, items):
+        """Sends points taken from the buffer, returns the ones that could
+        not be sent."""
+        calls, failed = self._prepare(items)
+        if calls:
+            failed.extend(self._complete(calls, self.__sendCalls(calls)))
+        return failed
+
+    def __sendCalls(self, calls):
+        """Sends calls made by _prepare(), as many per request as the
+        scheduler allows, and returns a list of the (success, result) of
+        each."""
+        results = list()
+        while len(results) < len(calls):
+            i = len(results)
+            chunk = [(method, args) for method, args, _ in calls[i:i + self._scheduler.calls]]
+            start = time.time()
+            try:
+                results.extend(self.__callBatch(chunk))
+                self._scheduler.observe_request(time.time() - start, True)
+            except OneException:
+                e = sys.exc_info()[1]
+                log.error("Exception While Writing Data: %s", e)
+                results.extend([(False, e)] * len(chunk))
+                self._scheduler.observe_request(time.time() - start, False)
+        return results
+
+    def _prepare(self, items):
+        """Builds the calls that send points taken from the buffer: the
+        latest live value of each alias is written with writegroup, in
+        chunks of at most config['writegroup_max_entries'] values, and the
+        other points of each alias are recorded with one recordbatch call.
+
+        Returns (calls, failed), where calls is a list of (method, args,
+        points) and failed lists the points that can't be sent now because
+        their dataport could not be looked up or created.
+        """
+        live = dict()
+        records = dict()
+        for item in items:
+            alias = item[0]
+            if item[3] == LIVE:
+                if alias in live:
+                    # record the earlier values (they may have been put back
+                    # by a failed flush)
+                    live[alias][3] = OFFSET
+                    records.setdefault(alias, []).append(live[alias])
+                live[alias] = item
+            else:
+                records.setdefault(alias, []).append(item)
+        failed = list()
+        aliases = set(live) | set(records)
         try:
-            time.sleep(1)
-            data = self.__read(alias,
-                               count,
-                               forcequery)
-            self._cache[alias]['data'] = data
-            self._cache[alias]['time'] = int(time.time())
-            return data
+            rids = self._conn.resolve_many(self._cik, list(aliases))
         except OneException:
             e = sys.exc_info()[1]
-            log.error(e.message)
-        except Exception:
-            e = sys.exc_info()[1]
-            log.excpetion("Unknown Exception While Refreshing Data")
-        return False
+            log.error("Exception While Looking Up Aliases: %s", e)
+            for item in live.values():
+                item[3] = OFFSET
+            return [], list(items)
+        missing = [alias for alias in aliases if rids[alias] is None]
+        created = dict()
+        if missing:
+            if self._auto:
+                # create datasources if necessary
+                created = self.__createDataports(missing,
+                                                 format=self._auto['format'],
+                                                 preprocess=self._auto['preprocess'],
+                                                 count=self._auto['count'],
+                                                 duration=self._auto['duration'],
+                                                 visibility=self._auto['visibility'])
+            else:
+                m = "Data source does not exist while not in AUTO_CREATE mode: %s"
+                log.warning(m, missing)
+        for alias in missing:
+            success, result = created.get(alias, (None, None))
+            if success:
+                rids[alias] = result
+                continue
+            if success is False:
+                # retry the points once the dataport can be created
+                if alias in live:
+                    live[alias][3] = OFFSET
+                    failed.append(live[alias])
+                failed.extend(records.get(alias, []))
+            live.pop(alias, None)
+            records.pop(alias, None)
+
+        calls = list()
+        maxentries = self._config.get('writegroup_max_entries', 500)
+        livedata = list(live.values())
+        for i in range(0, len(livedata), maxentries):
+            chunk = livedata[i:i + maxentries]
+            calls.append(('writegroup',
+                          [[[rids[item[0]], item[2]] for item in chunk]],
+                          chunk))
+        curtime = int(time.time())
+        for alias, entries in records.items():
+            recentry = list()
+            for entry in entries:
+                t = entry[1]
+                if entry[3] == OFFSET:
+                    # send local times as offsets from now, so that the
+                    # device clock being off doesn't move the points; the
+                    # platform wants an offset below 0
+                    t = min(t - curtime, -1)
+                recentry.append([t, entry[2]])
+            calls.append(('recordbatch', [rids[alias], recentry], entries))
+        return calls, failed
+
+    def _complete(self, calls, results):
+        """Checks the (success, result) of each call made by _prepare() and
+        returns the points that have to be sent again. Live values whose
+        writegroup failed are retried as historical data, each alias in
+        its own recordbatch, so that one bad value doesn't keep failing the
+        others."""
+        failed = list()
+        for (method, args, points), (success, result) in zip(calls, results):
+            if method == 'writegroup':
+                if success:
+                    log.info("[Live] Written to 1p: %s values", len(points))
+                    continue
+                log.error("Exception While Writing Live Data: %s", result)
+                for item in points:
+                    item[3] = OFFSET
+                failed.extend(points)
+            else:
+                alias = points[0][0]
+                if success:
+                    log.info("[Historical] Written to 1p: %s, %s points",
+                             alias, len(points))
+                elif str(result).find("datapoint") != -1:
+                    # the platform won't take these points, drop them
+                    log.error("Dropped points of %s: %s", alias, result)
+                else:
+                    log.error("Exception While Recording Data: %s", result)
+                    failed.extend(points)
+        return failed
+
+    # Subscriptions below
+
+    def __assign(self, alias):
+        """Adds alias to a wait loop, starting a new one unless there are
+        config['subscribe_loops'] already. Called with _sublock held."""
+        if len(self._waitloops) < self._config.get('subscribe_loops', 16):
+            loop = _WaitLoop()
+            loop.aliases.add(alias)
+            self._waitloops.append(loop)
+            thread = threading.Thread(target=self.__waitLoop, args=(loop,))
+            thread.daemon = True
+            thread.start()
+        else:
+            min(self._waitloops, key=lambda loop: len(loop.aliases)).aliases.add(alias)
+
+    def __waitLoop(self, loop):
+        """Waits for updates of the aliases of loop until it is stopped or
+        has no aliases left."""
+        timeout = int(self._config.get('subscribe_timeout', 30) * 1000)
+        since = dict()
+        errors = 0
+        while True:
+            with self._sublock:
+                if loop.stopped or not loop.aliases:
+                    loop.stopped = True
+                    if loop in self._waitloops:
+                        self._waitloops.remove(loop)
+                    return
+                aliases = list(loop.aliases)
+            now = int(time.time())
+            try:
+                rids = self._conn.resolve_many(self._cik, aliases)
+                ridaliases = dict((rids[alias], alias) for alias in aliases
+                                  if rids[alias] is not None)
+                if not ridaliases:
+                    loop.wake.wait(timeout / 1000.0)
+                    continue
+                calls = self._conn._composeCalls(
+                    [('wait', [rid, {'timeout': timeout,
+                                     'since': since.setdefault(alias, now)}])
+                     for rid, alias in ridaliases.items()])
+                results = self._conn._callJsonRPC(self._cik, calls,
+                                                  returnreq=True, notimeout=True)
+            except OneException:
+                e = sys.exc_info()[1]
+                log.error("Exception While Waiting For Updates: %s", e)
+                # don't serve stale values while updates can't be had
+                for alias in aliases:
+                    self._cache.invalidate(alias)
+                errors += 1
+                loop.wake.wait(min(2 ** errors, 60))
+                continue
+            failed = 0
+            for request, success, result in results:
+                if request is None:
+                    continue
+                alias = ridaliases[request['arguments'][0]]
+                if success:
+                    points = result if result and isinstance(result[0], list) else [result]
+                    points = sorted(points, key=lambda point: point[0], reverse=True)
+                    since[alias] = points[0][0]
+                    self.__deliver(alias, points)
+                elif result != 'expire':
+                    log.warning("Failed to wait for %s: %s", alias, result)
+                    self._cache.invalidate(alias)
+                    failed += 1
+            if failed and failed == len(ridaliases):
+                # every wait failed right away, back off as for errors
+                errors += 1
+                loop.wake.wait(min(2 ** errors, 60))
+            else:
+                errors = 0
+
+    def __deliver(self, alias, points):
+        self._cache.push(alias, points)
+        with self._sublock:
+            callbacks = list(self._subscribers.get(alias, ()))
+        for callback in callbacks:
+            try:
+                callback(alias, points)
+            except Exception:
+                log.exception("Exception In Subscription Callback")
 
     # Public methods below
 
+    def bufferStats(self):
+        """Returns the write buffer depth and its dropped and coalesced
+        counters, see WriteBuffer.stats()."""
+        return self._buffer.stats()
+
     def isThreadAlive(self):
-        return self._thread.isAlive()
+        return self._thread.is_alive()
 
     def comment(self,
                 alias,
@@ -364,70 +610,280 @@ class Datastore():
         if rid:
             return False, "Alias already existed."
         else:
-            if self.__createDataport(alias,
-                                     name,
-                                     format,
-                                     preprocess,
-                                     count,
-                                     duration,
-                                     visibility):
+            success, result = self.__createDataports([alias],
+                                                     name,
+                                                     format,
+                                                     preprocess,
+                                                     count,
+                                                     duration,
+                                                     visibility)[alias]
+            if success:
                 return True, True
             else:
                 return False, "Failed to create Dataport."
 
+    def createDataports(self,
+                        aliases,
+                        format,
+                        preprocess=[],
+                        count=0,
+                        duration=0,
+                        visibility="public"):
+        """Creates a dataport, named after its alias, for each alias that
+        doesn't exist yet, with a few batched requests. Returns a dict
+        mapping each alias to (True, rid) or (False, error message)."""
+        rids = self._conn.resolve_many(self._cik, aliases)
+        missing = [alias for alias in aliases if rids[alias] is None]
+        results = self.__createDataports(missing,
+                                         None,
+                                         format,
+                                         preprocess,
+                                         count,
+                                         duration,
+                                         visibility)
+        for alias in aliases:
+            if rids[alias] is not None:
+                results[alias] = (False, "Alias already existed.")
+        return results
+
     def read(self, alias, count=1, forcequery=False):
-        if alias in self._cache:  # has cache data
-            if self.__isExpired(alias) or count != len(self._cache[alias]['data']):
-                return self.__refreshData(alias, count, forcequery)
-            else:
-                return self._cache[alias]['data']
-        else:  # no cache data
-            return self.__addCacheData(alias, count, forcequery)
+        try:
+            return self._cache.read(
+                alias, count,
+                lambda alias, count: self.__read(alias, count, forcequery))
+        except OneException:
+            e = sys.exc_info()[1]
+            log.error("%s", e)
+        except Exception:
+            log.exception("Unknown Exception While Refreshing Data")
+        return False
+
+    def cacheStats(self):
+        """Returns the read cache counters, see ReadCache.stats()."""
+        return self._cache.stats()
 
     def record(self, alias, entries):
-        if self.__isBufferFull() or not (self._auto or self.__lookup(alias)):
+        if not (self._auto or self.__lookup(alias)):
             return False
-        lock.acquire()
-        try:
-            if alias not in self._recordBuffer:
-                self._recordBuffer[alias] = list()
-            for (t, value) in entries:
-                recentry = [t, value, False]
-                self._recordBuffer[alias].append(recentry)
-        finally:
-            lock.release()
+        if not self._buffer.record(alias, entries):
+            return False
+        self._scheduler.added(self._buffer.depth())
+        return True
 
     def restart(self):
         self.stop(force=True)
         self.start()
 
     def start(self, daemon=False):
-        time.sleep(1)
+        try:
+            # resolve every alias of the device up front
+            self._conn.prefetch_aliases(self._cik)
+        except OneException:
+            e = sys.exc_info()[1]
+            log.warning("Failed to prefetch aliases: %s", e)
+        if self._killed and self._thread is not None:
+            # the stopped run abandons the buffer on its way out
+            self._thread.join()
+        self._resume()
         self._killed = False
         self._forceterminate = False
+        with self._sublock:
+            for alias in self._subscribers:
+                if not any(alias in loop.aliases for loop in self._waitloops):
+                    self.__assign(alias)
         self._thread = threading.Thread(target=self.__processJsonRPC)
-        self._thread.setDaemon(daemon)
+        self._thread.daemon = daemon
         self._thread.start()
 
     def stop(self, force=False):
         self._killed = True
         self._forceterminate = force
+        self._scheduler.wake()
+        with self._sublock:
+            for loop in self._waitloops:
+                loop.stopped = True
+                loop.wake.set()
+            del self._waitloops[:]
+
+    def subscribe(self, alias, callback=None):
+        """Waits for updates of alias with the platform's long-poll wait
+        API. Updates go into the read cache, so that reads of alias are
+        answered locally while it is subscribed, and are passed to
+        callback(alias, points), points being a list of [timestamp, value]
+        newest first.
+
+        Subscriptions are spread over at most config['subscribe_loops']
+        threads, each of which waits for its aliases with one request. The
+        platform answers a request once every wait in it has returned, so
+        aliases only share a thread, and each other's latency, when more
+        than subscribe_loops aliases are subscribed."""
+        with self._sublock:
+            callbacks = self._subscribers.get(alias)
+            if callbacks is None:
+                self._subscribers[alias] = callbacks = list()
+                # updates keep the cached points fresh
+                self._cache.ttls[alias] = float('inf')
+                self.__assign(alias)
+            if callback is not None:
+                callbacks.append(callback)
+
+    def unsubscribe(self, alias, callback=None):
+        """Removes callback from the subscription of alias, and ends the
+        subscription when it has no callbacks left or callback is None."""
+        with self._sublock:
+            callbacks = self._subscribers.get(alias)
+            if callbacks is None:
+                return
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if callback is not None and callbacks:
+                return
+            del self._subscribers[alias]
+            ttls = self._config.get('read_cache_ttls') or {}
+            if alias in ttls:
+                self._cache.ttls[alias] = ttls[alias]
+            else:
+                self._cache.ttls.pop(alias, None)
+            self._cache.invalidate(alias)
+            for loop in self._waitloops:
+                loop.aliases.discard(alias)
 
     def write(self, alias, value):
-        if self.__isBufferFull() or not (self._auto or self.__lookup(alias)):
+        if not (self._auto or self.__lookup(alias)):
             return False
         else:
-            lock.acquire()
-            try:
-                if alias in self._liveBuffer:
-                    self._liveBuffer[alias] = value
-                    msg = "Update the (alias,value) in buffer:%s,%s"
-                    log.debug(msg % (alias, value))
-                    return False
-                else:
-                    self._liveBuffer[alias] = value
-            finally:
-                lock.release()
-            log.debug("Current buffer count: %s" % self.__bufferCount())
-            log.debug("Add to buffer:%s,%s" % (alias, value))
+            if not self._buffer.write(alias, value, int(time.time())):
+                log.debug("Coalesced or dropped (alias,value):%s,%s", alias, value)
+                return False
+            self._scheduler.added(self._buffer.depth())
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Current buffer count: %s", self.__bufferCount())
+                log.debug("Add to buffer:%s,%s", alias, value)
             return True
+
+
+class DatastoreManager(object):
+    """Hosts the Datastores of many devices behind a single flusher thread
+    and a single pooled connection to the platform.
+
+        manager = DatastoreManager(interval=1)
+        device = manager.add(cik)
+        manager.start()
+        device.write('temp', 21.5)
+
+    Each flush sends the buffered points of every device, up to
+    max_workers devices' requests at once. The device that goes first
+    changes from one flush to the next, so every device makes progress
+    when the platform can't keep up with all of them. Devices share one
+    adaptive FlushScheduler, which a device passing the high water mark
+    wakes. With config['spool_dir'] set, each device spools to its own
+    subdirectory, named after its CIK.
+    """
+
+    def __init__(self,
+                 interval,
+                 autocreate=False,
+                 config=datastore_config,
+                 transport=transport_config,
+                 max_workers=10):
+        self._interval = interval
+        self._auto = autocreate
+        self._config = config
+        self._maxworkers = max_workers
+        self._conn = OnepV1(transport['host'],
+                            transport['port'],
+                            transport['url'],
+                            transport['https'],
+                            transport['timeout'],
+                            pool=True,
+                            compress=transport.get('compress'))
+        self._scheduler = _flushScheduler(interval, config)
+        self._devices = OrderedDict()
+        self._lock = threading.Lock()
+        self._turn = 0
+        self._killed = False
+        self._forceterminate = False
+        self._thread = None
+
+    def add(self, cik):
+        """Returns the Datastore of device cik, adding it if needed. The
+        Datastore is flushed by the manager and must not be started."""
+        with self._lock:
+            ds = self._devices.get(cik)
+            if ds is None:
+                config = self._config
+                if config.get('spool_dir'):
+                    config = dict(config, spool_dir=os.path.join(config['spool_dir'], cik))
+                ds = Datastore(cik, self._interval, self._auto, config,
+                               conn=self._conn, scheduler=self._scheduler)
+                self._devices[cik] = ds
+            return ds
+
+    def remove(self, cik):
+        """Stops managing device cik, after flushing its buffered points."""
+        with self._lock:
+            ds = self._devices.pop(cik, None)
+        if ds is not None:
+            ds._flush()
+            ds._abandon()
+
+    def devices(self):
+        """Returns the CIKs of the managed devices."""
+        with self._lock:
+            return list(self._devices.keys())
+
+    def flush(self):
+        """Flushes every device once. Returns the number of points taken
+        from the buffers and the number of them that could not be sent."""
+        with self._lock:
+            devices = list(self._devices.values())
+            if devices:
+                self._turn %= len(devices)
+                devices = devices[self._turn:] + devices[:self._turn]
+                self._turn += 1
+
+        def flush(ds):
+            try:
+                return ds._flush()
+            except Exception:
+                log.exception("Unknown Exception While Flushing %s", ds._cik)
+                return 0, 0
+
+        if ThreadPoolExecutor is None or self._maxworkers <= 1 or len(devices) <= 1:
+            counts = [flush(ds) for ds in devices]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self._maxworkers, len(devices))) as executor:
+                counts = list(executor.map(flush, devices))
+        return sum(c[0] for c in counts), sum(c[1] for c in counts)
+
+    def __run(self):
+        while not (self._killed and self._forceterminate):
+            self._scheduler.wait()
+            self._scheduler.observe_flush(*self.flush())
+            if self._killed and not any(len(ds._buffer) for ds in list(self._devices.values())):
+                self._forceterminate = True
+        for ds in list(self._devices.values()):
+            ds._abandon()
+
+    def isThreadAlive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, daemon=False):
+        if self._killed and self._thread is not None:
+            # the stopped run abandons the devices on its way out
+            self._thread.join()
+        with self._lock:
+            for ds in self._devices.values():
+                ds._resume()
+        self._killed = False
+        self._forceterminate = False
+        self._thread = threading.Thread(target=self.__run)
+        self._thread.daemon = daemon
+        self._thread.start()
+
+    def stop(self, force=False):
+        self._killed = True
+        self._forceterminate = force
+        self._scheduler.wake()
+        for ds in list(self._devices.values()):
+            ds.stop(force)
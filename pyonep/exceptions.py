@@ -40,3 +40,11 @@ class ProvisionException(OneException):
 
     def __repr__(self):
         return "{0} {1}".format(self.response.status(), self.response.reason())
+
+
+class CircuitOpenException(OneException):
+    pass
+
+
+class LoadShedException(OneException):
+    pass
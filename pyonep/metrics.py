@@ -0,0 +1,196 @@
+# ==============================================================================
+# metrics.py
+# Request instrumentation hooks and latency histograms
+# ==============================================================================
+#
+# Copyright (c) 2016, Exosite LLC
+# All rights reserved.
+#
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+# log errors stderr, don't log anything else
+h = logging.StreamHandler()
+h.setLevel(logging.ERROR)
+log.addHandler(h)
+
+
+def notify(observers, event):
+    """Passes event to each observer. An observer that raises is logged
+    and does not fail the request."""
+    for observer in observers:
+        try:
+            observer(event)
+        except Exception:
+            log.exception("Exception In Metrics Observer")
+
+
+class Histogram(object):
+    """A log-linear histogram, in the style of HdrHistogram.
+
+    Values are multiplied by scale and counted in buckets that are
+    linear within each power of two, with 2 ** subbits buckets per power,
+    so any value is known to within a relative error of 2 ** -subbits
+    (about 3% by default) however large it is. Recording a value is a few
+    integer operations, and memory only grows with the log of the largest
+    value.
+
+    Args:
+        scale: Factor applied to values before they are counted, e.g.
+            1e6 to count seconds in microseconds.
+        subbits: Bits of precision kept for each value.
+    """
+
+    def __init__(self, scale=1, subbits=5):
+        self.scale = scale
+        self.subbits = subbits
+        self._sub = 1 << subbits
+        self._counts = []
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, v):
+        if v < 2 * self._sub:
+            return v
+        shift = v.bit_length() - self.subbits - 1
+        return (shift + 1) * self._sub + (v >> shift) - self._sub
+
+    def _lowest(self, index):
+        # smallest scaled value counted in bucket index
+        if index < 2 * self._sub:
+            return index
+        shift = index // self._sub - 1
+        return (index - shift * self._sub) << shift
+
+    def record(self, value):
+        """Counts one value. Negative values are counted as 0."""
+        v = max(0, int(value * self.scale))
+        index = self._index(v)
+        with self._lock:
+            if index >= len(self._counts):
+                self._counts.extend([0] * (index + 1 - len(self._counts)))
+            self._counts[index] += 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        """Returns the value below which p percent of the values fall, or
+        None if nothing was recorded."""
+        with self._lock:
+            if not self.count:
+                return None
+            rank = max(1, int(round(self.count * p / 100.0)))
+            seen = 0
+            for index, count in enumerate(self._counts):
+                seen += count
+                if seen >= rank:
+                    break
+            value = self._lowest(index) / float(self.scale)
+            return min(max(value, self.min), self.max)
+
+    def reset(self):
+        """Forgets every recorded value."""
+        with self._lock:
+            self._counts = []
+            self.count = 0
+            self.total = 0
+            self.min = self.max = None
+
+    def stats(self):
+        """Returns a dict of the count, min, mean, max and the 50th, 90th,
+        99th and 99.9th percentiles."""
+        return {'count': self.count,
+                'min': self.min,
+                'mean': self.total / float(self.count) if self.count else None,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'p999': self.percentile(99.9)}
+
+
+class Metrics(object):
+    """An observer that keeps histograms of request timings and sizes.
+
+    Pass it in the observers list of OnepV1, Provision or OneP_Request.
+    Observers are called with one dict per event:
+
+    'http' events, one per attempt of an HTTP request:
+        method, path, status (None on error), error (the exception, or
+        None), request_bytes, response_bytes, and timings in seconds:
+        send (from sending the request to receiving the response headers,
+        which includes connecting and waiting on the server), download
+        (reading the response body) and total.
+
+    'rpc' events, one per JSON RPC request:
+        procedures (the procedure of each call), calls, error,
+        request_bytes, response_bytes, and timings in seconds: encode,
+        request (the HTTP request, retries included), decode and total.
+
+    Histograms are kept for every timing ('http.send', 'rpc.encode',
+    ...), for byte counts and for the number of calls per request, and
+    calls and errors are counted per procedure.
+    """
+    TIMINGS = {'http': ('send', 'download', 'total'),
+               'rpc': ('encode', 'request', 'decode', 'total')}
+    SIZES = ('request_bytes', 'response_bytes')
+
+    def __init__(self, subbits=5):
+        self.subbits = subbits
+        self.histograms = {}
+        self.procedures = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, scale=1):
+        """Returns the histogram called name, creating it if needed."""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(
+                    name, Histogram(scale=scale, subbits=self.subbits))
+        return histogram
+
+    def __call__(self, event):
+        kind = event['event']
+        for timing in self.TIMINGS.get(kind, ()):
+            if event.get(timing) is not None:
+                self.histogram(kind + '.' + timing, 1e6).record(event[timing])
+        for size in self.SIZES:
+            if event.get(size) is not None:
+                self.histogram(kind + '.' + size).record(event[size])
+        if kind == 'rpc':
+            self.histogram('rpc.calls').record(event['calls'])
+            with self._lock:
+                for procedure in event['procedures']:
+                    self.procedures[procedure] = self.procedures.get(procedure, 0) + 1
+        if event.get('error') is not None:
+            with self._lock:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def reset(self):
+        """Forgets every recorded event."""
+        with self._lock:
+            self.histograms = {}
+            self.procedures = {}
+            self.errors = {}
+
+    def stats(self):
+        """Returns a dict of each histogram's stats, and of the counts of
+        calls per procedure and of errors per event kind."""
+        with self._lock:
+            histograms = dict(self.histograms)
+            stats = {'procedures': dict(self.procedures),
+                     'errors': dict(self.errors)}
+        for name, histogram in histograms.items():
+            stats[name] = histogram.stats()
+        return stats
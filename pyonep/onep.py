@@ -9,10 +9,19 @@
 #
 import sys
 import logging
+import threading
+import time
+from array import array
+from collections import deque
+from operator import itemgetter
 
 from pyonep import onephttp
+from .cache import AliasCache, authkey
+from .codec import get_codec
+from .metrics import notify
+from .retry import idempotent
 from .exceptions import OneException, OnePlatformException
-from .exceptions import JsonRPCRequestException, JsonRPCResponseException
+from .exceptions import JsonRPCRequestException
 
 log = logging.getLogger(__name__)
 
@@ -22,15 +31,16 @@ h.setLevel(logging.ERROR)
 log.addHandler(h)
 
 try:
-    if sys.version_info < (2, 6):
-        json_module = 'python-simplejson'
-        import simplejson as json
-    else:
-        json_module = 'python-json'
-        import json
+    from concurrent.futures import Future, ThreadPoolExecutor
 except ImportError:
-    log.critical("The package '%s' is required." % json_module)
-    sys.exit(1)
+    # Python 2 without the futures package: BatchPolicy is unavailable and
+    # send_all_deferred() sends one auth at a time
+    Future = ThreadPoolExecutor = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class FORMATS:
@@ -39,32 +49,233 @@ class FORMATS:
     INTEGER = 'integer'
 
 
+class RESULTFORMATS:
+    # [[timestamp, value], ...] as returned by the platform
+    LIST = None
+    # (array('q') of timestamps, array('d') of values)
+    COLUMNS = 'columns'
+    # (array('q') of timestamps, numpy array of values)
+    NUMPY = 'numpy'
+
+
+def pack_points(points, resultformat=RESULTFORMATS.COLUMNS):
+    """Packs a read result of [[timestamp, value], ...] into a tuple of
+    (timestamps, values), where timestamps is an array('q') and values is
+    an array('d'), or a numpy array if resultformat is RESULTFORMATS.NUMPY.
+    Values are only packed if they are all numbers: values of string
+    dataports, numeric strings included, are returned as a list. Each
+    column is built in a single pass over the points without creating
+    intermediate lists."""
+    if resultformat == RESULTFORMATS.NUMPY and numpy is None:
+        raise OneException("RESULTFORMATS.NUMPY requires numpy")
+    timestamps = array('q', map(itemgetter(0), points))
+    try:
+        # array('d') refuses strings, where numpy would parse them
+        values = array('d', map(itemgetter(1), points))
+    except (TypeError, ValueError):
+        # string dataport
+        return timestamps, list(map(itemgetter(1), points))
+    if resultformat == RESULTFORMATS.NUMPY:
+        values = numpy.frombuffer(values, dtype=float)
+    return timestamps, values
+
+
+class ReadPager(object):
+    """Walks the window [starttime, endtime] of a dataport one page of
+    page_size points at a time, in sort order ('asc' or 'desc').
+
+    Each page is read with options() and passed to advance(), which returns
+    the points that were not already returned by a previous page. Pages
+    overlap on the timestamp of the boundary point, because more points may
+    share that timestamp, and those points are only returned once.
+
+    When a whole page shares one timestamp, that timestamp is read on its
+    own, with a limit that doubles until every point at it is returned."""
+
+    def __init__(self, starttime, endtime, page_size=1000, sort='asc'):
+        self.starttime = starttime
+        self.endtime = endtime
+        self.page_size = page_size
+        self.sort = sort
+        self.done = False
+        # timestamp the next page begins at, and how many of the points at
+        # that timestamp have already been returned
+        self._boundary = None
+        self._seen = 0
+        # limit of the next read of a crowded boundary timestamp, None
+        # when not draining one
+        self._drain = None
+
+    def options(self):
+        """Returns the read options for the next page."""
+        if self._drain is not None:
+            return {'starttime': self._boundary,
+                    'endtime': self._boundary,
+                    'limit': self._drain,
+                    'sort': self.sort}
+        return {'starttime': self.starttime,
+                'endtime': self.endtime,
+                'limit': self.page_size,
+                'sort': self.sort}
+
+    def advance(self, page):
+        """Moves the window past page and returns its new points."""
+        if self._drain is not None:
+            return self._advancedrain(page)
+        skip = 0
+        if self._boundary is not None:
+            while (skip < len(page) and skip < self._seen and
+                   page[skip][0] == self._boundary):
+                skip += 1
+        if len(page) < self.page_size:
+            self.done = True
+            return page[skip:]
+        last = page[-1][0]
+        n = 1
+        while n < len(page) and page[-1 - n][0] == last:
+            n += 1
+        self._boundary = last
+        self._seen = n
+        if n == len(page):
+            # a whole page shares one timestamp, so the window can't start
+            # at it again without returning the same page forever
+            self._drain = 2 * self.page_size
+        elif self.sort == 'asc':
+            self.starttime = last
+        else:
+            self.endtime = last
+        return page[skip:]
+
+    def _advancedrain(self, page):
+        """advance() for a read of the crowded boundary timestamp only."""
+        points = page[self._seen:]
+        if len(page) < self._drain:
+            # every point at the boundary has been returned, carry on
+            # past it
+            if self.sort == 'asc':
+                self.starttime = self._boundary + 1
+            else:
+                self.endtime = self._boundary - 1
+            self._boundary = None
+            self._seen = 0
+            self._drain = None
+            if self.starttime > self.endtime:
+                self.done = True
+        else:
+            self._seen = len(page)
+            self._drain *= 2
+        return points
+
+
+def _isrid(resource):
+    """Returns True if resource is a resource ID rather than an alias."""
+    if len(resource) != 40:
+        return False
+    try:
+        int(resource, 16)
+        return True
+    except ValueError:
+        return False
+
+
+def _chain(future, fn):
+    """Returns a Future for fn applied to the result of future."""
+    chained = Future()
+
+    def done(f):
+        try:
+            chained.set_result(fn(f.result()))
+        except Exception:
+            chained.set_exception(sys.exc_info()[1])
+    future.add_done_callback(done)
+    return chained
+
+
 class DeferredRequests():
     """Encapsulates a list of deferred requests for each auth/CIK. Once the requests
         are ready to be sent, get_method_args_pairs() returns a list of the
         method name and arguments for each request and get_notimeout() returns whether
-        the client should time out."""
+        the client should time out.
+
+        DeferredRequests may be shared between threads. Each auth/CIK has its
+        own lock, so threads deferring calls for different auths don't contend,
+        and pop() takes the pending requests for an auth atomically."""
 
     def __init__(self):
         self._requests = {}
         self._notimeouts = {}
+        self._futures = {}
+        self._sizes = {}
+        self._bytes = {}
+        self._since = {}
+        self._auths = {}
+        self._locks = {}
+        self._lock = threading.Lock()
 
     def _authstr(self, auth):
         """Convert auth to str so that it can be hashed"""
-        if type(auth) is dict:
-            return '{' + ','.join(["{0}:{1}".format(k, auth[k]) for k in sorted(auth.keys())]) + '}'
-        return auth
-
-    def add(self, auth, method, args, notimeout=False):
-        """Append a deferred request for a particular auth/CIK."""
+        return authkey(auth)
+
+    def _authlock(self, authstr):
+        """Returns the lock for an auth/CIK, creating it if necessary."""
+        lock = self._locks.get(authstr)
+        if lock is None:
+            with self._lock:
+                lock = self._locks.setdefault(authstr, threading.Lock())
+        return lock
+
+    def add(self, auth, method, args, notimeout=False, future=None, size=0):
+        """Append a deferred request for a particular auth/CIK. future, if
+        given, is resolved with the request's result when it is sent. size
+        is the request's encoded size in bytes. Returns a tuple of the number
+        of requests and bytes now deferred for auth/CIK."""
         authstr = self._authstr(auth)
-        self._requests.setdefault(authstr, []).append((method, args))
-        self._notimeouts.setdefault(authstr, False)
-        if notimeout:
-            self._notimeouts[authstr] = notimeout
+        with self._authlock(authstr):
+            requests = self._requests.setdefault(authstr, [])
+            if not requests:
+                self._since[authstr] = time.time()
+                self._auths[authstr] = auth
+            requests.append((method, args))
+            self._futures.setdefault(authstr, []).append(future)
+            self._sizes.setdefault(authstr, []).append(size)
+            self._bytes[authstr] = self._bytes.get(authstr, 0) + size
+            self._notimeouts.setdefault(authstr, False)
+            if notimeout:
+                self._notimeouts[authstr] = notimeout
+            return len(requests), self._bytes[authstr]
 
     def reset(self, auth):
-        self._requests.pop(self._authstr(auth))
+        self._pop(self._authstr(auth), strict=True)
+
+    def _pop(self, authstr, strict=False):
+        """Removes the deferred requests for authstr and returns a tuple of
+        (auth, method/arguments pairs, notimeout, futures, sizes), where
+        sizes is the encoded size of each request."""
+        with self._authlock(authstr):
+            if strict:
+                requests = self._requests.pop(authstr)
+            else:
+                requests = self._requests.pop(authstr, [])
+            self._since.pop(authstr, None)
+            self._bytes.pop(authstr, None)
+            return (self._auths.pop(authstr, authstr),
+                    requests,
+                    self._notimeouts.pop(authstr, False),
+                    self._futures.pop(authstr, []),
+                    self._sizes.pop(authstr, []))
+
+    def pop(self, auth):
+        """Removes the deferred requests for auth/CIK and returns a tuple of
+        (method/arguments pairs, notimeout). Requests deferred after pop()
+        returns are kept for the next send."""
+        _, requests, notimeout, _, _ = self._pop(self._authstr(auth))
+        return requests, notimeout
+
+    def pending(self):
+        """Returns a list of (authstr, time) tuples for each auth/CIK that has
+        deferred requests, where time is when its oldest request was
+        deferred."""
+        return list(self._since.items())
 
     def has_requests(self, auth):
         """Returns True if there are any deferred requests for
@@ -84,6 +295,117 @@ class DeferredRequests():
         return self._notimeouts[self._authstr(auth)]
 
 
+class BatchPolicy(object):
+    """Decides when OnepV1 sends an auth/CIK's deferred calls by itself.
+
+    Args:
+        max_calls: Send once this many calls are deferred.
+        max_bytes: Send once the deferred calls encode to this many bytes.
+        max_age: Send once the oldest deferred call is this many seconds old.
+        max_workers: Number of auths/CIKs whose calls are sent concurrently.
+    Any of max_calls, max_bytes and max_age may be None to disable that
+    trigger.
+    """
+
+    def __init__(self, max_calls=100, max_bytes=None, max_age=1.0, max_workers=1):
+        if Future is None:
+            raise OneException("BatchPolicy requires the concurrent.futures module")
+        self.max_calls = max_calls
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_workers = max_workers
+
+    def isfull(self, count, nbytes):
+        """Returns True if count calls of nbytes should be sent now."""
+        return ((self.max_calls is not None and count >= self.max_calls) or
+                (self.max_bytes is not None and nbytes >= self.max_bytes))
+
+    def chunks(self, sizes):
+        """Splits calls of the given encoded sizes into requests that each
+        stay within max_calls and max_bytes. Returns a list of the number
+        of calls in each request. A call larger than max_bytes is sent in
+        a request of its own."""
+        chunks = []
+        count = nbytes = 0
+        for size in sizes:
+            if count and ((self.max_calls is not None and count >= self.max_calls) or
+                          (self.max_bytes is not None and nbytes + size > self.max_bytes)):
+                chunks.append(count)
+                count = nbytes = 0
+            count += 1
+            nbytes += size
+        if count:
+            chunks.append(count)
+        return chunks
+
+
+class BatchFlusher(threading.Thread):
+    """Background thread that sends a OnepV1 instance's deferred calls
+    when its BatchPolicy says they are due."""
+
+    def __init__(self, onep, policy):
+        threading.Thread.__init__(self, name='pyonep-batch-flusher')
+        self.daemon = True
+        self.onep = onep
+        self.policy = policy
+        self._cond = threading.Condition()
+        self._full = set()
+        self._changed = False
+        self._stopped = False
+
+    def added(self, authstr, count, nbytes):
+        """Called after a call is deferred for authstr."""
+        full = self.policy.isfull(count, nbytes)
+        # the first call for an auth starts a new max_age deadline
+        if full or count == 1:
+            with self._cond:
+                if full:
+                    self._full.add(authstr)
+                self._changed = True
+                self._cond.notify()
+
+    def stop(self):
+        """Sends any remaining deferred calls and stops the thread."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self is not threading.current_thread():
+            self.join()
+
+    def _due(self):
+        """Returns a set of authstrs that are due now, and the number of
+        seconds until the next one is due (None if nothing is pending)."""
+        with self._cond:
+            due, self._full = self._full, set()
+            self._changed = False
+        timeout = None
+        if self.policy.max_age is not None:
+            now = time.time()
+            for authstr, since in self.onep.deferred.pending():
+                wait = since + self.policy.max_age - now
+                if wait <= 0:
+                    due.add(authstr)
+                elif timeout is None or wait < timeout:
+                    timeout = wait
+        return due, timeout
+
+    def _send(self, authstrs):
+        # exceptions are passed to the calls' futures
+        self.onep._send_deferred_many(authstrs, self.policy.max_workers)
+
+    def run(self):
+        while True:
+            due, timeout = self._due()
+            self._send(due)
+            with self._cond:
+                if self._stopped:
+                    break
+                # a call deferred since _due() may be due sooner
+                if not self._changed:
+                    self._cond.wait(timeout)
+        self._send([authstr for authstr, _ in self.onep.deferred.pending()])
+
+
 class OnepV1():
     headers = {'Content-Type': 'application/json; charset=utf-8'}
 
@@ -97,35 +419,112 @@ class OnepV1():
                  reuseconnection=False,
                  logrequests=False,
                  curldebug=False,
-                 startid=0):
+                 startid=0,
+                 pool=None,
+                 batch=None,
+                 codec=None,
+                 aliascache=None,
+                 retry=None,
+                 breaker=None,
+                 limiter=None,
+                 observers=None,
+                 logbody=None,
+                 logsample=1.0,
+                 compress=None,
+                 compresslevel=6,
+                 logsize=100):
+        """batch, if given, is a BatchPolicy. Calls made with defer=True
+        then return a concurrent.futures.Future that resolves to the call's
+        (success, result) tuple, and deferred calls are sent by a background
+        thread as soon as the policy says they are due.
+
+        codec selects the JSON codec (see pyonep.codec.get_codec). By default
+        the fastest installed one is used.
+
+        aliascache is the pyonep.cache.AliasCache used by resolve(). Pass the
+        same one to several instances to share it.
+
+        retry, if given, is a pyonep.retry.RetryPolicy. Requests that fail
+        to connect are retried, and so are requests that fail otherwise if
+        all of their calls are to procedures that are safe to repeat (see
+        retry.IDEMPOTENT_PROCEDURES).
+
+        breaker, if given, is a pyonep.circuit.CircuitBreaker, or True to
+        use the one shared by every client of this host. While it is open
+        calls fail right away with CircuitOpenException. limiter, if given,
+        is a pyonep.circuit.ConcurrencyLimiter; requests over its limit
+        are shed with LoadShedException.
+
+        observers is a list of callables, such as a pyonep.metrics.Metrics,
+        that are passed an event with the timings, sizes and procedures of
+        each RPC request and of each HTTP attempt made for it.
+
+        With logrequests, the bodies of the last logsize requests are kept
+        for loggedrequests().
+
+        logbody and logsample limit the request bodies logged at debug
+        level: each body is cut to logbody characters, and only a
+        logsample fraction of them are logged.
+
+        compress, if given, is the size in characters from which request
+        bodies are sent gzip compressed, at compresslevel. If the server
+        refuses a compressed body it is sent again uncompressed, and this
+        instance stops compressing. Compressed responses are always
+        accepted, and decompressed as they are read."""
         self.url = url
+        self.codec = get_codec(codec)
+        self.aliascache = AliasCache() if aliascache is None else aliascache
         self._clientid = None
         self._resourceid = None
         self.deferred = DeferredRequests()
         if agent is not None:
             self.headers['User-Agent'] = agent
         self.logrequests = logrequests
+        self._loggedrequests = deque(maxlen=logsize)
+        self.observers = observers or []
         # starting ID for RPC calls
         self.startid = startid
-        self.onephttp = onephttp.OneP_Request(host + ':' + str(port),
-                                              https=https,
-                                              httptimeout=int(httptimeout),
-                                              headers=self.headers,
-                                              reuseconnection=reuseconnection,
-                                              log=log,
-                                              curldebug=curldebug)
+        self._idlock = threading.Lock()
+        self.batch = batch
+        self._flusher = None
+        self._flusherlock = threading.Lock()
+        self.onephttp = self._transport(host + ':' + str(port),
+                                        https=https,
+                                        httptimeout=int(httptimeout),
+                                        headers=self.headers,
+                                        reuseconnection=reuseconnection,
+                                        log=log,
+                                        curldebug=curldebug,
+                                        pool=pool,
+                                        retry=retry,
+                                        breaker=breaker,
+                                        limiter=limiter,
+                                        observers=self.observers,
+                                        logbody=logbody,
+                                        logsample=logsample,
+                                        compress=compress,
+                                        compresslevel=compresslevel)
+
+    def _transport(self, host, **kwargs):
+        """Returns the HTTP transport for host. Subclasses override this to
+        use another transport."""
+        return onephttp.OneP_Request(host, **kwargs)
 
     def close(self):
         """Closes any open connection. This should only need to be called if
         reuseconnection is set to True. Once it's closed, the connection may be
-        reopened by making another API called."""
+        reopened by making another API called. In batching mode, any deferred
+        calls are sent first."""
+        with self._flusherlock:
+            flusher, self._flusher = self._flusher, None
+        if flusher is not None:
+            flusher.stop()
         self.onephttp.close()
 
-    _loggedrequests = []
-
     def loggedrequests(self):
-        """Returns a list of request bodies made by this instance of OnepV1"""
-        return self._loggedrequests
+        """Returns a list of the last logsize request bodies made by this
+        instance of OnepV1, oldest first"""
+        return list(self._loggedrequests)
 
     def _callJsonRPC(self, auth, callrequests, returnreq=False, notimeout=False):
         """Calls the Exosite One Platform RPC API.
@@ -138,31 +537,74 @@ class OnepV1():
             notimeout, if true, ignores reuseconnection setting, creating
             a new connection with no timeout.
                 """
+        if self.observers:
+            return self._observeJsonRPC(auth, callrequests, returnreq, notimeout)
+        body = self._encodeJsonRPC(auth, callrequests)
+        body, response = self._requestJsonRPC(body, callrequests, notimeout)
+        return self._parseJsonRPC(body, callrequests, returnreq)
+
+    def _observeJsonRPC(self, auth, callrequests, returnreq, notimeout):
+        """_callJsonRPC, timing each phase for the observers."""
+        event = {'event': 'rpc',
+                 'procedures': [c['procedure'] for c in callrequests],
+                 'calls': len(callrequests),
+                 'error': None,
+                 'request_bytes': None,
+                 'response_bytes': None,
+                 'encode': None,
+                 'request': None,
+                 'decode': None}
+        start = time.time()
+        try:
+            body = self._encodeJsonRPC(auth, callrequests)
+            encoded = time.time()
+            event['encode'] = encoded - start
+            event['request_bytes'] = len(body)
+            body, response = self._requestJsonRPC(body, callrequests, notimeout)
+            received = time.time()
+            event['request'] = received - encoded
+            event['response_bytes'] = len(body)
+            result = self._parseJsonRPC(body, callrequests, returnreq)
+            event['decode'] = time.time() - received
+            return result
+        except Exception:
+            event['error'] = sys.exc_info()[1]
+            raise
+        finally:
+            event['total'] = time.time() - start
+            notify(self.observers, event)
+
+    def _requestJsonRPC(self, body, callrequests, notimeout):
+        """Sends an encoded RPC request, returning the raw response body
+        and the response."""
+        def handle_request_exception(exception):
+            raise JsonRPCRequestException(
+                "Failed to make http request: %s" % str(exception))
+
+        return self.onephttp.request('POST',
+                                     self.url,
+                                     body,
+                                     self.headers,
+                                     exception_fn=handle_request_exception,
+                                     notimeout=notimeout,
+                                     raw=True,
+                                     idempotent=idempotent(
+                                         [c['procedure'] for c in callrequests]))
+
+    def _encodeJsonRPC(self, auth, callrequests):
+        """Builds the JSON body of an RPC request."""
         # get full auth (auth could be a CIK str)
         auth = self._getAuth(auth)
         jsonreq = {"auth": auth, "calls": callrequests}
         if self.logrequests:
             self._loggedrequests.append(jsonreq)
-        body = json.dumps(jsonreq)
-
-        def handle_request_exception(exception):
-            raise JsonRPCRequestException(
-                "Failed to make http request: %s" % str(exception))
-
-        body, response = self.onephttp.request('POST',
-                                               self.url,
-                                               body,
-                                               self.headers,
-                                               exception_fn=handle_request_exception,
-                                               notimeout=notimeout)
-
-        def handle_response_exception(exception):
-
-            raise JsonRPCResponseException(
-                "Failed to get response for request: %s %s" % (type(exception), str(exception)))
+        return self.codec.dumps(jsonreq)
 
+    def _parseJsonRPC(self, body, callrequests, returnreq=False):
+        """Parses the JSON body of an RPC response. See _callJsonRPC for
+        the structure of the result."""
         try:
-            res = json.loads(body)
+            res = self.codec.loads(body)
         except:
             ex = sys.exc_info()[1]
             raise OnePlatformException(
@@ -170,24 +612,32 @@ class OnepV1():
         if isinstance(res, dict) and 'error' in res:
             raise OnePlatformException(str(res['error']))
         if isinstance(res, list):
-            ret = []
+            # index the requests by id once so that matching each response
+            # to its request is O(1), and return results in request order
+            index = dict((call['id'], i) for i, call in enumerate(callrequests))
+            ret = [None] * len(callrequests)
             for r in res:
-                # first, find the matching request so we can return it
-                # along with the response.
-                request = None
-                for call in callrequests:
-                    if call['id'] == r['id']:
-                        request = call
+                i = index.get(r['id'])
+                request = None if i is None else callrequests[i]
                 if 'status' in r:
                     if 'ok' == r['status']:
                         if 'result' in r:
-                            ret.append((request, True, r['result']))
+                            result = (request, True, r['result'])
                         else:
-                            ret.append((request, True, 'ok'))
+                            result = (request, True, 'ok')
                     else:
-                        ret.append((request, False, r['status']))
+                        result = (request, False, r['status'])
                 elif 'error' in r:
                     raise OnePlatformException(str(r['error']))
+                else:
+                    continue
+                if i is None:
+                    ret.append(result)
+                else:
+                    ret[i] = result
+            if None in ret:
+                # drop requests the server didn't respond to
+                ret = [r for r in ret if r is not None]
             if returnreq:
                 return ret
             else:
@@ -210,51 +660,235 @@ class OnepV1():
             return {"cik": auth}
 
     def _composeCalls(self, method_args_pairs):
+        # reserve a block of ids so that threads sharing this
+        # instance never send duplicate call ids
+        with self._idlock:
+            callid = self.startid
+            self.startid += len(method_args_pairs)
         calls = []
         for method, args in method_args_pairs:
-            calls.append({'id': self.startid,
+            calls.append({'id': callid,
                           'procedure': method,
                           'arguments': args})
-            self.startid += 1
+            callid += 1
         return calls
 
-    def _call(self, method, auth, arg, defer, notimeout=False):
+    def _call(self, method, auth, arg, defer, notimeout=False, transform=None):
         """Calls the Exosite One Platform RPC API.
 
            If `defer` is False, result is a tuple with this structure:
 
                 (success (boolean), response)
 
-           Otherwise, the result is just True.
+           Otherwise, the result is just True, or a Future for that tuple
+           in batching mode.
 
            notimeout, if True, ignores the reuseconnection setting, creating
            a new connection with no timeout.
+
+           transform, if given, is applied to the (success, response) tuple.
+           It is not applied to results returned by send_deferred().
         """
         if defer:
+            if self.batch is not None:
+                future = self._batchcall(method, auth, arg, notimeout)
+                if transform is not None:
+                    future = _chain(future, transform)
+                return future
             self.deferred.add(auth, method, arg, notimeout=notimeout)
             return True
         else:
             calls = self._composeCalls([(method, arg)])
-            return self._callJsonRPC(auth, calls, notimeout=notimeout)
+            r = self._callJsonRPC(auth, calls, notimeout=notimeout)
+            if transform is not None:
+                r = transform(r)
+            return r
+
+    def _packread(self, resultformat):
+        """Returns a transform that packs a successful read result."""
+        def transform(r):
+            success, result = r
+            if not success:
+                return r
+            return success, pack_points(result, resultformat)
+        return transform
+
+    def _batchcall(self, method, auth, arg, notimeout):
+        """Defers a call in batching mode and returns its Future."""
+        future = Future()
+        size = 0
+        if self.batch.max_bytes is not None:
+            size = len(self.codec.dumps({'id': 0, 'procedure': method, 'arguments': arg}))
+        count, nbytes = self.deferred.add(auth, method, arg, notimeout=notimeout,
+                                          future=future, size=size)
+        flusher = self._flusher
+        if flusher is None:
+            with self._flusherlock:
+                if self._flusher is None:
+                    self._flusher = BatchFlusher(self, self.batch)
+                    self._flusher.start()
+                flusher = self._flusher
+        flusher.added(self.deferred._authstr(auth), count, nbytes)
+        return future
 
     def has_deferred(self, auth):
         return self.deferred.has_requests(auth)
 
     def send_deferred(self, auth):
         """Send all deferred requests for a particular CIK/auth."""
-        if self.deferred.has_requests(auth):
-            method_arg_pairs = self.deferred.get_method_args_pairs(auth)
-            calls = self._composeCalls(method_arg_pairs)
-            # should this call be made with no timeout? (e.g. is there a
-            # wait())
-            notimeout = self.deferred.get_notimeout(auth)
+        r = self._send_deferred(self.deferred._authstr(auth))
+        if r is None:
+            raise JsonRPCRequestException('No deferred requests to send.')
+        return r
+
+    def send_all_deferred(self, max_workers=10):
+        """Send the deferred requests of every CIK/auth, sending up to
+        max_workers auths' requests concurrently.
+
+        Returns a tuple of two dicts keyed by CIK (a dict auth is keyed by
+        its string form, see DeferredRequests._authstr). The first maps each
+        auth to its list of (request, success, response) tuples, as
+        returned by send_deferred(). The second maps each auth whose
+        request failed to the exception, so that one bad CIK does not stop
+        the others from being sent."""
+        authstrs = [authstr for authstr, _ in self.deferred.pending()]
+        return self._send_deferred_many(authstrs, max_workers)
+
+    def _send_deferred_many(self, authstrs, max_workers):
+        """Sends the deferred requests of each authstr. See
+        send_all_deferred."""
+        results = {}
+        errors = {}
+
+        def send(authstr):
             try:
-                r = self._callJsonRPC(auth, calls, returnreq=True, notimeout=notimeout)
-            finally:
-                # remove deferred calls
-                self.deferred.reset(auth)
-            return r
-        raise JsonRPCRequestException('No deferred requests to send.')
+                r = self._send_deferred(authstr)
+                if r is not None:
+                    results[authstr] = r
+            except Exception:
+                errors[authstr] = sys.exc_info()[1]
+
+        if ThreadPoolExecutor is None or max_workers <= 1 or len(authstrs) <= 1:
+            for authstr in authstrs:
+                send(authstr)
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(authstrs))) as executor:
+                list(executor.map(send, authstrs))
+        return results, errors
+
+    def _send_deferred(self, authstr):
+        """Sends the deferred requests for authstr and resolves their futures.
+        In batching mode the requests are split into as many RPC requests as
+        the BatchPolicy requires. Returns None if there was nothing to send."""
+        # take the deferred calls before sending so that calls deferred by
+        # other threads in the meantime are kept for the next send
+        auth, method_arg_pairs, notimeout, futures, sizes = self.deferred._pop(authstr)
+        if not method_arg_pairs:
+            return None
+        calls = self._composeCalls(method_arg_pairs)
+        chunks = [len(calls)]
+        if self.batch is not None:
+            chunks = self.batch.chunks(sizes)
+        ret = []
+        error = None
+        start = 0
+        for size in chunks:
+            chunk = calls[start:start + size]
+            chunkfutures = futures[start:start + size]
+            start += size
+            try:
+                # should this call be made with no timeout? (e.g. is there a
+                # wait())
+                r = self._callJsonRPC(auth, chunk, returnreq=True, notimeout=notimeout)
+            except Exception:
+                error = sys.exc_info()[1]
+                for future in chunkfutures:
+                    if future is not None and not future.done():
+                        future.set_exception(error)
+                continue
+            self._resolvefutures(chunk, chunkfutures, r)
+            ret.extend(r)
+        if error is not None:
+            raise error
+        return ret
+
+    def _resolvefutures(self, calls, futures, results):
+        """Sets each future to the (success, result) of its call."""
+        if not any(futures):
+            return
+        index = dict((call['id'], i) for i, call in enumerate(calls))
+        for request, success, result in results:
+            if request is None:
+                continue
+            future = futures[index[request['id']]]
+            if future is not None and not future.done():
+                future.set_result((success, result))
+        for future in futures:
+            if future is not None and not future.done():
+                future.set_exception(OnePlatformException("No response for call"))
+
+    def resolve(self, auth, alias, forcequery=False):
+        """Returns the resource ID of alias, or None if it doesn't exist.
+        Results, including missing aliases, are kept in self.aliascache. If
+        forcequery is True, the cache is bypassed."""
+        return self.resolve_many(auth, [alias], forcequery)[alias]
+
+    def resolve_many(self, auth, aliases, forcequery=False):
+        """Returns a dict mapping each alias to its resource ID, or None if
+        it doesn't exist. Aliases that are not cached are looked up with a
+        single RPC request."""
+        rids, calls = self._resolvecalls(auth, aliases, forcequery)
+        if calls:
+            self._resolveresults(auth, calls, self._callJsonRPC(auth, calls, returnreq=True),
+                                 rids)
+        return rids
+
+    def _resolvecalls(self, auth, aliases, forcequery):
+        """Returns a dict of the cached resource IDs of aliases, and the
+        lookup calls for the others."""
+        rids = {}
+        missing = []
+        for alias in aliases:
+            rid = None if forcequery else self.aliascache.get(auth, alias)
+            if rid is None:
+                missing.append(alias)
+            else:
+                rids[alias] = rid or None
+        return rids, self._composeCalls([('lookup', ['alias', alias]) for alias in missing])
+
+    def _resolveresults(self, auth, calls, results, rids):
+        """Caches the results of lookup calls and adds them to rids."""
+        for request, success, result in results:
+            if request is None:
+                continue
+            alias = request['arguments'][1]
+            if success:
+                self.aliascache.put(auth, alias, result)
+                rids[alias] = result
+            else:
+                self.aliascache.put_missing(auth, alias)
+                rids[alias] = None
+        for call in calls:
+            rids.setdefault(call['arguments'][1], None)
+
+    def prefetch_aliases(self, auth, resource={'alias': ''}):
+        """Caches the resource IDs of every alias of a client (by default
+        the client of auth) with a single info call. Returns a dict mapping
+        each alias to its resource ID."""
+        return self._prefetchresult(auth, self.info(auth, resource, {'aliases': True}))
+
+    def _prefetchresult(self, auth, r):
+        """Caches the aliases in the result of an info call."""
+        success, result = r
+        if not success:
+            raise OnePlatformException(
+                "Error message from one platform (info): %s" % result)
+        rids = {}
+        for rid, aliases in result['aliases'].items():
+            for alias in aliases:
+                self.aliascache.put(auth, alias, rid)
+                rids[alias] = rid
+        return rids
 
     def connect_as(self, clientid):
         self._clientid = clientid
@@ -406,7 +1040,7 @@ class OnepV1():
         """
         return self._call('move', auth, [resource, destinationresource, options], defer)
 
-    def read(self, auth, resource, options, defer=False):
+    def read(self, auth, resource, options, defer=False, resultformat=RESULTFORMATS.LIST):
         """ Read value(s) from a dataport.
 
         Calls a function that builds a request to read the dataport specified by an alias or rid
@@ -416,8 +1050,152 @@ class OnepV1():
             auth: Takes the device cik
             resource: Takes the dataport alias or rid.
             options: Takes a list of options for what to return.
+            resultformat: RESULTFORMATS.COLUMNS or RESULTFORMATS.NUMPY to get the
+                data as a (timestamps, values) tuple of packed arrays instead of a
+                list of [timestamp, value] lists. See pack_points. Ignored for
+                results returned by send_deferred().
         """
-        return self._call('read', auth, [resource, options], defer)
+        transform = None
+        if resultformat is not RESULTFORMATS.LIST:
+            transform = self._packread(resultformat)
+        return self._call('read', auth, [resource, options], defer, transform=transform)
+
+    def iter_read(self, auth, resource, starttime, endtime, page_size=1000, sort='asc',
+                  pages=False, prefetch=True):
+        """ Iterates over all the points of a dataport between starttime and endtime.
+
+        Points are read page_size at a time, so memory use does not grow with the
+        length of the window. While the caller works through a page, the next one is
+        read in the background unless prefetch is False.
+
+        Args:
+            auth: Takes the device cik
+            resource: Takes the dataport alias or rid.
+            starttime: Start of the window (inclusive), in seconds since the epoch.
+            endtime: End of the window (inclusive), in seconds since the epoch.
+            page_size: Number of points per read.
+            sort: 'asc' for oldest points first, 'desc' for newest first.
+            pages: If True, yield lists of points instead of single points.
+            prefetch: If True, read the next page while the current one is consumed.
+
+        Raises:
+            OnePlatformException if a read fails.
+        """
+        pager = ReadPager(starttime, endtime, page_size, sort)
+
+        def readpage(options):
+            success, result = self.read(auth, resource, options)
+            if not success:
+                raise OnePlatformException(
+                    "Error message from one platform (read): %s" % result)
+            return result
+
+        executor = None
+        if prefetch and ThreadPoolExecutor is not None:
+            executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            page = readpage(pager.options())
+            while True:
+                points = pager.advance(page)
+                if not pager.done:
+                    options = pager.options()
+                    if executor is not None:
+                        nextpage = executor.submit(readpage, options)
+                    else:
+                        nextpage = None
+                if points:
+                    if pages:
+                        yield points
+                    else:
+                        for point in points:
+                            yield point
+                if pager.done:
+                    break
+                page = readpage(options) if nextpage is None else nextpage.result()
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def read_many(self, auth, resources, options, max_calls=100, max_workers=4,
+                  resultformat=RESULTFORMATS.LIST):
+        """ Read value(s) from many dataports at once.
+
+        The reads are packed into RPC requests of up to max_calls calls each, and up to
+        max_workers of those requests are sent concurrently.
+
+        Args:
+            auth: Takes the device cik
+            resources: A list of dataports. Each is a rid, an alias, or an identifier
+                dict such as {"alias": "temp"}.
+            options: Read options, as for read(), used for every dataport.
+            max_calls: Maximum number of reads per RPC request.
+            max_workers: Maximum number of RPC requests in flight.
+            resultformat: See read().
+
+        Returns:
+            A dict mapping each resource (the alias for identifier dicts) to the
+            (success, result) tuple of its read. If the request carrying a read fails,
+            its result is (False, exception), so one failure does not lose the rest.
+        """
+        calls, keys = self._readcalls(resources, options)
+        transform = None
+        if resultformat is not RESULTFORMATS.LIST:
+            transform = self._packread(resultformat)
+        chunks = [(calls[i:i + max_calls], keys[i:i + max_calls])
+                  for i in range(0, len(calls), max_calls)]
+        results = {}
+
+        def send(chunk):
+            chunkcalls, chunkkeys = chunk
+            try:
+                r = self._callJsonRPC(auth, chunkcalls, returnreq=True)
+            except Exception:
+                ex = sys.exc_info()[1]
+                for key in chunkkeys:
+                    results[key] = (False, ex)
+                return
+            self._readresults(chunkcalls, chunkkeys, r, results, transform)
+
+        if ThreadPoolExecutor is None or max_workers <= 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                send(chunk)
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+                list(executor.map(send, chunks))
+        return results
+
+    def _readcalls(self, resources, options):
+        """Returns the read calls for read_many and the result key of each."""
+        keys = []
+        pairs = []
+        seen = set()
+        for resource in resources:
+            if isinstance(resource, dict):
+                key = resource.get('alias', self.deferred._authstr(resource))
+            else:
+                key = resource
+                if not _isrid(resource):
+                    resource = {'alias': resource}
+            if key in seen:
+                continue
+            seen.add(key)
+            keys.append(key)
+            pairs.append(('read', [resource, options]))
+        return self._composeCalls(pairs), keys
+
+    def _readresults(self, calls, keys, r, results, transform):
+        """Stores the results of a read_many request in results."""
+        index = dict((call['id'], i) for i, call in enumerate(calls))
+        for request, success, result in r:
+            if request is None:
+                continue
+            key = keys[index[request['id']]]
+            results[key] = (success, result)
+            if transform is not None:
+                results[key] = transform(results[key])
+        for key in keys:
+            if key not in results:
+                results[key] = (False, OnePlatformException("No response for call"))
 
     def record(self, auth, resource, entries, options={}, defer=False):
         """ Records a list of historical entries to the resource specified.
@@ -12,9 +12,202 @@
    Copyright (c) 2016, Exosite LLC"""
 # pylint: disable = W0312
 
+import logging
+import random
 import sys
+import threading
+import time
+import warnings
+import zlib
 
 from requests import Session, Request
+from requests.adapters import HTTPAdapter
+
+from .circuit import get_breaker
+from .exceptions import CircuitOpenException, LoadShedException
+from .metrics import notify
+
+
+class ConnectionPool(object):
+    """A pool of keep-alive HTTP connections to a single host.
+
+    A ConnectionPool may be shared by any number of OneP_Request objects
+    (and therefore OnepV1 and Provision instances) that talk to the same
+    host, so that the TCP and TLS handshakes are paid once instead of on
+    every call.
+
+    Args:
+        maxsize: Number of keep-alive connections kept open per host.
+        idletimeout: Seconds a pool may sit unused before its connections
+            are closed. None disables idle reaping.
+        block: If True, callers wait for a free connection when all
+            maxsize connections are busy instead of opening a new,
+            short-lived one.
+    """
+
+    def __init__(self, maxsize=10, idletimeout=60, block=False):
+        self.maxsize = maxsize
+        self.idletimeout = idletimeout
+        self.block = block
+        self._lock = threading.Lock()
+        self._session = None
+        self._lastused = None
+        # counters carried over from sessions that have been reset
+        self._hits = 0
+        self._misses = 0
+        self.resets = 0
+        self.reaped = 0
+        self.errors = 0
+
+    def _newsession(self):
+        session = Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.maxsize,
+                              pool_block=self.block)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def session(self):
+        """Returns the pooled requests Session, reaping it first if it has
+        been idle for longer than idletimeout."""
+        with self._lock:
+            now = time.time()
+            if (self._session is not None and
+                    self.idletimeout is not None and
+                    now - self._lastused > self.idletimeout):
+                self._discard()
+                self.reaped += 1
+            if self._session is None:
+                self._session = self._newsession()
+            self._lastused = now
+            return self._session
+
+    def reap(self):
+        """Closes the pooled connections if they have been idle for longer
+        than idletimeout. Returns True if anything was closed."""
+        with self._lock:
+            if (self._session is None or self.idletimeout is None or
+                    time.time() - self._lastused <= self.idletimeout):
+                return False
+            self._discard()
+            self.reaped += 1
+            return True
+
+    def reset(self):
+        """Closes every pooled connection, including those other threads
+        are using. A request error doesn't need it: urllib3 closes the
+        failed connection instead of handing it back to the pool."""
+        with self._lock:
+            if self._session is not None:
+                self._discard()
+                self.resets += 1
+
+    def failed(self):
+        """Counts a request that failed on a pooled connection."""
+        with self._lock:
+            self.errors += 1
+
+    def close(self):
+        """Closes every pooled connection. The pool reopens connections on
+        the next request."""
+        with self._lock:
+            if self._session is not None:
+                self._discard()
+
+    def _discard(self):
+        # caller holds self._lock
+        hits, misses = self._sessioncounts(self._session)
+        self._hits += hits
+        self._misses += misses
+        self._session.close()
+        self._session = None
+
+    @staticmethod
+    def _sessioncounts(session):
+        hits = misses = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                misses += pool.num_connections
+                hits += max(0, pool.num_requests - pool.num_connections)
+        return hits, misses
+
+    def stats(self):
+        """Returns a dict of pool counters. A hit is a request served on an
+        already open connection, a miss is a request that had to open a
+        new one."""
+        with self._lock:
+            hits, misses = self._hits, self._misses
+            if self._session is not None:
+                h, m = self._sessioncounts(self._session)
+                hits += h
+                misses += m
+            return {'hits': hits,
+                    'misses': misses,
+                    'resets': self.resets,
+                    'reaped': self.reaped,
+                    'errors': self.errors}
+
+
+_pools = {}
+_poolslock = threading.Lock()
+
+
+def get_pool(host, https=True, **kwargs):
+    """Returns the process-wide ConnectionPool for host, creating it with
+    kwargs (see ConnectionPool) the first time it is requested. Later
+    kwargs that differ from the existing pool's settings are ignored,
+    with a warning."""
+    key = (https, host)
+    with _poolslock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(**kwargs)
+        pool = _pools[key]
+    different = sorted(k for k, v in kwargs.items() if getattr(pool, k) != v)
+    if different:
+        warnings.warn("The shared pool for %s was created with other settings, "
+                      "ignoring %s" % (host, ', '.join(different)), RuntimeWarning)
+    return pool
+
+
+def close_pools():
+    """Closes every process-wide pool and forgets them, so that the next
+    get_pool() creates new ones."""
+    with _poolslock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+# statuses a server may answer a compressed request body with when it
+# doesn't take compressed bodies
+COMPRESSION_REJECTED = frozenset([400, 415])
+
+
+def gzip_body(body, level=6):
+    """Returns body gzip compressed."""
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def logged_body(body, logbody=None, logsample=1.0):
+    """Returns body as it should be logged: None if it isn't sampled (a
+    logsample fraction of bodies is), else cut to logbody characters
+    (None keeps it whole)."""
+    if body is None or (logsample < 1 and random.random() >= logsample):
+        return None
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+    if logbody is not None and len(body) > logbody:
+        body = '%s... (%d characters)' % (body[:logbody], len(body))
+    return body
 
 
 class OneP_Request:
@@ -25,16 +218,52 @@ class OneP_Request:
                  headers={},
                  reuseconnection=False,
                  log=None,
-                 curldebug=False):
+                 curldebug=False,
+                 pool=None,
+                 retry=None,
+                 breaker=None,
+                 limiter=None,
+                 observers=None,
+                 logbody=None,
+                 logsample=1.0,
+                 compress=None,
+                 compresslevel=6):
         self.host = ('https://' + host) if https else ('http://' + host)
         self.https = https
         self.httptimeout = httptimeout
         self.headers = headers
         self.reuseconnection = reuseconnection
-        self.session = Session()
-        self.session.headers.update(self.headers)
+        # pool may be a ConnectionPool, or True to use the shared pool
+        # for this host
+        if pool is True:
+            pool = get_pool(host, https)
+        self.pool = pool
+        # created on first use when reuseconnection is True
+        self.session = None
         self.log = log
         self.curldebug = curldebug
+        # at debug level, request bodies are cut to logbody characters
+        # (None logs them whole), and only a logsample fraction of them
+        # is logged at all
+        self.logbody = logbody
+        self.logsample = logsample
+        # a retry.RetryPolicy, or None to never retry
+        self.retry = retry
+        # breaker may be a circuit.CircuitBreaker, or True to use the
+        # shared breaker for this host
+        if breaker is True:
+            breaker = get_breaker(host, https)
+        self.breaker = breaker
+        # a circuit.ConcurrencyLimiter, or None for no limit
+        self.limiter = limiter
+        # callables passed an 'http' event for each attempt, see
+        # metrics.Metrics
+        self.observers = observers or []
+        # request bodies of at least compress characters are sent gzip
+        # compressed, unless the server turned compressed bodies down
+        self.compress = compress
+        self.compresslevel = compresslevel
+        self.compressionrejected = False
 
     def request(self,
                 method,
@@ -43,69 +272,214 @@ class OneP_Request:
                 headers={},
                 exception_fn=None,
                 notimeout=False,
-                verify=True):
+                verify=True,
+                raw=False,
+                idempotent=False):
         """Wraps HTTPConnection.request. On exception it calls exception_fn
         with the exception object. If exception_fn is None, it re-raises the
         exception. If notimeout is True, create a new connection (regardless of
         self.reuseconnection setting) that uses the global default timeout for
-        sockets (usually None)."""
-        # This needs to be done first because self.session may be None
-        if not self.reuseconnection or notimeout:
-            self.close()
-            self.session = Session()
+        sockets (usually None). When a pool is configured, connections are
+        always taken from the pool and notimeout only disables the timeout.
+        If raw is True, the response body is returned as bytes instead of
+        being decoded to text. With a retry policy, failed requests are
+        retried as the policy allows; idempotent tells it whether the
+        request may be sent again after it reached the server.
+        CircuitOpenException and LoadShedException, raised when the
+        circuit breaker or concurrency limiter turn a request away, are
+        neither retried nor passed to exception_fn. A compressed request
+        body the server answers with 400 or 415 is sent again
+        uncompressed, and bodies are no longer compressed if that
+        succeeds."""
+        if self.retry is not None:
+            self.retry.started()
+        compress = (self.compress is not None and not self.compressionrejected and
+                    body is not None and len(body) >= self.compress)
+        rejected = None
+        attempt = 0
+        while True:
+            try:
+                result = self._guarded(method, path, body, headers, notimeout, verify, raw,
+                                       compress)
+            except (CircuitOpenException, LoadShedException):
+                raise
+            except Exception:
+                ex = sys.exc_info()[1]
+                delay = None
+                if self.retry is not None:
+                    delay = self.retry.delay(attempt, idempotent, exception=ex)
+                if delay is None:
+                    if exception_fn is not None:
+                        exception_fn(ex)
+                        return
+                    raise ex
+                self.log.info("Retrying %s %s in %.3fs after: %s", method, path, delay, ex)
+            else:
+                status = result[1].status_code
+                if compress and status in COMPRESSION_REJECTED:
+                    self.log.info("%s %s got status %s for a compressed body, "
+                                  "sending it uncompressed", method, path, status)
+                    compress = False
+                    rejected = status
+                    continue
+                if rejected is not None and status not in COMPRESSION_REJECTED:
+                    # the same body went through uncompressed
+                    self.compressionrejected = True
+                    rejected = None
+                if self.retry is None:
+                    return result
+                delay = self.retry.delay(attempt, idempotent, status=result[1].status_code)
+                if delay is None:
+                    if result[1].status_code not in self.retry.statuses:
+                        self.retry.succeeded(attempt)
+                    return result
+                self.log.info("Retrying %s %s in %.3fs after status %s",
+                              method, path, delay, result[1].status_code)
+            time.sleep(delay)
+            attempt += 1
 
-        allheaders = headers
-        allheaders.update(self.session.headers)
+    def _logbody(self, body):
+        """Returns body as it should be logged: None if it isn't sampled,
+        else cut to logbody characters."""
+        return logged_body(body, self.logbody, self.logsample)
 
+    def _logrequest(self, method, path, body, allheaders):
+        """Logs a request at debug level, as a curl call if curldebug is
+        set. Only called when debug logging is enabled."""
+        body = self._logbody(body)
+        if self.curldebug:
+            # output request as a curl call
+            def escape(s):
+                """escape single quotes for bash"""
+                if isinstance(s, bytes):
+                    s = s.decode('utf-8')
+                return s.replace("'", "'\\''")
+
+            self.log.debug(
+                "curl '%s%s' -X %s -m %s %s %s",
+                self.host,
+                path,
+                method,
+                self.httptimeout,
+                ' '.join(['-H \'{0}: {1}\''.format(escape(h), escape(allheaders[h]))
+                          for h in allheaders]),
+                '' if body is None else '-d \'' + escape(body) + '\'')
+        else:
+            self.log.debug("%s %s\nHost: %s\nHeaders: %s",
+                           method,
+                           path,
+                           self.host,
+                           allheaders)
+            if body is not None:
+                self.log.debug("Body: %s", body)
+
+    def _guarded(self, method, path, body, headers, notimeout, verify, raw, compress=False):
+        """Makes one attempt at a request through the concurrency limiter
+        and circuit breaker, if any."""
+        if self.limiter is not None:
+            self.limiter.acquire()
         try:
-            if self.curldebug:
-                # output request as a curl call
-                def escape(s):
-                    """escape single quotes for bash"""
-                    return s.replace("'", "'\\''")
-
-                self.log.debug(
-                    "curl '{1}{2}' -X {3} -m {4} {5} {6}".format(
-                        'https' if self.https else 'http',
-                        self.host,
-                        path,
-                        method,
-                        self.httptimeout,
-                        ' '.join(['-H \'{0}: {1}\''.format(escape(h), escape(allheaders[h]))
-                                  for h in allheaders]),
-                        '' if body is None else '-d \'' + escape(body) + '\''))
-            else:
-                self.log.debug("%s %s\nHost: %s\nHeaders: %s" % (
-                    method,
-                    path,
-                    self.host,
-                    allheaders))
-                if body is not None:
-                    self.log.debug("Body: %s" % body)
+            if self.breaker is None:
+                return self._send(method, path, body, headers, notimeout, verify, raw, compress)
+            probe = self.breaker.allow()
+            start = time.time()
+            try:
+                result = self._send(method, path, body, headers, notimeout, verify, raw, compress)
+            except Exception:
+                self.breaker.record(time.time() - start, False, probe)
+                raise
+            self.breaker.record(time.time() - start,
+                                not self.breaker.failed(result[1].status_code),
+                                probe)
+            return result
+        finally:
+            if self.limiter is not None:
+                self.limiter.release()
+
+    def _send(self, method, path, body, headers, notimeout, verify, raw, compress=False):
+        """Makes one attempt at a request. See request()."""
+        temporary = None
+        if self.pool is not None:
+            session = self.pool.session()
+        elif self.reuseconnection and not notimeout:
+            if self.session is None:
+                self.session = Session()
+                self.session.headers.update(self.headers)
+            session = self.session
+        else:
+            # a connection for this request only, so that threads sharing
+            # this object never close each other's connections
+            session = temporary = Session()
+            session.headers.update(self.headers)
+        allheaders = dict(session.headers)
+        allheaders.update(self.headers)
+        allheaders.update(headers)
+
+        start = None
+        try:
+            if self.log.isEnabledFor(logging.DEBUG):
+                self._logrequest(method, path, body, allheaders)
+            if compress:
+                body = gzip_body(body, self.compresslevel)
+                allheaders['Content-Encoding'] = 'gzip'
             URI = self.host + path
-            prepped = self.session.prepare_request(
-                Request(method, URI, data=body, headers=headers)
+            prepped = session.prepare_request(
+                Request(method, URI, data=body, headers=allheaders)
             )
 
-            response = self.session.send(
+            start = time.time()
+            response = session.send(
                 prepped,
                 verify=verify,
                 timeout=None if notimeout else self.httptimeout
             )
-            return response.text, response
+            if self.observers:
+                total = time.time() - start
+                # requests has read the whole body by the time send()
+                # returns, and elapsed only covers the wait for headers
+                send = response.elapsed.total_seconds()
+                notify(self.observers, {
+                    'event': 'http',
+                    'method': method,
+                    'path': path,
+                    'status': response.status_code,
+                    'error': None,
+                    'request_bytes': len(prepped.body or b''),
+                    'response_bytes': len(response.content),
+                    'send': send,
+                    'download': max(0.0, total - send),
+                    'total': total})
+            return (response.content if raw else response.text), response
 
         except Exception:
-            self.close()
-            ex = sys.exc_info()[1]
-            if exception_fn is not None:
-                exception_fn(ex)
-            else:
-                raise ex
+            if self.observers and start is not None:
+                notify(self.observers, {
+                    'event': 'http',
+                    'method': method,
+                    'path': path,
+                    'status': None,
+                    'error': sys.exc_info()[1],
+                    'request_bytes': len(prepped.body or b''),
+                    'response_bytes': None,
+                    'send': None,
+                    'download': None,
+                    'total': time.time() - start})
+            if self.pool is not None:
+                # urllib3 has already dropped the failed connection, the
+                # others may be in use by other threads
+                self.pool.failed()
+            elif temporary is None:
+                self.close()
+            raise
+        finally:
+            if temporary is not None:
+                temporary.close()
 
     def close(self):
         """Closes any open connection. This should only need to be called if
         reuseconnection is set to True. Once it's closed, the connection may be
-        reopened by making another API called."""
+        reopened by making another API called. A shared pool is left open;
+        call pool.close() to close its connections."""
         if self.session is not None:
             self.session.close()
             self.session = None
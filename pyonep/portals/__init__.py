@@ -19,7 +19,8 @@ class Portals(Endpoints):
                     user,
                     auth='__prompt__',
                     use_token=False,
-                    debug=False):
+                    debug=False,
+                    codec=None):
         """
             Params:
                 domain:         the domain of the Exosite domain your Portal is on. 
@@ -33,6 +34,8 @@ class Portals(Endpoints):
                                 Portals token
                 use_token:      if using a token in the auth parameter, set this to True. 
                                 Otherwise, leave blank
+                codec:          JSON codec, or codec name, used for request and response
+                                bodies. See pyonep.codec.get_codec.
         """
         if auth == '__prompt__':
             print('') # some interpreters don't put a newline before the getpass prompt
@@ -44,7 +47,8 @@ class Portals(Endpoints):
                             portal_name,
                             user,
                             auth,
-                            use_token=use_token
+                            use_token=use_token,
+                            codec=codec
         )
 
     def get_portals_list(self):
@@ -308,7 +312,7 @@ class Portals(Endpoints):
                     auth=self.auth()
                     )
         if HTTP_STATUS.OK == r.status_code:
-            return r.json()
+            return self.codec().loads(r.content)
         else:
             print("Something went wrong: <{0}>: {1}".format(
                         r.status_code, r.reason))
@@ -328,7 +332,7 @@ class Portals(Endpoints):
         r = requests.get(   self.portals_url()+'/devices/'+device_rid+'/data-sources', 
                     headers=headers, auth=self.auth())
         if HTTP_STATUS.OK == r.status_code:
-            return r.json()
+            return self.codec().loads(r.content)
         else:
             print("Something went wrong: <{0}>: {1}".format(
                         r.status_code, r.reason))
@@ -350,7 +354,7 @@ class Portals(Endpoints):
                             +']/data?limit='+str(limit),
                             headers=headers, auth=self.auth())
         if HTTP_STATUS.OK == r.status_code:
-            return r.json()
+            return self.codec().loads(r.content)
         else:
             print("Something went wrong: <{0}>: {1}".format(
                         r.status_code, r.reason))
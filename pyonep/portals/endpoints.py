@@ -6,6 +6,7 @@ import requests, json
 from pyonep.portals.constants import HTTP_STATUS
 from pyonep.portals.utils import dictify_device_meta
 from pyonep.portals.__version__ import __version__ as VERSION
+from pyonep.codec import get_codec
 from requests.auth import HTTPBasicAuth
 
 try:
@@ -25,7 +26,8 @@ class Domain(object):
                     domain,
                     user,
                     auth,
-                    use_token=False):
+                    use_token=False,
+                    codec=None):
         """
             Abstract the whitelabel/domain
         """
@@ -40,6 +42,7 @@ class Domain(object):
         self.__durl = 'https://'+self.__domain
         self.__user_agent = 'Portals-Bindings-v{0}'.format(VERSION)
         self.__content_type = 'application/json; charset=utf-8'
+        self.__codec = get_codec(codec)
 
     def domain(self):
         return self.__domain
@@ -55,6 +58,8 @@ class Domain(object):
         return self.__content_type
     def headers(self):
         return self.__headers
+    def codec(self):
+        return self.__codec
 
 class Endpoints(Domain):
     """
@@ -69,9 +74,11 @@ class Endpoints(Domain):
                     portal_id=None,
                     # portal_rid=None,
                     use_token=False,
-                    debug=False
+                    debug=False,
+                    codec=None
                     ):
-        Domain.__init__(self, domain=domain, user=user, auth=auth, use_token=use_token)
+        Domain.__init__(self, domain=domain, user=user, auth=auth, use_token=use_token,
+                        codec=codec)
         self.__purl = self.domain_url()+'/api/portals/v1'
         self.__vendor = self.domain().split('.')[0]
         self.__portal_name = portal_name
@@ -159,7 +166,7 @@ class Endpoints(Domain):
                             headers=headers,
                             auth=self.auth())
         if HTTP_STATUS.OK == r.status_code:
-            return [ _id['id'] for _id in r.json() ]
+            return [ _id['id'] for _id in self.codec().loads(r.content) ]
         else:
             print("get_user_portals: Something went wrong: <{0}>: {1}".format(
                         r.status_code, r.reason))
@@ -181,7 +188,7 @@ class Endpoints(Domain):
                             headers=headers,
                             auth=self.auth())
         if HTTP_STATUS.OK == r.status_code:
-            return r.json()
+            return self.codec().loads(r.content)
         else:
             print("get_user_portals: Something went wrong: <{0}>: {1}".format(
                         r.status_code, r.reason))
@@ -202,7 +209,7 @@ class Endpoints(Domain):
                             headers=headers,
                             auth=self.auth())
         if HTTP_STATUS.OK == r.status_code:
-            return r.json()
+            return self.codec().loads(r.content)
         else:
             print("get_portal_by_id: Something went wrong: <{0}>: {1}".format(
                         r.status_code, r.reason))
@@ -228,13 +235,13 @@ class Endpoints(Domain):
         headers.update(self.headers())
 
         r = requests.post(  self.portals_url()+'/portals/'+self.portal_id()+'/devices', 
-                                data=json.dumps(device),
+                                data=self.codec().dumps(device),
                                 headers=headers,
                                 auth=self.auth())
 
         if HTTP_STATUS.ADDED == r.status_code:
             # fix the 'meta' to be dictionary instead of string
-            device_obj = r.json()
+            device_obj = self.codec().loads(r.content)
             return dictify_device_meta(device_obj)
         else:
             print("add_device: Something went wrong: <{0}>: {1}".format(
@@ -255,12 +262,12 @@ class Endpoints(Domain):
         headers.update(self.headers())
 
         r = requests.put(   self.portals_url()+'/devices/'+rid, 
-                            data=json.dumps(device_obj),
+                            data=self.codec().dumps(device_obj),
                             headers=headers,
                             auth=self.auth())
         if HTTP_STATUS.OK == r.status_code:
             # fix the 'meta' to be dictionary instead of string
-            updated_dev_obj = r.json()
+            updated_dev_obj = self.codec().loads(r.content)
             updated_dev_obj['info']['description']['meta'] =\
                             json.loads(device_obj['info']['description']['meta'])
             return updated_dev_obj
@@ -283,11 +290,11 @@ class Endpoints(Domain):
         headers.update(self.headers())
 
         r = requests.put(   self.portals_url()+'/portals/'+self.portal_id(), 
-                            data=json.dumps(portal_obj),
+                            data=self.codec().dumps(portal_obj),
                             headers=headers,
                             auth=self.auth())
         if HTTP_STATUS.OK == r.status_code:
-            return r.json()
+            return self.codec().loads(r.content)
         else:
             print("update_portal: Something went wrong: <{0}>: {1}".format(
                         r.status_code, r.reason))
@@ -314,7 +321,7 @@ class Endpoints(Domain):
     
         if HTTP_STATUS.OK == r.status_code:
             # fix the 'meta' to be dictionary instead of string
-            device_obj = r.json()
+            device_obj = self.codec().loads(r.content)
             # device_obj['info']['description']['meta'] = \
                     # json.loads(device_obj['info']['description']['meta'])
             return device_obj
@@ -345,7 +352,7 @@ class Endpoints(Domain):
     
         if HTTP_STATUS.OK == r.status_code:
             # TODO: loop through all rids and fix 'meta' to be dict like add_device and get_device do
-            return r.json()
+            return self.codec().loads(r.content)
         else:
             print("get_multiple_devices: Something went wrong: <{0}>: {1}".format(
                         r.status_code, r.reason))
@@ -372,7 +379,7 @@ class Endpoints(Domain):
                             auth=self.auth())
     
         if HTTP_STATUS.OK == r.status_code:
-            return r.json()
+            return self.codec().loads(r.content)
         else:
             print("get_all_user_accounts: Something went wrong: <{0}>: {1}".format(
                         r.status_code, r.reason))
@@ -394,7 +401,7 @@ class Endpoints(Domain):
                             auth=self.auth())
     
         if HTTP_STATUS.OK == r.status_code:
-            return r.json()
+            return self.codec().loads(r.content)
         else:
             print("get_user_permission: Something went wrong: <{0}>: {1}".format(
                         r.status_code, r.reason))
@@ -421,7 +428,7 @@ class Endpoints(Domain):
                             auth=self.auth())
     
         if HTTP_STATUS.OK == r.status_code:
-            return r.json()
+            return self.codec().loads(r.content)
         else:
             print("add_user_permission: Something went wrong: <{0}>: {1}".format(
                         r.status_code, r.reason))
@@ -448,7 +455,7 @@ class Endpoints(Domain):
                             auth=self.auth())
     
         if HTTP_STATUS.OK == r.status_code:
-            return r.json()
+            return self.codec().loads(r.content)
         else:
             print("create_token: Something went wrong: <{0}>: {1}".format(
                         r.status_code, r.reason))
@@ -15,6 +15,7 @@ import logging
 import sys
 from pyonep import onephttp
 from .exceptions import ProvisionException
+from .retry import IDEMPOTENT_METHODS
 
 if sys.version_info < (3, 0):
     urlencode = urllib.urlencode
@@ -78,6 +79,21 @@ class Provision(object):
             Defaults to False.
         manage_by_sharecode: When provisioning default device setups via template, whether or not
             the template is referenced by shared code or by resource ID.  Defaults to False.
+        pool: A onephttp.ConnectionPool to take keep-alive connections from, or True to use the
+            pool shared by every client of this host.  Defaults to None (no pooling).
+        retry: A retry.RetryPolicy for failed requests.  Only GET requests are retried once they
+            have reached the server.  Defaults to None (no retries).
+        breaker: A circuit.CircuitBreaker that fails requests fast while the host is failing, or True
+            to use the breaker shared by every client of this host.  Defaults to None.
+        limiter: A circuit.ConcurrencyLimiter that sheds requests over its limit.  Defaults to None.
+        observers: A list of callables, such as a metrics.Metrics, passed the timings and sizes of
+            each HTTP request.  Defaults to None.
+        logbody: Number of characters of each request body logged at the debug level.  Defaults to
+            None (whole bodies).
+        logsample: Fraction of request bodies logged at the debug level.  Defaults to 1.0.
+        compress: Size in characters from which request bodies are sent gzip compressed.  A body
+            the server refuses compressed is sent again uncompressed.  Defaults to None (never).
+        compresslevel: gzip compression level, 1 to 9.  Defaults to 6.
     """
 
     def __init__(self,
@@ -90,7 +106,16 @@ class Provision(object):
                  reuseconnection=False,
                  raise_api_exceptions=False,
                  curldebug=False,
-                 manage_by_sharecode=False):
+                 manage_by_sharecode=False,
+                 pool=None,
+                 retry=None,
+                 breaker=None,
+                 limiter=None,
+                 observers=None,
+                 logbody=None,
+                 logsample=1.0,
+                 compress=None,
+                 compresslevel=6):
         # backward compatibility
         protocol = 'https://'
         if host.startswith(protocol):
@@ -103,7 +128,16 @@ class Provision(object):
                                                httptimeout=int(httptimeout),
                                                reuseconnection=reuseconnection,
                                                log=log,
-                                               curldebug=curldebug)
+                                               curldebug=curldebug,
+                                               pool=pool,
+                                               retry=retry,
+                                               breaker=breaker,
+                                               limiter=limiter,
+                                               observers=observers,
+                                               logbody=logbody,
+                                               logsample=logsample,
+                                               compress=compress,
+                                               compresslevel=compresslevel)
         self._raise_api_exceptions = raise_api_exceptions
 
     def _filter_options(self, aliases=True, comments=True, historical=True):
@@ -154,7 +188,8 @@ class Provision(object):
         body, response = self._onephttp.request(method,
                                                 url,
                                                 body,
-                                                headers)
+                                                headers,
+                                                idempotent=method in IDEMPOTENT_METHODS)
 
         pr = ProvisionResponse(body, response)
         if self._raise_api_exceptions and not pr.isok:
@@ -167,7 +202,7 @@ class Provision(object):
         This should only need to be called if `reuseconnection` is set to True. Once closed,
         the connection may be reopened by making another API call.
         """
-        self.onephttp.close()
+        self._onephttp.close()
 
     def content_create(self, key, model, contentid, meta, protected=False):
         """Creates a content entity bucket with the given `contentid`.
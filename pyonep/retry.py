@@ -0,0 +1,147 @@
+# ==============================================================================
+# retry.py
+# Retrying of failed One Platform HTTP requests
+# ==============================================================================
+#
+# Copyright (c) 2016, Exosite LLC
+# All rights reserved.
+#
+import random
+import threading
+
+from requests.exceptions import ConnectionError, ConnectTimeout, Timeout
+from requests.packages.urllib3.exceptions import MaxRetryError, NewConnectionError
+
+# RPC procedures that may be sent again without changing their effect
+IDEMPOTENT_PROCEDURES = frozenset(['read', 'info', 'listing', 'lookup', 'usage'])
+
+# HTTP methods that may be sent again without changing their effect
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+# HTTP statuses of responses worth retrying
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+
+
+def idempotent(procedures):
+    """Returns True if an RPC request made of calls to procedures may be
+    sent again."""
+    return all(procedure in IDEMPOTENT_PROCEDURES for procedure in procedures)
+
+
+def unsent(exception):
+    """Returns True if a request that raised exception never reached the
+    server, because connecting timed out or was refused."""
+    if isinstance(exception, ConnectTimeout):
+        return True
+    if isinstance(exception, ConnectionError) and exception.args:
+        reason = exception.args[0]
+        if isinstance(reason, MaxRetryError):
+            reason = reason.reason
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+class RetryPolicy(object):
+    """Decides whether a failed request is retried, and after how long.
+
+    A request that failed to connect, because connecting timed out or was
+    refused, is always retried, since it never reached the platform (see
+    unsent()). A request that failed in any other way, timed
+    out, or got a response with one of statuses, is only retried if it is
+    idempotent (see IDEMPOTENT_PROCEDURES and IDEMPOTENT_METHODS).
+
+    Args:
+        retries: Most retries of one request.
+        backoff: Seconds before the first retry. The delay doubles with
+            each retry, up to max_backoff.
+        jitter: If True, each delay is drawn at random between 0 and the
+            backoff, so that clients that failed together don't retry
+            together.
+        budget: Retries allowed per request, on average. Each request adds
+            budget to a balance of at most max_budget retries, and each
+            retry takes one, so retries can't multiply the load on a
+            platform that keeps failing.
+        statuses: HTTP statuses that are retried.
+
+    Counters:
+        requests: requests made.
+        retries: retries made.
+        recovered: requests that succeeded after being retried.
+        exhausted: requests given up on after retries retries.
+        throttled: retries not made because the budget was spent.
+
+    A RetryPolicy may be shared by any number of clients.
+    """
+
+    def __init__(self,
+                 retries=3,
+                 backoff=0.1,
+                 max_backoff=5.0,
+                 jitter=True,
+                 budget=0.1,
+                 max_budget=10,
+                 statuses=RETRY_STATUSES):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.budget = budget
+        self.max_budget = max_budget
+        self.statuses = statuses
+        self._balance = max_budget
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries_made = 0
+        self.recovered = 0
+        self.exhausted = 0
+        self.throttled = 0
+
+    def started(self):
+        """Counts a new request, adding to the retry budget."""
+        with self._lock:
+            self.requests += 1
+            self._balance = min(self.max_budget, self._balance + self.budget)
+
+    def retryable(self, idempotent, exception=None, status=None):
+        """Returns True if a request that raised exception, or got a
+        response with status, may be retried."""
+        if exception is not None:
+            if unsent(exception):
+                return True
+            return idempotent and isinstance(exception, (ConnectionError, Timeout))
+        return idempotent and status in self.statuses
+
+    def delay(self, attempt, idempotent, exception=None, status=None):
+        """Returns the seconds to wait before retrying a request whose
+        attempt (0 for the first) failed, or None if it must not be
+        retried."""
+        if not self.retryable(idempotent, exception, status):
+            return None
+        with self._lock:
+            if attempt >= self.retries:
+                self.exhausted += 1
+                return None
+            if self._balance < 1:
+                self.throttled += 1
+                return None
+            self._balance -= 1
+            self.retries_made += 1
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def succeeded(self, attempt):
+        """Counts a request that succeeded on attempt."""
+        if attempt:
+            with self._lock:
+                self.recovered += 1
+
+    def stats(self):
+        """Returns a dict of the retry counters and the retry budget left."""
+        return {'requests': self.requests,
+                'retries': self.retries_made,
+                'recovered': self.recovered,
+                'exhausted': self.exhausted,
+                'throttled': self.throttled,
+                'budget': self._balance}
@@ -0,0 +1,129 @@
+# ==============================================================================
+# scheduler.py
+# Adaptive scheduling of Datastore write buffer flushes
+# ==============================================================================
+#
+# Copyright (c) 2016, Exosite LLC
+# All rights reserved.
+#
+import threading
+import time
+
+
+class FlushScheduler(object):
+    """Decides when a write buffer is flushed and how many calls go in
+    each request.
+
+    The buffer is flushed every `interval` seconds while points keep
+    coming. When a flush finds nothing to send, the interval doubles, up
+    to max_interval, so an idle buffer costs few wake-ups; the next point
+    added brings it back to the base interval. When a flush fails the
+    interval doubles too, to back off from a struggling platform. A flush
+    happens right away when the buffer depth reaches high_water, and is
+    never scheduled more often than the observed request latency.
+
+    The number of calls per request starts at max_calls. It is halved
+    when a request fails or takes longer than target_latency, and grows
+    back by a tenth of max_calls after each fast request.
+
+    Latency and error rate are tracked as exponentially weighted moving
+    averages, with weight alpha for the newest observation. While the
+    error rate is at or above max_errorrate the platform is taken to be
+    struggling: the interval keeps doubling even after a successful
+    flush, and the number of calls per request doesn't grow.
+    """
+
+    def __init__(self,
+                 interval=1.0,
+                 min_interval=0.1,
+                 max_interval=30.0,
+                 high_water=None,
+                 max_calls=100,
+                 target_latency=1.0,
+                 alpha=0.3,
+                 max_errorrate=0.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.base = min(max(interval, min_interval), max_interval)
+        self.interval = self.base
+        self.high_water = high_water
+        self.max_calls = max_calls
+        self.calls = max_calls
+        self.target_latency = target_latency
+        self.alpha = alpha
+        self.max_errorrate = max_errorrate
+        self.latency = None
+        self.errorrate = 0.0
+        self._idle = False
+        self._due = False
+        self._last = time.time()
+        self._cond = threading.Condition()
+
+    def added(self, depth):
+        """Tells the scheduler that points were added and the buffer now
+        holds depth points. Cheap unless it needs to wake the flusher."""
+        if self.high_water is not None and depth >= self.high_water:
+            with self._cond:
+                self._due = True
+                self._cond.notify_all()
+        elif self._idle:
+            with self._cond:
+                self._idle = False
+                self.interval = self.base
+                self._cond.notify_all()
+
+    def wake(self):
+        """Makes wait() return now."""
+        with self._cond:
+            self._due = True
+            self._cond.notify_all()
+
+    def wait(self):
+        """Blocks until the next flush is due."""
+        with self._cond:
+            while not self._due:
+                remaining = self._last + self.interval - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            self._due = False
+            self._last = time.time()
+
+    def _average(self, average, value):
+        if average is None:
+            return value
+        return (1 - self.alpha) * average + self.alpha * value
+
+    def observe_request(self, latency, ok):
+        """Records the latency in seconds of a flush request, and whether
+        it succeeded."""
+        with self._cond:
+            self.latency = self._average(self.latency, latency)
+            self.errorrate = self._average(self.errorrate, 0.0 if ok else 1.0)
+            if not ok or latency > self.target_latency:
+                self.calls = max(1, self.calls // 2)
+            elif self.errorrate < self.max_errorrate:
+                self.calls = min(self.max_calls,
+                                 self.calls + max(1, self.max_calls // 10))
+
+    def observe_flush(self, points, failed):
+        """Records the outcome of a flush of points, failed of which could
+        not be sent, and picks the interval to the next one."""
+        with self._cond:
+            if failed or (points and self.errorrate >= self.max_errorrate):
+                self._idle = False
+                self.interval = min(self.interval * 2, self.max_interval)
+            elif not points:
+                self._idle = True
+                self.interval = min(self.interval * 2, self.max_interval)
+            else:
+                self._idle = False
+                self.interval = min(max(self.base, self.latency or 0), self.max_interval)
+
+    def stats(self):
+        """Returns a dict of the current interval, calls per request, and
+        the latency and error rate averages."""
+        return {'interval': self.interval,
+                'calls': self.calls,
+                'latency': self.latency,
+                'errorrate': self.errorrate}
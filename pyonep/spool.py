@@ -0,0 +1,172 @@
+# ==============================================================================
+# spool.py
+# Append-only disk spool for points a Datastore could not send yet
+# ==============================================================================
+#
+# Copyright (c) 2016, Exosite LLC
+# All rights reserved.
+#
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .codec import get_codec
+
+log = logging.getLogger(__name__)
+
+# log errors stderr, don't log anything else
+h = logging.StreamHandler()
+h.setLevel(logging.ERROR)
+log.addHandler(h)
+
+SUFFIX = '.seg'
+
+
+class _Segment(object):
+    """A segment file being appended to through a memory map."""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.file = open(path, 'w+b')
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.offset = 0
+
+    def room(self):
+        return len(self.map) - self.offset
+
+    def write(self, data):
+        self.map[self.offset:self.offset + len(data)] = data
+        self.offset += len(data)
+
+    def sync(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        # drop the unused preallocated space
+        self.file.truncate(self.offset)
+        self.file.close()
+
+
+class Spool(object):
+    """An append-only log of points, kept in segment files in directory.
+
+    Each append() writes one length-prefixed JSON record to the active
+    segment, which is memory mapped and preallocated to segment_size
+    bytes. Writes are synced to disk at most every fsync_interval seconds
+    (0 syncs every append, None leaves it to the OS), and by sync().
+
+    Segments are read back oldest first with pending() and read(), and
+    deleted with ack() once their points have been sent, so the spool only
+    takes disk space for points not yet acknowledged by the platform.
+    Segments left by an earlier process are picked up when a Spool is
+    opened on the same directory.
+    """
+    HEADER = struct.Struct('>I')
+
+    def __init__(self, directory, segment_size=4 * 1024 * 1024, fsync_interval=1.0, codec=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self._codec = get_codec(codec)
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._segments = sorted(int(name[:-len(SUFFIX)])
+                                for name in os.listdir(directory)
+                                if name.endswith(SUFFIX) and name[:-len(SUFFIX)].isdigit())
+        self._nextid = self._segments[-1] + 1 if self._segments else 0
+        self._active = None
+        self._lastsync = time.time()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, '%016d%s' % (segment, SUFFIX))
+
+    def _rotate(self, size):
+        self._close_active()
+        segment = self._nextid
+        self._nextid += 1
+        self._active = _Segment(self._path(segment), size)
+        self._segments.append(segment)
+
+    def _close_active(self):
+        if self._active is not None:
+            self._active.close()
+            self._active = None
+
+    def append(self, items):
+        """Appends a list of points to the spool."""
+        data = self._codec.dumps([item[:4] for item in items])
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        record = self.HEADER.pack(len(data)) + data
+        with self._lock:
+            if self._active is None or self._active.room() < len(record):
+                self._rotate(max(self.segment_size, len(record)))
+            self._active.write(record)
+            if self.fsync_interval is not None and \
+                    time.time() - self._lastsync >= self.fsync_interval:
+                self._sync()
+
+    def _sync(self):
+        if self._active is not None:
+            self._active.sync()
+        self._lastsync = time.time()
+
+    def sync(self):
+        """Syncs the points appended so far to disk."""
+        with self._lock:
+            self._sync()
+
+    def pending(self):
+        """Returns the ids of the segments holding unacknowledged points,
+        oldest first. The active segment is closed first, so that it can
+        be read, unless older segments are pending."""
+        with self._lock:
+            if self._active is not None and self._segments[0] == self._nextid - 1:
+                self._close_active()
+            if self._active is None:
+                return list(self._segments)
+            return self._segments[:-1]
+
+    def read(self, segment):
+        """Returns the points in a segment returned by pending(). A record
+        torn by a crash ends the segment."""
+        items = []
+        with open(self._path(segment), 'rb') as f:
+            data = f.read()
+        offset = 0
+        size = self.HEADER.size
+        while offset + size <= len(data):
+            length, = self.HEADER.unpack_from(data, offset)
+            offset += size
+            if length == 0 or offset + length > len(data):
+                break
+            try:
+                items.extend(self._codec.loads(data[offset:offset + length]))
+            except ValueError:
+                log.warning("Skipping corrupt record in spool segment %s", segment)
+                break
+            offset += length
+        return items
+
+    def ack(self, segment):
+        """Deletes a segment whose points were sent."""
+        with self._lock:
+            if self._active is not None and segment == self._nextid - 1:
+                self._close_active()
+            self._segments.remove(segment)
+            os.remove(self._path(segment))
+
+    def __len__(self):
+        return len(self._segments)
+
+    def close(self):
+        """Closes the active segment, syncing it to disk."""
+        with self._lock:
+            self._close_active()
@@ -0,0 +1,226 @@
+# ==============================================================================
+# writebuffer.py
+# Buffer of the dataport writes a Datastore has yet to send to the platform
+# ==============================================================================
+#
+# Copyright (c) 2016, Exosite LLC
+# All rights reserved.
+#
+import itertools
+import threading
+import time
+
+# kinds of buffered points
+LIVE = 'live'        # written with write(), sent with writegroup
+RECORD = 'record'    # recorded with a timestamp, or a negative offset
+                     # from the time it is sent
+OFFSET = 'offset'    # timestamp is local time, sent as an offset from the
+                     # time it is sent
+
+
+class POLICIES:
+    """What a full WriteBuffer does with new points."""
+    # wait up to timeout seconds for room, then drop the new points
+    BLOCK = 'block'
+    # drop the oldest buffered points to make room
+    DROP_OLDEST = 'drop_oldest'
+    # drop the new points
+    DROP_NEWEST = 'drop_newest'
+    # like DROP_NEWEST, but a live value replaces the buffered live value of
+    # the same alias even when the buffer is not full, so at most the latest
+    # value of each alias is written per flush
+    COALESCE = 'coalesce'
+
+
+class _Shard(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = []
+        # pending live item of each alias, so that writes coalesce
+        self.live = {}
+
+
+class WriteBuffer(object):
+    """Buffers points to be written to a device's dataports.
+
+    Points are [alias, timestamp, value, kind, seq] lists. Aliases are
+    spread over shards that each have their own lock, so producers writing
+    to different aliases rarely contend. swap() takes every buffered point
+    out at once, which lets the flusher send them without holding any lock
+    producers need.
+
+    The buffer holds at most maxsize points, counting the points taken by
+    swap() until they are released, and policy (see POLICIES) decides what
+    happens to points that don't fit.
+
+    Counters:
+        dropped: points dropped because the buffer was full.
+        coalesced: live values replaced by a later value of the same alias.
+    """
+
+    def __init__(self, maxsize=1024, policy=POLICIES.COALESCE, timeout=None, shards=16):
+        if policy not in (POLICIES.BLOCK, POLICIES.DROP_OLDEST,
+                          POLICIES.DROP_NEWEST, POLICIES.COALESCE):
+            raise ValueError("Unknown write buffer policy '%s'" % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.timeout = timeout
+        self._shards = [_Shard() for _ in range(shards)]
+        self._depth = 0
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self.dropped = 0
+        self.coalesced = 0
+
+    def _shard(self, alias):
+        return self._shards[hash(alias) % len(self._shards)]
+
+    def _reserve(self, n):
+        """Makes room for n points. Returns False if they must be dropped."""
+        with self._cond:
+            if self.maxsize is None or self._depth + n <= self.maxsize:
+                self._depth += n
+                return True
+            if self.policy == POLICIES.BLOCK and n <= self.maxsize:
+                deadline = None if self.timeout is None else time.time() + self.timeout
+                while self._depth + n > self.maxsize:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                else:
+                    self._depth += n
+                    return True
+            elif self.policy == POLICIES.DROP_OLDEST:
+                excess = self._depth + n - self.maxsize
+                self._depth += n
+            if self.policy != POLICIES.DROP_OLDEST:
+                self.dropped += n
+                return False
+        evicted = self._evict(excess)
+        with self._cond:
+            if evicted < excess:
+                # points being sent can't be evicted, drop the new ones
+                self._depth -= n
+                self.dropped += n
+            self._depth -= evicted
+            self.dropped += evicted
+            self._cond.notify_all()
+        return evicted >= excess
+
+    def _evict(self, n):
+        """Drops up to n of the oldest buffered points, returns how many."""
+        evicted = 0
+        while evicted < n:
+            oldest = None
+            for shard in self._shards:
+                items = shard.items
+                if items and (oldest is None or items[0][4] < oldest.items[0][4]):
+                    oldest = shard
+            if oldest is None:
+                break
+            with oldest.lock:
+                if oldest.items:
+                    item = oldest.items.pop(0)
+                    if oldest.live.get(item[0]) is item:
+                        del oldest.live[item[0]]
+                    evicted += 1
+        return evicted
+
+    def write(self, alias, value, timestamp):
+        """Buffers a live value of alias. Returns True if it was buffered as
+        a new point, False if it was dropped or coalesced."""
+        shard = self._shard(alias)
+        if self.policy == POLICIES.COALESCE:
+            with shard.lock:
+                item = shard.live.get(alias)
+                if item is not None:
+                    item[1] = timestamp
+                    item[2] = value
+                    self.coalesced += 1
+                    return False
+        if not self._reserve(1):
+            return False
+        item = [alias, timestamp, value, LIVE, next(self._seq)]
+        with shard.lock:
+            if self.policy == POLICIES.COALESCE:
+                shard.live[alias] = item
+            shard.items.append(item)
+        return True
+
+    def record(self, alias, entries, kind=RECORD):
+        """Buffers entries, a list of [timestamp, value], of alias. Returns
+        False if they were dropped."""
+        if self.maxsize is not None and len(entries) > self.maxsize:
+            if self.policy != POLICIES.DROP_OLDEST:
+                with self._cond:
+                    self.dropped += len(entries)
+                return False
+            with self._cond:
+                self.dropped += len(entries) - self.maxsize
+            entries = entries[-self.maxsize:]
+        if not self._reserve(len(entries)):
+            return False
+        items = [[alias, t, value, kind, next(self._seq)] for t, value in entries]
+        shard = self._shard(alias)
+        with shard.lock:
+            shard.items.extend(items)
+        return True
+
+    def restore(self, items):
+        """Puts back points taken with swap() that could not be sent,
+        ahead of the points buffered since. They keep their room in the
+        buffer."""
+        byshard = {}
+        for item in items:
+            byshard.setdefault(id(self._shard(item[0])), []).append(item)
+        for shard in self._shards:
+            shard_items = byshard.get(id(shard))
+            if shard_items:
+                with shard.lock:
+                    shard.items[:0] = shard_items
+
+    def release(self, n):
+        """Frees the room of n points taken with swap() that were sent or
+        given up on."""
+        if n:
+            with self._cond:
+                self._depth -= n
+                self._cond.notify_all()
+
+    def swap(self):
+        """Takes out and returns every buffered point. The points keep
+        their room in the buffer until they are released or restored."""
+        items = []
+        for shard in self._shards:
+            with shard.lock:
+                shard_items = shard.items
+                shard.items = []
+                shard.live = {}
+            items.extend(shard_items)
+        return items
+
+    def clear_live(self):
+        """Drops the buffered live values."""
+        cleared = 0
+        for shard in self._shards:
+            with shard.lock:
+                items = [item for item in shard.items if item[3] != LIVE]
+                cleared += len(shard.items) - len(items)
+                shard.items = items
+                shard.live = {}
+        self.release(cleared)
+
+    def depth(self):
+        """Returns the number of points buffered or being sent."""
+        return self._depth
+
+    def __len__(self):
+        return sum(len(shard.items) for shard in self._shards)
+
+    def stats(self):
+        """Returns a dict of the buffer depth and counters."""
+        return {'depth': self._depth,
+                'maxsize': self.maxsize,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced}
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Local HTTP servers for tests that don't need the One Platform"""
+from __future__ import unicode_literals
+import json
+import threading
+from unittest import TestCase
+
+from pyonep import onephttp
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    """Responds with the request body, or with what the server's handle()
+    returns: a body, or a (body, status) tuple"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        result = self.server.handle(self, self.rfile.read(length))
+        if isinstance(result, tuple):
+            self.respond(*result)
+        else:
+            self.respond(result)
+
+    def respond(self, body, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler=EchoHandler):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.requests = []
+
+    def handle(self, request, body):
+        self.requests.append(body)
+        return body
+
+
+class RPCServer(LocalServer):
+    """Answers every JSON RPC call with status ok and the result
+    [procedure, arguments], unless a result function is registered for
+    the procedure with on()."""
+
+    def __init__(self):
+        LocalServer.__init__(self)
+        self.results = {}
+
+    def on(self, procedure, fn):
+        """fn(arguments) returns a response dict without the id."""
+        self.results[procedure] = fn
+
+    def handle(self, request, body):
+        self.requests.append(body)
+        req = json.loads(body.decode('utf-8'))
+        res = []
+        for call in req['calls']:
+            fn = self.results.get(call['procedure'])
+            if fn is None:
+                r = {'status': 'ok',
+                     'result': [call['procedure'], call['arguments']]}
+            else:
+                r = fn(call['arguments'])
+            r['id'] = call['id']
+            res.append(r)
+        return json.dumps(res).encode('utf-8')
+
+
+class LocalServerTestCase(TestCase):
+    """Base class for tests that need a local HTTP server"""
+    __test__ = False
+    server_class = LocalServer
+
+    def setUp(self):
+        self.server = self.server_class()
+        self.host = '127.0.0.1'
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        # pools shared through pool=True would outlive the server
+        onephttp.close_pools()
+
+
+def dataport_read(points):
+    """Returns a read handler for RPCServer.on() that serves points, a list
+    of [timestamp, value] in ascending order, honoring the starttime,
+    endtime, limit and sort read options."""
+    def read(args):
+        options = args[1]
+        selected = [p for p in points
+                    if options.get('starttime', 0) <= p[0] <= options.get('endtime', 2 ** 62)]
+        if options.get('sort', 'desc') == 'desc':
+            selected.reverse()
+        return {'status': 'ok', 'result': selected[:options.get('limit', 1)]}
+    return read
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""Test asyncio RPC client against a local JSON RPC server"""
+from __future__ import unicode_literals
+import asyncio
+import json
+
+from pyonep.asynconep import AsyncOnepV1, AsyncOneP_Request
+from test.localserver import LocalServerTestCase, RPCServer, dataport_read
+from test.test_onephttp import _RecordingLog
+
+
+class TestAsyncOnepV1(LocalServerTestCase):
+    """
+        Test AsyncOnepV1 methods
+    """
+    __test__ = True
+    server_class = RPCServer
+
+    def run_async(self, coro):
+        return asyncio.new_event_loop().run_until_complete(coro)
+
+    def connect(self, **kwargs):
+        return AsyncOnepV1(host=self.host, port=self.port, https=False, **kwargs)
+
+    def test_transport(self):
+        """The client is built with an asyncio transport only"""
+        conn = self.connect(maxsize=3, keepalive=5)
+        self.assertTrue(isinstance(conn.onephttp, AsyncOneP_Request))
+        self.assertEqual((conn.onephttp.maxsize, conn.onephttp.keepalive), (3, 5))
+
+    def test_logging(self):
+        """Requests are only logged at debug level, with bodies cut to
+        logbody characters"""
+        async def go(conn):
+            try:
+                return await conn.read('cik', {'alias': 'x'}, {'limit': 1})
+            finally:
+                await conn.close()
+        conn = self.connect()
+        conn.onephttp.log = log = _RecordingLog(enabled=False)
+        self.run_async(go(conn))
+        self.assertEqual(log.messages, [])
+        conn = self.connect(logbody=3)
+        conn.onephttp.log = log = _RecordingLog(enabled=True)
+        self.run_async(go(conn))
+        self.assertTrue(log.messages[-1].startswith('Body: {"a... ('))
+
+    def test_call(self):
+        """A single call returns (success, result)"""
+        async def go():
+            conn = self.connect()
+            try:
+                return await conn.read('cik', {'alias': 'x'}, {'limit': 1})
+            finally:
+                await conn.close()
+        ok, result = self.run_async(go())
+        self.assertTrue(ok)
+        self.assertEqual(result, ['read', [{'alias': 'x'}, {'limit': 1}]])
+
+    def test_deferred(self):
+        """Deferred calls are sent in a single request"""
+        async def go():
+            conn = self.connect()
+            try:
+                self.assertTrue(await conn.write('cik', 'rid', 1, defer=True))
+                self.assertTrue(await conn.info('cik', 'rid', defer=True))
+                return await conn.send_deferred('cik')
+            finally:
+                await conn.close()
+        results = self.run_async(go())
+        self.assertEqual([r[2][0] for r in results], ['write', 'info'])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_concurrent_calls(self):
+        """Concurrent calls share a bounded number of connections"""
+        async def go():
+            conn = self.connect(maxsize=2)
+            try:
+                return await asyncio.gather(
+                    *[conn.info('cik', 'rid{0}'.format(i)) for i in range(50)])
+            finally:
+                await conn.close()
+        results = self.run_async(go())
+        self.assertEqual(len(results), 50)
+        self.assertTrue(all(ok for ok, _ in results))
+        ids = [json.loads(b.decode('utf-8'))['calls'][0]['id']
+               for b in self.server.requests]
+        self.assertEqual(len(set(ids)), 50)
+
+    def test_send_all_deferred(self):
+        """Deferred calls for every auth are sent concurrently"""
+        async def go():
+            conn = self.connect()
+            try:
+                for i in range(10):
+                    await conn.info('cik{0}'.format(i), 'rid', defer=True)
+                return await conn.send_all_deferred(max_workers=3)
+            finally:
+                await conn.close()
+        results, errors = self.run_async(go())
+        self.assertEqual(errors, {})
+        self.assertEqual(len(results), 10)
+
+    def test_iter_read(self):
+        """Paginated reads return every point once"""
+        points = [[t // 2, t] for t in range(40)]
+        self.server.on('read', dataport_read(points))
+
+        async def go():
+            conn = self.connect()
+            try:
+                return [p async for p in conn.iter_read('cik', 'rid', 0, 100, page_size=3)]
+            finally:
+                await conn.close()
+        self.assertEqual(self.run_async(go()), points)
+
+    def test_resolve(self):
+        """Aliases are looked up once and cached, missing ones too"""
+        rids = {'temp': 'a' * 40, 'humidity': 'b' * 40}
+
+        def lookup(args):
+            if args[1] in rids:
+                return {'status': 'ok', 'result': rids[args[1]]}
+            return {'status': 'invalid'}
+        self.server.on('lookup', lookup)
+
+        async def go():
+            conn = self.connect()
+            try:
+                self.assertEqual(await conn.resolve('cik', 'temp'), 'a' * 40)
+                self.assertEqual(await conn.resolve('cik', 'nope'), None)
+                return await conn.resolve_many('cik', ['temp', 'humidity', 'nope'])
+            finally:
+                await conn.close()
+        self.assertEqual(self.run_async(go()),
+                         {'temp': 'a' * 40, 'humidity': 'b' * 40, 'nope': None})
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_prefetch(self):
+        """prefetch_aliases caches every alias with one call"""
+        self.server.on('info', lambda args: {
+            'status': 'ok',
+            'result': {'aliases': {'a' * 40: ['temp'], 'b' * 40: ['humidity', 'h']}}})
+
+        async def go():
+            conn = self.connect()
+            try:
+                rids = await conn.prefetch_aliases('cik')
+                return rids, await conn.resolve_many('cik', ['temp', 'h'])
+            finally:
+                await conn.close()
+        rids, resolved = self.run_async(go())
+        self.assertEqual(rids, {'temp': 'a' * 40, 'humidity': 'b' * 40, 'h': 'b' * 40})
+        self.assertEqual(resolved, {'temp': 'a' * 40, 'h': 'b' * 40})
+        self.assertEqual(len(self.server.requests), 1)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Test caches"""
+from __future__ import unicode_literals
+import threading
+import time
+from unittest import TestCase
+
+from pyonep.cache import AliasCache, LRUCache, ReadCache
+
+
+class TestLRUCache(TestCase):
+    """
+        Test LRU eviction and expiry
+    """
+
+    def test_eviction(self):
+        """The least recently used entry is evicted"""
+        cache = LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_expiry(self):
+        """Expired entries are misses and counted as stale"""
+        cache = LRUCache(ttl=0.01)
+        cache.put('a', 1)
+        cache.put('b', 2, ttl=60)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 2)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stale']), (1, 1, 1))
+
+
+class TestAliasCache(TestCase):
+    """
+        Test alias cache entries
+    """
+
+    def test_negative(self):
+        """Missing aliases are cached for negative_ttl"""
+        cache = AliasCache(ttl=60, negative_ttl=0.01)
+        cache.put('cik', 'temp', 'a' * 40)
+        cache.put_missing('cik', 'nope')
+        self.assertEqual(cache.get('cik', 'temp'), 'a' * 40)
+        self.assertEqual(cache.get({'cik': 'cik'}, 'temp'), None)
+        self.assertTrue(cache.get('cik', 'nope') is AliasCache.MISSING)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('cik', 'nope'), None)
+
+
+class TestReadCache(TestCase):
+    """
+        Test read caching and coalescing
+    """
+
+    def fetcher(self, points, delay=0):
+        calls = []
+
+        def fetch(alias, count):
+            calls.append((alias, count))
+            time.sleep(delay)
+            return points[:count]
+        return fetch, calls
+
+    def test_window(self):
+        """A cached read serves reads of fewer points"""
+        cache = ReadCache()
+        fetch, calls = self.fetcher([[3, 'c'], [2, 'b'], [1, 'a']])
+        self.assertEqual(cache.read('temp', 2, fetch), [[3, 'c'], [2, 'b']])
+        self.assertEqual(cache.read('temp', 1, fetch), [[3, 'c']])
+        self.assertEqual(cache.read('temp', 3, fetch), [[3, 'c'], [2, 'b'], [1, 'a']])
+        # the dataport has only 3 points
+        self.assertEqual(len(cache.read('temp', 10, fetch)), 3)
+        self.assertEqual(len(cache.read('temp', 5, fetch)), 3)
+        self.assertEqual(calls, [('temp', 2), ('temp', 3), ('temp', 10)])
+
+    def test_ttls(self):
+        """Aliases can have their own TTL"""
+        cache = ReadCache(ttl=10, ttls={'fast': 0.01})
+        fetch, calls = self.fetcher([[1, 'a']])
+        cache.read('fast', 1, fetch)
+        cache.read('slow', 1, fetch)
+        time.sleep(0.02)
+        cache.read('fast', 1, fetch)
+        cache.read('slow', 1, fetch)
+        self.assertEqual(calls, [('fast', 1), ('slow', 1), ('fast', 1)])
+
+    def test_coalesce(self):
+        """Concurrent misses of an alias share one read"""
+        cache = ReadCache()
+        fetch, calls = self.fetcher([[1, 'a']], delay=0.1)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.read('temp', 1, fetch)))
+                   for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [[[1, 'a']]] * 10)
+        self.assertEqual(calls, [('temp', 1)])
+        self.assertEqual(cache.stats()['coalesced'], 9)
+
+    def test_error(self):
+        """Errors reach every waiting reader and aren't cached"""
+        cache = ReadCache()
+
+        def fetch(alias, count):
+            raise ValueError('down')
+        self.assertRaises(ValueError, cache.read, 'temp', 1, fetch)
+        self.assertEqual(cache.get('temp', 1), None)
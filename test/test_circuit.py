@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Test circuit breaking and load shedding"""
+from __future__ import unicode_literals
+import threading
+import time
+from unittest import TestCase
+
+from pyonep import onep
+from pyonep.circuit import CircuitBreaker, ConcurrencyLimiter, CLOSED, OPEN, HALF_OPEN
+from pyonep.exceptions import CircuitOpenException, LoadShedException, OnePlatformException
+from test.localserver import LocalServerTestCase, RPCServer
+
+
+class TestCircuitBreaker(TestCase):
+    """
+        Test circuit state changes
+    """
+
+    def outcomes(self, breaker, n, latency=0.0, ok=False):
+        for _ in range(n):
+            breaker.record(latency, ok, breaker.allow())
+
+    def test_opens_on_errors(self):
+        """The circuit opens once enough requests failed, and fails fast"""
+        breaker = CircuitBreaker(window=10, min_requests=4, error_rate=0.5)
+        self.outcomes(breaker, 1, ok=True)
+        self.outcomes(breaker, 2)
+        self.assertEqual(breaker.state, CLOSED)
+        self.outcomes(breaker, 1)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertRaises(CircuitOpenException, breaker.allow)
+        self.assertEqual(breaker.stats()['rejected'], 1)
+
+    def test_opens_on_latency(self):
+        """The circuit opens once enough requests were slow"""
+        breaker = CircuitBreaker(min_requests=2, slow_latency=1.0, slow_rate=0.5)
+        self.outcomes(breaker, 1, latency=0.1, ok=True)
+        self.outcomes(breaker, 1, latency=2.0, ok=True)
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_half_open(self):
+        """After reset_timeout probes are let through, and close the
+        circuit if they succeed"""
+        breaker = CircuitBreaker(min_requests=1, reset_timeout=0.05, probes=1)
+        self.outcomes(breaker, 1)
+        time.sleep(0.06)
+        probe = breaker.allow()
+        self.assertTrue(probe)
+        self.assertEqual(breaker.state, HALF_OPEN)
+        # only one probe at a time
+        self.assertRaises(CircuitOpenException, breaker.allow)
+        breaker.record(0.0, False, probe)
+        self.assertEqual(breaker.state, OPEN)
+        time.sleep(0.06)
+        breaker.record(0.0, True, breaker.allow())
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertFalse(breaker.allow())
+
+
+class TestConcurrencyLimiter(TestCase):
+    """
+        Test shedding excess requests
+    """
+
+    def test_shed(self):
+        """Requests over the limit are shed"""
+        limiter = ConcurrencyLimiter(2)
+        limiter.acquire()
+        limiter.acquire()
+        self.assertRaises(LoadShedException, limiter.acquire)
+        limiter.release()
+        limiter.acquire()
+        self.assertEqual(limiter.stats(), {'limit': 2, 'inflight': 2, 'shed': 1})
+
+    def test_wait(self):
+        """Requests wait up to timeout for a slot"""
+        limiter = ConcurrencyLimiter(1, timeout=1)
+        limiter.acquire()
+        threading.Timer(0.05, limiter.release).start()
+        limiter.acquire()
+        self.assertEqual(limiter.stats()['shed'], 0)
+
+
+class FailingRPCServer(RPCServer):
+    """Answers every request with 503"""
+
+    def handle(self, request, body):
+        self.requests.append(body)
+        return b'unavailable', 503
+
+
+class TestCircuit(LocalServerTestCase):
+    """
+        Test failing fast against a failing platform
+    """
+    __test__ = True
+    server_class = FailingRPCServer
+
+    def test_fail_fast(self):
+        """Once the circuit opens requests no longer reach the server"""
+        breaker = CircuitBreaker(min_requests=3, reset_timeout=60)
+        conn = onep.OnepV1(host=self.host, port=self.port, https=False, breaker=breaker)
+        for _ in range(3):
+            self.assertRaises(OnePlatformException, conn.read, 'cik', 'rid', {})
+        self.assertRaises(CircuitOpenException, conn.read, 'cik', 'rid', {})
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_limiter_released(self):
+        """Failed requests give back their slot"""
+        limiter = ConcurrencyLimiter(1)
+        conn = onep.OnepV1(host=self.host, port=self.port, https=False, limiter=limiter)
+        for _ in range(2):
+            self.assertRaises(OnePlatformException, conn.read, 'cik', 'rid', {})
+        self.assertEqual(limiter.stats()['inflight'], 0)
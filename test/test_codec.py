@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Test JSON codecs"""
+from __future__ import unicode_literals
+from unittest import TestCase
+
+from pyonep import codec
+
+
+class TestCodec(TestCase):
+    """
+        Test codec selection and round trips
+    """
+
+    def available(self):
+        codecs = []
+        for cls in codec.CODECS:
+            try:
+                codecs.append(cls())
+            except ImportError:
+                pass
+        return codecs
+
+    def test_default(self):
+        """The default codec is the first one installed"""
+        self.assertTrue(codec.get_codec() is codec.get_codec())
+        self.assertEqual(codec.get_codec().name, self.available()[0].name)
+
+    def test_by_name(self):
+        """Codecs can be selected by name"""
+        self.assertEqual(codec.get_codec('json').name, 'json')
+        self.assertRaises(ValueError, codec.get_codec, 'nosuchcodec')
+        c = codec.JsonCodec()
+        self.assertTrue(codec.get_codec(c) is c)
+
+    def test_round_trip(self):
+        """Every installed codec decodes bytes and text"""
+        obj = {'auth': {'cik': 'x' * 40},
+               'calls': [{'id': 1, 'procedure': 'write',
+                          'arguments': [{'alias': '温度'}, 21.5, {}]}]}
+        for c in self.available():
+            encoded = c.dumps(obj)
+            if not isinstance(encoded, bytes):
+                encoded = encoded.encode('utf-8')
+            self.assertEqual(c.loads(encoded), obj, c.name)
+            self.assertEqual(c.loads(encoded.decode('utf-8')), obj, c.name)
@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+"""Test Datastore against a local JSON RPC server"""
+from __future__ import unicode_literals
+import json
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from pyonep.datastore import Datastore, DatastoreManager, datastore_config
+from test.localserver import LocalServerTestCase, RPCServer, dataport_read
+
+RIDS = dict(('alias{0}'.format(i), '{0:040x}'.format(i)) for i in range(20))
+
+
+class DatastoreTestCase(LocalServerTestCase):
+    """Base class for Datastore tests. The server knows the aliases in RIDS
+    and accepts writegroup and record calls."""
+    __test__ = False
+    server_class = RPCServer
+
+    def setUp(self):
+        LocalServerTestCase.setUp(self)
+
+        def lookup(args):
+            if args[1] in RIDS:
+                return {'status': 'ok', 'result': RIDS[args[1]]}
+            return {'status': 'invalid'}
+        self.server.on('lookup', lookup)
+        self.server.on('info', lambda args: {
+            'status': 'ok',
+            'result': {'aliases': dict((rid, [alias]) for alias, rid in RIDS.items())}})
+        self.server.on('writegroup', lambda args: {'status': 'ok'})
+        self.server.on('recordbatch', lambda args: {'status': 'ok'})
+
+    def datastore(self, **kwargs):
+        transport = {'host': self.host,
+                     'port': self.port,
+                     'url': '/onep:v1/rpc/process',
+                     'https': False,
+                     'timeout': 3}
+        return Datastore('cik', 1, transport=transport, **kwargs)
+
+    def flush(self, ds):
+        ds._flush()
+
+    def sent_calls(self, procedure):
+        calls = []
+        for body in self.server.requests:
+            calls.extend(c for c in json.loads(body.decode('utf-8'))['calls']
+                         if c['procedure'] == procedure)
+        return calls
+
+
+class TestWriteBuffer(DatastoreTestCase):
+    """
+        Test buffering and flushing writes
+    """
+    __test__ = True
+
+    def test_threads_write(self):
+        """Writes from many threads are flushed, latest value per alias"""
+        ds = self.datastore()
+
+        def worker(n):
+            for i in range(50):
+                ds.write('alias{0}'.format(n), i)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.flush(ds)
+
+        written = {}
+        for call in self.sent_calls('writegroup'):
+            written.update(dict(call['arguments'][0]))
+        self.assertEqual(written, dict((RIDS['alias{0}'.format(n)], 49) for n in range(10)))
+        self.assertEqual(len(ds._buffer), 0)
+
+    def test_failed_write_is_recorded(self):
+        """Live values that fail to be written are recorded by the next flush"""
+        ds = self.datastore()
+        self.server.on('writegroup', lambda args: {'status': 'fail'})
+        ds.write('alias1', 10)
+        self.flush(ds)
+        self.assertEqual(len(ds._buffer), 1)
+        self.flush(ds)
+        records = self.sent_calls('recordbatch')
+        self.assertEqual(len(records), 1)
+        rid, entries = records[0]['arguments']
+        self.assertEqual(rid, RIDS['alias1'])
+        self.assertEqual(entries[0][1], 10)
+        # sent as an offset from now
+        self.assertTrue(-5 < entries[0][0] < 0)
+        self.assertEqual(len(ds._buffer), 0)
+
+    def test_one_request_per_flush(self):
+        """A flush sends chunked writegroups and a recordbatch per alias
+        in one request"""
+        config = dict(datastore_config, writegroup_max_entries=3)
+        ds = self.datastore(config=config)
+        for i in range(7):
+            ds.write('alias{0}'.format(i), i)
+        ds.record('alias1', [[-10, 1], [1400000000, 2]])
+        ds.record('alias2', [[1400000000, 3]])
+        del self.server.requests[:]
+        self.flush(ds)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual([len(c['arguments'][0]) for c in self.sent_calls('writegroup')],
+                         [3, 3, 1])
+        batches = dict((c['arguments'][0], c['arguments'][1])
+                       for c in self.sent_calls('recordbatch'))
+        self.assertEqual(batches[RIDS['alias2']], [[1400000000, 3]])
+        self.assertEqual(batches[RIDS['alias1']][1], [1400000000, 2])
+        # the offset is passed on for the platform to resolve
+        self.assertEqual(batches[RIDS['alias1']][0], [-10, 1])
+
+    def test_retry_per_alias(self):
+        """Points of one alias the platform rejects don't hold up the others"""
+        ds = self.datastore()
+
+        def writegroup(args):
+            if any(rid == RIDS['alias1'] for rid, value in args[0]):
+                return {'status': 'fail'}
+            return {'status': 'ok'}
+        self.server.on('writegroup', writegroup)
+        self.server.on('recordbatch', lambda args: {
+            'status': 'fail' if args[0] == RIDS['alias1'] else 'ok'})
+        ds.write('alias1', 1)
+        ds.write('alias2', 2)
+        self.flush(ds)
+        self.assertEqual(len(ds._buffer), 2)
+        # each alias is retried on its own
+        self.flush(ds)
+        self.assertEqual(sorted(c['arguments'][0] for c in self.sent_calls('recordbatch')),
+                         [RIDS['alias1'], RIDS['alias2']])
+        self.assertEqual([item[0] for item in ds._buffer.swap()], ['alias1'])
+
+    def test_flush_does_not_block_writers(self):
+        """Producers can write while a flush waits on the platform"""
+        ds = self.datastore()
+
+        def slow_writegroup(args):
+            time.sleep(0.5)
+            return {'status': 'ok'}
+        self.server.on('writegroup', slow_writegroup)
+        ds.write('alias1', 1)
+        ds.write('alias2', 1)
+        flusher = threading.Thread(target=self.flush, args=(ds,))
+        flusher.start()
+        time.sleep(0.1)
+        start = time.time()
+        for i in range(100):
+            ds.write('alias3', i)
+        self.assertTrue(time.time() - start < 0.3)
+        flusher.join()
+        self.assertEqual(len(ds._buffer), 1)
+
+
+class TestSpool(DatastoreTestCase):
+    """
+        Test spilling points to disk during an outage
+    """
+    __test__ = True
+
+    def setUp(self):
+        DatastoreTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        DatastoreTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def test_replay_after_restart(self):
+        """Points spilled by one Datastore are sent by the next one"""
+        config = dict(datastore_config, spool_dir=self.directory)
+        ds = self.datastore(config=config)
+        self.server.on('writegroup', lambda args: {'status': 'fail'})
+        self.server.on('recordbatch', lambda args: {'status': 'fail'})
+        ds.write('alias1', 10)
+        ds.record('alias2', [[1400000000, 1], [1400000001, 2], [-5, 3]])
+        self.flush(ds)
+        # the record points were sent, with the offset as given, and failed
+        self.assertEqual([c['arguments'][1] for c in self.sent_calls('recordbatch')],
+                         [[[1400000000, 1], [1400000001, 2], [-5, 3]]])
+        self.assertEqual(ds.bufferStats()['depth'], 0)
+        self.assertEqual(len(ds._spool), 1)
+        ds._spool.close()
+
+        del self.server.requests[:]
+        self.server.on('recordbatch', lambda args: {'status': 'ok'})
+        ds = self.datastore(config=config)
+        self.flush(ds)
+        batches = dict((c['arguments'][0], c['arguments'][1])
+                       for c in self.sent_calls('recordbatch'))
+        self.assertEqual(batches[RIDS['alias2']][:2], [[1400000000, 1], [1400000001, 2]])
+        # local times are sent as offsets from now
+        t, v = batches[RIDS['alias2']][2]
+        self.assertTrue(-8 <= t <= -5 and v == 3)
+        t, v = batches[RIDS['alias1']][0]
+        self.assertTrue(-3 <= t <= -1 and v == 10)
+        self.assertEqual(len(ds._spool), 0)
+
+
+class TestFlusher(DatastoreTestCase):
+    """
+        Test the flusher thread
+    """
+    __test__ = True
+
+    def test_flush_interval(self):
+        """Writes are flushed after the interval, and stop() ends the thread"""
+        transport = {'host': self.host,
+                     'port': self.port,
+                     'url': '/onep:v1/rpc/process',
+                     'https': False,
+                     'timeout': 3}
+        ds = Datastore('cik', 0.1, transport=transport)
+        ds.start(daemon=True)
+        ds.write('alias1', 1)
+        deadline = time.time() + 2
+        while not self.sent_calls('writegroup') and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.sent_calls('writegroup')), 1)
+        ds.stop()
+        ds._thread.join(2)
+        self.assertFalse(ds.isThreadAlive())
+
+    def test_start_after_stop(self):
+        """A Datastore started again after stop() flushes new writes"""
+        transport = {'host': self.host,
+                     'port': self.port,
+                     'url': '/onep:v1/rpc/process',
+                     'https': False,
+                     'timeout': 3}
+        ds = Datastore('cik', 0.1, transport=transport)
+        ds.start(daemon=True)
+        ds.stop(force=True)
+        ds._thread.join(2)
+        ds.start(daemon=True)
+        ds.write('alias1', 2)
+        deadline = time.time() + 2
+        while not self.sent_calls('writegroup') and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.sent_calls('writegroup')), 1)
+        ds.restart()
+        ds.write('alias1', 3)
+        deadline = time.time() + 2
+        while len(self.sent_calls('writegroup')) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.sent_calls('writegroup')), 2)
+        ds.stop(force=True)
+        ds._thread.join(2)
+
+
+class TestRead(DatastoreTestCase):
+    """
+        Test cached reads
+    """
+    __test__ = True
+
+    def test_read_cache(self):
+        """Reads of fewer points than a cached read don't go to the platform"""
+        self.server.on('read', dataport_read([[1, 'a'], [2, 'b'], [3, 'c']]))
+        ds = self.datastore()
+        self.assertEqual(ds.read('alias1', 2), [[3, 'c'], [2, 'b']])
+        self.assertEqual(ds.read('alias1'), [[3, 'c']])
+        self.assertEqual(len(self.sent_calls('read')), 1)
+        self.assertEqual(ds.cacheStats()['hits'], 1)
+
+
+class TestSubscribe(DatastoreTestCase):
+    """
+        Test subscriptions with the wait API
+    """
+    __test__ = True
+
+    def setUp(self):
+        DatastoreTestCase.setUp(self)
+        self.updates = dict((rid, queue.Queue()) for rid in RIDS.values())
+
+        def wait(args):
+            try:
+                point = self.updates[args[0]].get(timeout=args[1]['timeout'] / 1000.0)
+            except queue.Empty:
+                return {'status': 'expire'}
+            return {'status': 'ok', 'result': point}
+        self.server.on('wait', wait)
+
+    def test_subscribe(self):
+        """Updates reach callbacks and the read cache"""
+        config = dict(datastore_config, subscribe_timeout=0.2, subscribe_loops=2)
+        ds = self.datastore(config=config)
+        received = queue.Queue()
+        for i in range(3):
+            ds.subscribe('alias{0}'.format(i), lambda alias, points: received.put((alias, points)))
+        self.updates[RIDS['alias1']].put([1400000000, 42])
+        self.assertEqual(received.get(timeout=2), ('alias1', [[1400000000, 42]]))
+        self.assertEqual(ds.read('alias1'), [[1400000000, 42]])
+        self.assertEqual(self.sent_calls('read'), [])
+
+        ds.unsubscribe('alias0')
+        ds.unsubscribe('alias1')
+        ds.unsubscribe('alias2')
+        deadline = time.time() + 2
+        while ds._waitloops and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(ds._waitloops, [])
+
+    def test_failed_wait_backs_off(self):
+        """Waits that keep failing are not sent again right away"""
+        self.server.on('wait', lambda args: {'status': 'invalid'})
+        config = dict(datastore_config, subscribe_timeout=0.2)
+        ds = self.datastore(config=config)
+        ds.subscribe('alias1')
+        time.sleep(1)
+        ds.unsubscribe('alias1')
+        self.assertTrue(len(self.sent_calls('wait')) <= 2)
+
+
+class TestManager(DatastoreTestCase):
+    """
+        Test flushing many devices with one DatastoreManager
+    """
+    __test__ = True
+
+    def manager(self, **kwargs):
+        transport = {'host': self.host,
+                     'port': self.port,
+                     'url': '/onep:v1/rpc/process',
+                     'https': False,
+                     'timeout': 3}
+        return DatastoreManager(0.1, transport=transport, **kwargs)
+
+    def written_ciks(self):
+        ciks = []
+        for body in self.server.requests:
+            req = json.loads(body.decode('utf-8'))
+            if any(c['procedure'] == 'writegroup' for c in req['calls']):
+                ciks.append(req['auth']['cik'])
+        return ciks
+
+    def test_flush_devices(self):
+        """One flush sends every device's points, each with its own CIK"""
+        manager = self.manager(max_workers=4)
+        ciks = ['cik{0}'.format(i) for i in range(10)]
+        for cik in ciks:
+            manager.add(cik).write('alias1', cik)
+        self.assertEqual(manager.flush(), (10, 0))
+        self.assertEqual(sorted(self.written_ciks()), ciks)
+        self.assertEqual(manager.flush(), (0, 0))
+
+    def test_round_robin(self):
+        """Each flush starts with the next device"""
+        manager = self.manager(max_workers=1)
+        for i in range(3):
+            manager.add('cik{0}'.format(i))
+        for n in range(3):
+            for cik in manager.devices():
+                manager.add(cik).write('alias1', n)
+            manager.flush()
+        self.assertEqual(self.written_ciks(),
+                         ['cik0', 'cik1', 'cik2', 'cik1', 'cik2', 'cik0', 'cik2', 'cik0', 'cik1'])
+
+    def test_thread(self):
+        """The manager's thread flushes all devices"""
+        manager = self.manager()
+        manager.start(daemon=True)
+        manager.add('cik0').write('alias1', 1)
+        manager.add('cik1').write('alias1', 1)
+        deadline = time.time() + 2
+        while len(self.written_ciks()) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(sorted(self.written_ciks()), ['cik0', 'cik1'])
+        manager.stop()
+        manager._thread.join(2)
+        self.assertFalse(manager.isThreadAlive())
+
+    def test_start_after_stop(self):
+        """Devices of a manager started again after stop() are flushed"""
+        manager = self.manager()
+        ds = manager.add('cik0')
+        manager.start(daemon=True)
+        manager.stop(force=True)
+        manager._thread.join(2)
+        manager.start(daemon=True)
+        manager.add('cik0').write('alias1', 1)
+        deadline = time.time() + 2
+        while not self.written_ciks() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.written_ciks(), ['cik0'])
+        self.assertEqual(len(ds._buffer), 0)
+        manager.stop(force=True)
+        manager._thread.join(2)
+
+    def test_remove_while_flushing(self):
+        """Removing a device waits for a flush in progress, and the device
+        is not flushed again once removed"""
+        def writegroup(args):
+            time.sleep(0.2)
+            return {'status': 'ok'}
+        self.server.on('writegroup', writegroup)
+        manager = self.manager()
+        ds = manager.add('cik0')
+        ds.write('alias1', 1)
+        flushing = threading.Thread(target=manager.flush)
+        flushing.start()
+        time.sleep(0.05)
+        manager.remove('cik0')
+        self.assertFalse(flushing.is_alive())
+        self.assertEqual(self.written_ciks(), ['cik0'])
+        self.assertEqual(ds._flush(), (0, 0))
+
+
+class TestAutocreate(DatastoreTestCase):
+    """
+        Test batched dataport creation
+    """
+    __test__ = True
+
+    def setUp(self):
+        DatastoreTestCase.setUp(self)
+        self.server.on('create', lambda args: {'status': 'ok',
+                                               'result': 'f' * 32 + args[1]['name'][-8:].rjust(8, '0')})
+        self.server.on('map', lambda args: {
+            'status': 'invalid' if args[2] == 'unmappable' else 'ok'})
+        self.server.on('drop', lambda args: {'status': 'ok'})
+
+    def test_autocreate(self):
+        """Missing dataports are created and mapped in batches"""
+        auto = {'format': 'float', 'preprocess': [], 'count': 'infinity',
+                'duration': 'infinity', 'visibility': 'parent'}
+        ds = self.datastore(autocreate=auto)
+        for i in range(50):
+            ds.write('new{0}'.format(i), i)
+        ds.write('unmappable', 0)
+        ds.write('alias1', 1)
+        del self.server.requests[:]
+        self.assertEqual(ds._flush(), (52, 1))
+        # lookup, create, map, drop and writegroup
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(len(self.sent_calls('create')), 51)
+        self.assertEqual(len(self.sent_calls('drop')), 1)
+        written = dict(self.sent_calls('writegroup')[0]['arguments'][0])
+        self.assertEqual(len(written), 51)
+        self.assertEqual(written['f' * 32 + 'new7'.rjust(8, '0')], 7)
+        self.assertEqual(ds._conn.resolve('cik', 'new7'), 'f' * 32 + 'new7'.rjust(8, '0'))
+        # the unmappable value is kept for retrying
+        self.assertEqual([item[0] for item in ds._buffer.swap()], ['unmappable'])
+
+    def test_create_dataports(self):
+        """createDataports reports per alias"""
+        ds = self.datastore()
+        results = ds.createDataports(['alias1', 'new1', 'unmappable'], 'float')
+        self.assertEqual(results, {'alias1': (False, 'Alias already existed.'),
+                                   'new1': (True, 'f' * 32 + 'new1'.rjust(8, '0')),
+                                   'unmappable': (False, 'invalid')})
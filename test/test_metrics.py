@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Test request instrumentation"""
+from __future__ import unicode_literals
+import random
+from unittest import TestCase
+
+from pyonep import onep
+from pyonep.metrics import Histogram, Metrics
+from test.localserver import LocalServerTestCase, RPCServer
+
+
+class TestHistogram(TestCase):
+    """
+        Test recording values and reading percentiles
+    """
+
+    def test_percentiles(self):
+        """Percentiles are within the histogram's precision"""
+        histogram = Histogram(subbits=5)
+        values = list(range(1, 100001))
+        random.shuffle(values)
+        for value in values:
+            histogram.record(value)
+        for p in [50, 90, 99, 99.9]:
+            expected = 1000 * p
+            self.assertTrue(abs(histogram.percentile(p) - expected) <= expected / 32.0)
+        stats = histogram.stats()
+        self.assertEqual((stats['count'], stats['min'], stats['max']), (100000, 1, 100000))
+
+    def test_scale(self):
+        """Scaled values come back in their own unit"""
+        histogram = Histogram(scale=1e6)
+        for _ in range(10):
+            histogram.record(0.25)
+        self.assertAlmostEqual(histogram.percentile(50), 0.25, places=2)
+        self.assertEqual(Histogram().percentile(50), None)
+
+
+class TestObservers(LocalServerTestCase):
+    """
+        Test events emitted by OnepV1
+    """
+    __test__ = True
+    server_class = RPCServer
+
+    def test_events(self):
+        """Each RPC request and HTTP attempt is reported"""
+        events = []
+        metrics = Metrics()
+        conn = onep.OnepV1(host=self.host, port=self.port, https=False,
+                           observers=[events.append, metrics])
+        conn.read('cik', 'rid', {})
+        http, rpc = events
+        self.assertEqual((http['event'], http['status']), ('http', 200))
+        self.assertEqual((rpc['event'], rpc['procedures'], rpc['calls']), ('rpc', ['read'], 1))
+        self.assertEqual(rpc['request_bytes'], http['request_bytes'])
+        self.assertTrue(rpc['total'] >= rpc['request'] >= http['total'])
+        stats = metrics.stats()
+        self.assertEqual(stats['rpc.total']['count'], 1)
+        self.assertEqual(stats['procedures'], {'read': 1})
+
+    def test_observer_error(self):
+        """A failing observer does not fail the request"""
+        def observer(event):
+            raise ValueError()
+        conn = onep.OnepV1(host=self.host, port=self.port, https=False,
+                           observers=[observer])
+        self.assertTrue(conn.read('cik', 'rid', {})[0])
+
+    def test_logged_requests(self):
+        """Only the last logsize requests are kept"""
+        conn = onep.OnepV1(host=self.host, port=self.port, https=False,
+                           logrequests=True, logsize=2)
+        for rid in ['a', 'b', 'c']:
+            conn.read('cik', rid, {})
+        self.assertEqual([r['calls'][0]['arguments'][0] for r in conn.loggedrequests()],
+                         ['b', 'c'])
@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+"""Test OnepV1 against a local JSON RPC server"""
+from __future__ import unicode_literals
+import json
+import threading
+import time
+
+from pyonep import onep
+from test.localserver import LocalServerTestCase, RPCServer, dataport_read
+
+
+class OnepTestCase(LocalServerTestCase):
+    """Base class for OnepV1 tests that talk to a local RPC server"""
+    __test__ = False
+    server_class = RPCServer
+
+    def connect(self, **kwargs):
+        return onep.OnepV1(host=self.host, port=self.port, https=False,
+                           **kwargs)
+
+    def sent_calls(self):
+        calls = []
+        for body in self.server.requests:
+            calls.extend(json.loads(body.decode('utf-8'))['calls'])
+        return calls
+
+
+class TestDeferred(OnepTestCase):
+    """
+        Test deferred calls from several threads
+    """
+    __test__ = True
+
+    def test_threads_share_client(self):
+        """Threads deferring calls on one client get unique call ids"""
+        conn = self.connect(pool=True)
+        results = []
+
+        def worker(n):
+            for i in range(20):
+                conn.info('cik{0}'.format(n), 'rid{0}'.format(i), defer=True)
+            results.extend(conn.send_deferred('cik{0}'.format(n)))
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(results), 160)
+        ids = [c['id'] for c in self.sent_calls()]
+        self.assertEqual(len(set(ids)), 160)
+        for request, ok, result in results:
+            self.assertTrue(ok)
+            self.assertEqual(result[1][0], request['arguments'][0])
+
+    def test_pop(self):
+        """pop() takes the deferred calls and leaves none behind"""
+        deferred = onep.DeferredRequests()
+        deferred.add('cik', 'read', ['rid', {}])
+        deferred.add('cik', 'wait', ['rid', {}], notimeout=True)
+        pairs, notimeout = deferred.pop('cik')
+        self.assertEqual([m for m, _ in pairs], ['read', 'wait'])
+        self.assertTrue(notimeout)
+        self.assertFalse(deferred.has_requests('cik'))
+        self.assertEqual(deferred.pop('cik'), ([], False))
+
+
+class TestCallJsonRPC(OnepTestCase):
+    """
+        Test response handling
+    """
+    __test__ = True
+
+    def test_results_in_request_order(self):
+        """Results of a batch come back in request order"""
+        conn = self.connect()
+        calls = conn._composeCalls([('info', ['rid{0}'.format(i)]) for i in range(500)])
+        body = json.dumps([{'id': c['id'], 'status': 'ok', 'result': c['arguments'][0]}
+                           for c in reversed(calls)])
+        results = conn._parseJsonRPC(body, calls, returnreq=True)
+        self.assertEqual([r[2] for r in results],
+                         ['rid{0}'.format(i) for i in range(500)])
+        self.assertTrue(all(r[0] is c for r, c in zip(results, calls)))
+
+    def test_failed_call(self):
+        """A failed call is reported with its status"""
+        self.server.on('read', lambda args: {'status': 'restricted'})
+        conn = self.connect()
+        conn.info('cik', 'rid', defer=True)
+        conn.read('cik', 'rid', {}, defer=True)
+        results = conn.send_deferred('cik')
+        self.assertEqual([r[1:] for r in results],
+                         [(True, ['info', ['rid', {}]]), (False, 'restricted')])
+
+
+class TestBatching(OnepTestCase):
+    """
+        Test automatic sending of deferred calls
+    """
+    __test__ = True
+
+    def test_max_calls(self):
+        """Deferred calls are sent once max_calls are queued"""
+        conn = self.connect(batch=onep.BatchPolicy(max_calls=10, max_age=None))
+        futures = [conn.info('cik', 'rid{0}'.format(i), defer=True) for i in range(30)]
+        results = [f.result(timeout=5) for f in futures]
+        self.assertEqual(results[3], (True, ['info', ['rid3', {}]]))
+        self.assertEqual(len(self.sent_calls()), 30)
+        for body in self.server.requests:
+            self.assertTrue(len(json.loads(body.decode('utf-8'))['calls']) <= 10)
+        conn.close()
+
+    def test_max_age(self):
+        """Deferred calls are sent once the oldest is max_age old"""
+        conn = self.connect(batch=onep.BatchPolicy(max_calls=None, max_age=0.05))
+        a = conn.info('cik1', 'rid', defer=True)
+        b = conn.info('cik2', 'rid', defer=True)
+        self.assertEqual(a.result(timeout=5)[0], True)
+        self.assertEqual(b.result(timeout=5)[0], True)
+        self.assertEqual(len(self.server.requests), 2)
+        conn.close()
+
+    def test_deferred_while_sending(self):
+        """A call deferred while another auth's calls are sent is sent
+        once it is max_age old"""
+        def info(args):
+            time.sleep(0.5)
+            return {'status': 'ok', 'result': {}}
+        self.server.on('info', info)
+        conn = self.connect(batch=onep.BatchPolicy(max_calls=None, max_age=0.1))
+        a = conn.info('cikA', 'rid', defer=True)
+        deadline = time.time() + 2
+        while not self.server.requests and time.time() < deadline:
+            time.sleep(0.01)
+        b = conn.info('cikB', 'rid', defer=True)
+        self.assertEqual(a.result(timeout=5)[0], True)
+        self.assertEqual(b.result(timeout=5)[0], True)
+        conn.close()
+
+    def test_max_bytes(self):
+        """Deferred calls are sent once they reach max_bytes"""
+        conn = self.connect(batch=onep.BatchPolicy(max_calls=None, max_bytes=250,
+                                                   max_age=None))
+        futures = [conn.write('cik', 'rid', 'x' * 90, defer=True) for i in range(4)]
+        for f in futures:
+            self.assertTrue(f.result(timeout=5)[0])
+        # each call is too big to share a request with another
+        self.assertEqual(len(self.server.requests), 4)
+        conn.close()
+
+    def test_uneven_calls(self):
+        """Requests are split on the size of each call, so a large call
+        among small ones doesn't push a request over max_bytes"""
+        policy = onep.BatchPolicy(max_calls=None, max_bytes=300, max_age=None)
+        sizes = [50, 50, 50, 250, 50, 50, 50]
+        self.assertEqual(policy.chunks(sizes), [3, 2, 2])
+        self.assertEqual(policy.chunks([400, 50]), [1, 1])
+        self.assertEqual(onep.BatchPolicy(max_calls=2).chunks([0] * 5), [2, 2, 1])
+        conn = self.connect(batch=policy)
+        for i, size in enumerate(sizes):
+            conn.deferred.add('cik', 'info', ['rid{0}'.format(i)], size=size)
+        results = conn.send_deferred('cik')
+        self.assertEqual([len(json.loads(body.decode('utf-8'))['calls'])
+                          for body in self.server.requests], [3, 2, 2])
+        self.assertEqual([r[2][1][0] for r in results],
+                         ['rid{0}'.format(i) for i in range(7)])
+        conn.close()
+
+    def test_close_sends_remaining(self):
+        """close() sends calls that are not due yet"""
+        conn = self.connect(batch=onep.BatchPolicy(max_calls=None, max_age=60))
+        future = conn.info('cik', 'rid', defer=True)
+        conn.close()
+        self.assertTrue(future.done())
+        self.assertEqual(future.result()[0], True)
+
+    def test_failed_request(self):
+        """A failed request is passed to every future of the batch"""
+        conn = onep.OnepV1(host=self.host, port=1, https=False, httptimeout=1,
+                           batch=onep.BatchPolicy(max_calls=2))
+        futures = [conn.info('cik', 'rid', defer=True) for i in range(2)]
+        for f in futures:
+            self.assertRaises(onep.JsonRPCRequestException, f.result, 5)
+        conn.close()
+
+
+class MixedAuthServer(RPCServer):
+    """Rejects requests whose CIK starts with 'bad', and answers the calls
+    of the others in reverse order with the result [cik, rid]"""
+
+    def handle(self, request, body):
+        self.requests.append(body)
+        req = json.loads(body.decode('utf-8'))
+        cik = req['auth']['cik']
+        if cik.startswith('bad'):
+            return json.dumps({'error': {'code': 401, 'message': 'Invalid'}}).encode('utf-8')
+        res = [{'id': call['id'], 'status': 'ok', 'result': [cik, call['arguments'][0]]}
+               for call in reversed(req['calls'])]
+        return json.dumps(res).encode('utf-8')
+
+
+class TestSendAllDeferred(OnepTestCase):
+    """
+        Test sending deferred calls for many auths
+    """
+    __test__ = True
+
+    def test_send_all_deferred(self):
+        """Every auth is sent and failures are reported per auth"""
+        conn = self.connect(pool=True)
+        for i in range(20):
+            conn.info('cik{0}'.format(i), 'rid', defer=True)
+        conn.info({'cik': 'cik0', 'client_id': 'rid'}, 'rid', defer=True)
+        self.server.on('info', lambda args: {'error': {'code': 401, 'message': 'Invalid'}})
+        results, errors = conn.send_all_deferred(max_workers=4)
+        self.assertEqual(len(errors), 21)
+        self.assertEqual(results, {})
+        self.assertTrue('{cik:cik0,client_id:rid}' in errors)
+
+        self.server.results.clear()
+        for i in range(20):
+            conn.info('cik{0}'.format(i), 'rid', defer=True)
+        results, errors = conn.send_all_deferred(max_workers=4)
+        self.assertEqual(errors, {})
+        self.assertEqual(sorted(results), sorted('cik{0}'.format(i) for i in range(20)))
+        self.assertFalse(conn.has_deferred('cik0'))
+
+
+class TestSendAllDeferredMixed(OnepTestCase):
+    """
+        Test sending deferred calls for valid and invalid CIKs together
+    """
+    __test__ = True
+    server_class = MixedAuthServer
+
+    def test_mixed_ciks(self):
+        """Each result goes to its own CIK and call, and invalid CIKs are
+        reported without affecting the others"""
+        conn = self.connect(pool=True)
+        ciks = ['{0}{1}'.format('bad' if i % 3 == 0 else 'good', i) for i in range(12)]
+        for cik in ciks:
+            for j in range(5):
+                conn.info(cik, '{0}-rid{1}'.format(cik, j), defer=True)
+        results, errors = conn.send_all_deferred(max_workers=4)
+        self.assertEqual(sorted(errors), sorted(c for c in ciks if c.startswith('bad')))
+        self.assertEqual(sorted(results), sorted(c for c in ciks if c.startswith('good')))
+        for cik, r in results.items():
+            self.assertEqual([result for request, ok, result in r],
+                             [[cik, '{0}-rid{1}'.format(cik, j)] for j in range(5)])
+            for request, ok, result in r:
+                self.assertTrue(ok)
+                self.assertEqual(request['arguments'][0], result[1])
+
+
+class TestReadResultFormat(OnepTestCase):
+    """
+        Test packed read results
+    """
+    __test__ = True
+
+    def test_columns(self):
+        """Numeric reads are packed into arrays"""
+        points = [[1500000000 + i, i * 0.5] for i in range(1000)]
+        self.server.on('read', lambda args: {'status': 'ok', 'result': points})
+        conn = self.connect()
+        ok, (timestamps, values) = conn.read('cik', 'rid', {},
+                                             resultformat=onep.RESULTFORMATS.COLUMNS)
+        self.assertTrue(ok)
+        self.assertEqual(timestamps.typecode, 'q')
+        self.assertEqual(values.typecode, 'd')
+        self.assertEqual(list(timestamps), [p[0] for p in points])
+        self.assertEqual(list(values), [p[1] for p in points])
+
+    def test_string_columns(self):
+        """String reads fall back to a list of values"""
+        self.server.on('read', lambda args: {'status': 'ok', 'result': [[2, 'b'], [1, 'a']]})
+        conn = self.connect(batch=onep.BatchPolicy(max_calls=1))
+        future = conn.read('cik', 'rid', {}, defer=True,
+                           resultformat=onep.RESULTFORMATS.COLUMNS)
+        ok, (timestamps, values) = future.result(timeout=5)
+        self.assertEqual(list(timestamps), [2, 1])
+        self.assertEqual(values, ['b', 'a'])
+        conn.close()
+
+    def test_numeric_strings(self):
+        """Numeric strings are kept as strings"""
+        points = [[1, '1.5'], [2, '2']]
+        for resultformat in [onep.RESULTFORMATS.COLUMNS, onep.RESULTFORMATS.NUMPY]:
+            if resultformat == onep.RESULTFORMATS.NUMPY and onep.numpy is None:
+                continue
+            timestamps, values = onep.pack_points(points, resultformat)
+            self.assertEqual(values, ['1.5', '2'])
+        self.assertEqual(list(onep.pack_points([[1, 1], [2, 2.5]])[1]), [1.0, 2.5])
+
+    def test_failed_read(self):
+        """Failed reads are returned unchanged"""
+        self.server.on('read', lambda args: {'status': 'invalid'})
+        conn = self.connect()
+        self.assertEqual(conn.read('cik', 'rid', {}, resultformat=onep.RESULTFORMATS.COLUMNS),
+                         (False, 'invalid'))
+
+
+class TestIterRead(OnepTestCase):
+    """
+        Test paginated reads
+    """
+    __test__ = True
+
+    # timestamps 0..99, with three points at 10, 11 and 50
+    points = sorted([[t, t] for t in range(100)] +
+                    [[10, 'a'], [10, 'b'], [11, 'c'], [50, 'd'], [50, 'e']],
+                    key=lambda p: p[0])
+
+    def setUp(self):
+        OnepTestCase.setUp(self)
+        self.server.on('read', dataport_read(self.points))
+
+    def test_ascending(self):
+        """All points are returned once, oldest first"""
+        conn = self.connect(pool=True)
+        for page_size in (3, 4, 7, 1000):
+            result = list(conn.iter_read('cik', 'rid', 0, 99, page_size=page_size))
+            self.assertEqual(result, self.points)
+
+    def test_descending(self):
+        """All points are returned once, newest first"""
+        conn = self.connect(pool=True)
+        result = list(conn.iter_read('cik', 'rid', 5, 60, page_size=4, sort='desc',
+                                     prefetch=False))
+        expected = [p for p in self.points if 5 <= p[0] <= 60]
+        self.assertEqual(result, list(reversed(expected)))
+
+    def test_pages(self):
+        """Pages are yielded as lists"""
+        conn = self.connect(pool=True)
+        pages = list(conn.iter_read('cik', 'rid', 0, 19, page_size=10, pages=True))
+        self.assertEqual(sum(pages, []), self.points[:23])
+        self.assertTrue(all(len(p) <= 10 for p in pages))
+
+    def test_crowded_timestamp(self):
+        """Every point of a timestamp shared by a whole page is returned"""
+        conn = self.connect(pool=True)
+        result = list(conn.iter_read('cik', 'rid', 10, 12, page_size=2))
+        self.assertEqual(result, [p for p in self.points if 10 <= p[0] <= 12])
+
+    def test_very_crowded_timestamp(self):
+        """Timestamps shared by many pages are drained in both orders"""
+        points = [[1, 1]] + [[2, i] for i in range(23)] + [[3, 3]]
+        self.server.on('read', dataport_read(points))
+        conn = self.connect(pool=True)
+        self.assertEqual(list(conn.iter_read('cik', 'rid', 0, 9, page_size=2)), points)
+        result = list(conn.iter_read('cik', 'rid', 0, 9, page_size=3, sort='desc'))
+        self.assertEqual(result, list(reversed(points)))
+
+
+class TestReadMany(OnepTestCase):
+    """
+        Test bulk reads
+    """
+    __test__ = True
+
+    def test_read_many(self):
+        """Reads are packed into few requests and keyed by resource"""
+        rid = 'a' * 40
+        aliases = ['port{0}'.format(i) for i in range(25)]
+        conn = self.connect(pool=True)
+        results = conn.read_many('cik', aliases + [rid, {'alias': 'x'}, 'port0'],
+                                 {'limit': 1}, max_calls=10)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(results), 27)
+        self.assertEqual(results['port3'], (True, ['read', [{'alias': 'port3'}, {'limit': 1}]]))
+        self.assertEqual(results[rid], (True, ['read', [rid, {'limit': 1}]]))
+        self.assertEqual(results['x'][0], True)
+
+    def test_partial_failure(self):
+        """A failed read is reported for its resource only"""
+        def read(args):
+            if args[0] == {'alias': 'bad'}:
+                return {'status': 'invalid'}
+            return {'status': 'ok', 'result': [[1, 1.0]]}
+        self.server.on('read', read)
+        conn = self.connect()
+        results = conn.read_many('cik', ['good', 'bad'], {},
+                                 resultformat=onep.RESULTFORMATS.COLUMNS)
+        self.assertEqual(results['bad'], (False, 'invalid'))
+        self.assertEqual(list(results['good'][1][1]), [1.0])
+
+
+class TestResolve(OnepTestCase):
+    """
+        Test cached alias resolution
+    """
+    __test__ = True
+
+    def setUp(self):
+        OnepTestCase.setUp(self)
+        rids = {'temp': 'a' * 40, 'humidity': 'b' * 40}
+
+        def lookup(args):
+            if args[1] in rids:
+                return {'status': 'ok', 'result': rids[args[1]]}
+            return {'status': 'invalid'}
+        self.server.on('lookup', lookup)
+        self.server.on('info', lambda args: {
+            'status': 'ok',
+            'result': {'aliases': {'a' * 40: ['temp'], 'b' * 40: ['humidity', 'h']}}})
+
+    def test_resolve(self):
+        """Aliases are looked up once and cached, missing ones too"""
+        conn = self.connect()
+        self.assertEqual(conn.resolve('cik', 'temp'), 'a' * 40)
+        self.assertEqual(conn.resolve('cik', 'temp'), 'a' * 40)
+        self.assertEqual(conn.resolve('cik', 'nope'), None)
+        self.assertEqual(conn.resolve('cik', 'nope'), None)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(conn.resolve_many('cik', ['temp', 'humidity', 'x']),
+                         {'temp': 'a' * 40, 'humidity': 'b' * 40, 'x': None})
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_prefetch(self):
+        """prefetch_aliases caches every alias with one call"""
+        conn = self.connect()
+        self.assertEqual(conn.prefetch_aliases('cik'),
+                         {'temp': 'a' * 40, 'humidity': 'b' * 40, 'h': 'b' * 40})
+        self.assertEqual(conn.resolve_many('cik', ['temp', 'h']),
+                         {'temp': 'a' * 40, 'h': 'b' * 40})
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(conn.aliascache.stats()['hits'], 2)
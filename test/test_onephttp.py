@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""Test onephttp transport against a local HTTP server"""
+from __future__ import unicode_literals
+import threading
+import time
+import warnings
+import zlib
+
+from pyonep import onephttp
+from test.localserver import EchoHandler, LocalServer, LocalServerTestCase
+
+
+class DroppingHandler(EchoHandler):
+    """Echoes request bodies, but hangs up without answering 'drop' and
+    answers 'slow' after a while"""
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if body == b'drop':
+            self.close_connection = True
+            return
+        if body == b'slow':
+            time.sleep(0.2)
+        self.respond(body)
+
+
+class DroppingServer(LocalServer):
+    def __init__(self):
+        LocalServer.__init__(self, DroppingHandler)
+
+
+class TestConnectionPool(LocalServerTestCase):
+    """
+        Test pooled onephttp transport
+    """
+    __test__ = True
+    server_class = DroppingServer
+
+    def test_pool_reuses_connections(self):
+        """Requests through a pool share one keep-alive connection"""
+        pool = onephttp.ConnectionPool(maxsize=2)
+        req = onephttp.OneP_Request(self.host + ':' + str(self.port), https=False, pool=pool, log=_NullLog())
+        for i in range(5):
+            body, response = req.request('POST', '/', '{0}'.format(i))
+            self.assertEqual(body, '{0}'.format(i))
+        stats = pool.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 4)
+
+    def test_pool_shared_between_requests(self):
+        """OneP_Request objects for the same host share the global pool"""
+        a = onephttp.OneP_Request(self.host + ':' + str(self.port), https=False, pool=True)
+        b = onephttp.OneP_Request(self.host + ':' + str(self.port), https=False, pool=True)
+        self.assertTrue(a.pool is b.pool)
+
+    def test_pool_reaps_idle(self):
+        """Idle pools are closed and counted"""
+        pool = onephttp.ConnectionPool(idletimeout=0)
+        req = onephttp.OneP_Request(self.host + ':' + str(self.port), https=False, pool=pool, log=_NullLog())
+        req.request('POST', '/', 'x')
+        time.sleep(0.01)
+        self.assertTrue(pool.reap())
+        self.assertEqual(pool.stats()['reaped'], 1)
+        req.request('POST', '/', 'x')
+        self.assertEqual(pool.stats()['misses'], 2)
+
+    def test_pool_kept_on_error(self):
+        """A failed request only drops its own connection"""
+        pool = onephttp.ConnectionPool(maxsize=2)
+        req = onephttp.OneP_Request(self.host + ':' + str(self.port), https=False, pool=pool,
+                                    log=_NullLog())
+        # open two connections
+        threads = [threading.Thread(target=req.request, args=('POST', '/', 'slow'))
+                   for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(pool.stats()['misses'], 2)
+        session = pool.session()
+        self.assertRaises(Exception, req.request, 'POST', '/', 'drop')
+        self.assertTrue(pool.session() is session)
+        self.assertEqual(self.idle(session), 1)
+        stats = pool.stats()
+        self.assertEqual((stats['resets'], stats['errors']), (0, 1))
+
+    @staticmethod
+    def idle(session):
+        """Counts the open connections waiting in session's pools"""
+        count = 0
+        for adapter in set(session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                queue = adapter.poolmanager.pools.get(key).pool.queue
+                count += sum(1 for conn in queue if conn is not None and conn.sock is not None)
+        return count
+
+    def test_shared_pool_settings(self):
+        """Asking for the shared pool with other settings warns"""
+        host = self.host + ':' + str(self.port)
+        onephttp.get_pool(host, False, maxsize=2)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual(onephttp.get_pool(host, False, maxsize=2).maxsize, 2)
+            self.assertEqual(caught, [])
+            onephttp.get_pool(host, False, maxsize=5)
+            self.assertEqual(len(caught), 1)
+
+
+class TestLogging(LocalServerTestCase):
+    """
+        Test debug logging of requests
+    """
+    __test__ = True
+
+    def test_lazy(self):
+        """Nothing is formatted when debug logging is off"""
+        log = _RecordingLog(enabled=False)
+        req = onephttp.OneP_Request(self.host + ':' + str(self.port), https=False,
+                                    log=log, curldebug=True)
+        req.request('POST', '/', 'x')
+        self.assertEqual(log.messages, [])
+
+    def test_logbody(self):
+        """Bodies are cut to logbody characters"""
+        log = _RecordingLog(enabled=True)
+        req = onephttp.OneP_Request(self.host + ':' + str(self.port), https=False,
+                                    log=log, logbody=3)
+        req.request('POST', '/', 'abcdefgh')
+        self.assertEqual(log.messages[-1], 'Body: abc... (8 characters)')
+
+    def test_logsample(self):
+        """Unsampled bodies are not logged"""
+        log = _RecordingLog(enabled=True)
+        req = onephttp.OneP_Request(self.host + ':' + str(self.port), https=False,
+                                    log=log, logsample=0)
+        req.request('POST', '/', 'abcdefgh')
+        self.assertEqual(len(log.messages), 1)
+
+
+class GzipServer(LocalServer):
+    """Echoes request bodies decompressed, along with their encoding, or
+    answers compressed bodies with `rejects` when it is set"""
+    rejects = None
+
+    def handle(self, request, body):
+        encoding = request.headers.get('Content-Encoding')
+        self.requests.append((encoding, body))
+        if encoding == 'gzip':
+            if self.rejects is not None:
+                return b'', self.rejects
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return ('%s:' % encoding).encode('utf-8') + body
+
+
+class TestCompression(LocalServerTestCase):
+    """
+        Test compressing request bodies
+    """
+    __test__ = True
+    server_class = GzipServer
+
+    def connect(self):
+        return onephttp.OneP_Request(self.host + ':' + str(self.port), https=False,
+                                     log=_NullLog(), compress=10)
+
+    def test_compress(self):
+        """Bodies over the threshold are sent gzip compressed"""
+        req = self.connect()
+        self.assertEqual(req.request('POST', '/', 'short')[0], 'None:short')
+        body = '[' + ','.join(['1'] * 1000) + ']'
+        self.assertEqual(req.request('POST', '/', body)[0], 'gzip:' + body)
+        self.assertTrue(len(self.server.requests[1][1]) < len(body) / 10)
+
+    def test_rejected(self):
+        """A refused compressed body is sent again uncompressed, and
+        compression is turned off"""
+        self.server.rejects = 415
+        req = self.connect()
+        body = 'x' * 100
+        self.assertEqual(req.request('POST', '/', body)[0], 'None:' + body)
+        self.assertTrue(req.compressionrejected)
+        req.request('POST', '/', body)
+        self.assertEqual([e for e, b in self.server.requests], ['gzip', None, None])
+
+
+class _NullLog(object):
+    def isEnabledFor(self, level):
+        return False
+
+    def debug(self, *args, **kwargs):
+        pass
+
+    def info(self, *args, **kwargs):
+        pass
+
+
+class _RecordingLog(object):
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.messages = []
+
+    def isEnabledFor(self, level):
+        return self.enabled
+
+    def debug(self, msg, *args):
+        self.messages.append(msg % args)
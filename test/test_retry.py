@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Test retrying failed requests"""
+from __future__ import unicode_literals
+import socket
+from unittest import TestCase
+
+from requests.exceptions import ConnectionError, ConnectTimeout
+from requests.packages.urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from pyonep import onep
+from pyonep.exceptions import JsonRPCRequestException, OnePlatformException
+from pyonep.retry import RetryPolicy, idempotent, unsent
+from test.localserver import LocalServerTestCase, RPCServer
+
+
+class TestRetryPolicy(TestCase):
+    """
+        Test retry decisions
+    """
+
+    def test_idempotent(self):
+        """Only requests made entirely of safe procedures are idempotent"""
+        self.assertTrue(idempotent(['read', 'info', 'lookup']))
+        self.assertFalse(idempotent(['read', 'write']))
+        self.assertFalse(idempotent(['create']))
+
+    def test_retryable(self):
+        """Failed connections are always retried, other failures only when
+        the request is idempotent"""
+        policy = RetryPolicy()
+        self.assertTrue(policy.retryable(False, exception=ConnectTimeout()))
+        self.assertFalse(policy.retryable(False, exception=ConnectionError()))
+        self.assertTrue(policy.retryable(True, exception=ConnectionError()))
+        self.assertFalse(policy.retryable(True, exception=ValueError()))
+        self.assertTrue(policy.retryable(True, status=503))
+        self.assertFalse(policy.retryable(False, status=503))
+        self.assertFalse(policy.retryable(True, status=400))
+        refused = ConnectionError(MaxRetryError(
+            None, '/', NewConnectionError(None, 'Connection refused')))
+        self.assertTrue(unsent(refused))
+        self.assertTrue(policy.retryable(False, exception=refused))
+
+    def test_backoff(self):
+        """Delays double up to max_backoff, until retries run out"""
+        policy = RetryPolicy(retries=4, backoff=1, max_backoff=3, jitter=False)
+        self.assertEqual([policy.delay(i, True, status=503) for i in range(5)],
+                         [1, 2, 3, 3, None])
+        self.assertEqual(policy.stats()['exhausted'], 1)
+
+    def test_budget(self):
+        """Retries stop when the budget is spent and resume as requests
+        are made"""
+        policy = RetryPolicy(budget=0.5, max_budget=2, backoff=0)
+        self.assertEqual(policy.delay(0, True, status=503), 0)
+        self.assertEqual(policy.delay(0, True, status=503), 0)
+        self.assertEqual(policy.delay(0, True, status=503), None)
+        self.assertEqual(policy.stats()['throttled'], 1)
+        policy.started()
+        policy.started()
+        self.assertEqual(policy.delay(0, True, status=503), 0)
+
+
+class FlakyRPCServer(RPCServer):
+    """Answers the first `failures` requests with 503"""
+    failures = 2
+
+    def handle(self, request, body):
+        if self.failures > 0:
+            self.failures -= 1
+            self.requests.append(body)
+            return b'unavailable', 503
+        return RPCServer.handle(self, request, body)
+
+
+class TestRetry(LocalServerTestCase):
+    """
+        Test retrying RPC requests
+    """
+    __test__ = True
+    server_class = FlakyRPCServer
+
+    def connect(self, port=None, **kwargs):
+        return onep.OnepV1(host=self.host, port=port or self.port, https=False,
+                           retry=self.policy, **kwargs)
+
+    def setUp(self):
+        LocalServerTestCase.setUp(self)
+        self.policy = RetryPolicy(backoff=0.001)
+
+    def test_retry_read(self):
+        """Idempotent requests are retried"""
+        success, result = self.connect().read('cik', 'rid', {})
+        self.assertTrue(success)
+        self.assertEqual(len(self.server.requests), 3)
+        stats = self.policy.stats()
+        self.assertEqual((stats['retries'], stats['recovered']), (2, 1))
+
+    def test_no_retry_write(self):
+        """Non-idempotent requests are not retried once sent"""
+        self.assertRaises(OnePlatformException,
+                          self.connect().write, 'cik', 'rid', 1)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_connection_refused(self):
+        """Refused connections are retried, whether or not the request is
+        idempotent"""
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        conn = self.connect(port=port)
+        self.assertRaises(JsonRPCRequestException, conn.read, 'cik', 'rid', {})
+        self.assertEqual(self.policy.stats()['retries'], 3)
+        self.assertRaises(JsonRPCRequestException, conn.write, 'cik', 'rid', 1)
+        self.assertEqual(self.policy.stats()['retries'], 6)
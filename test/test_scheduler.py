@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Test the adaptive flush scheduler"""
+from __future__ import unicode_literals
+import threading
+import time
+from unittest import TestCase
+
+from pyonep.scheduler import FlushScheduler
+
+
+class TestFlushScheduler(TestCase):
+    """
+        Test flush cadence and batch size
+    """
+
+    def test_idle_backoff(self):
+        """Idle flushes back off, and a new point resets the interval"""
+        scheduler = FlushScheduler(interval=1, max_interval=5)
+        for interval in [2, 4, 5, 5]:
+            scheduler.observe_flush(0, 0)
+            self.assertEqual(scheduler.interval, interval)
+        scheduler.added(1)
+        self.assertEqual(scheduler.interval, 1)
+
+    def test_failure_backoff(self):
+        """Failed flushes back off until a flush succeeds"""
+        scheduler = FlushScheduler(interval=1, max_interval=5)
+        scheduler.observe_flush(10, 10)
+        scheduler.observe_flush(10, 10)
+        self.assertEqual(scheduler.interval, 4)
+        # points keep coming during an outage
+        scheduler.added(1)
+        self.assertEqual(scheduler.interval, 4)
+        scheduler.observe_flush(10, 0)
+        self.assertEqual(scheduler.interval, 1)
+
+    def test_high_water(self):
+        """Reaching the high water mark wakes the flusher"""
+        scheduler = FlushScheduler(interval=10, high_water=100)
+        threading.Timer(0.05, scheduler.added, args=(99,)).start()
+        threading.Timer(0.1, scheduler.added, args=(100,)).start()
+        start = time.time()
+        scheduler.wait()
+        self.assertTrue(0.1 <= time.time() - start < 1)
+
+    def test_calls(self):
+        """Slow or failed requests get fewer calls"""
+        scheduler = FlushScheduler(max_calls=100, target_latency=1.0)
+        scheduler.observe_request(2.0, True)
+        self.assertEqual(scheduler.calls, 50)
+        scheduler.observe_request(0.1, False)
+        self.assertEqual(scheduler.calls, 25)
+        scheduler.observe_request(0.1, True)
+        self.assertEqual(scheduler.calls, 35)
+        self.assertTrue(0 < scheduler.errorrate < 1)
+
+    def test_error_rate(self):
+        """While the error rate is high, successes don't speed flushes up
+        or grow the batch size"""
+        scheduler = FlushScheduler(interval=1, max_interval=60, max_calls=100,
+                                   alpha=0.3, max_errorrate=0.5)
+        for _ in range(4):
+            scheduler.observe_request(0.1, False)
+        self.assertEqual(scheduler.calls, 6)
+        scheduler.observe_request(0.1, True)
+        self.assertEqual(scheduler.calls, 6)
+        scheduler.observe_flush(10, 0)
+        self.assertEqual(scheduler.interval, 2)
+        # the error rate decays below max_errorrate
+        scheduler.observe_request(0.1, True)
+        self.assertEqual(scheduler.calls, 16)
+        scheduler.observe_flush(10, 0)
+        self.assertEqual(scheduler.interval, 1)
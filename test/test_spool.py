@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Test the Datastore disk spool"""
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from pyonep.spool import Spool
+
+
+class TestSpool(TestCase):
+    """
+        Test appending, replaying and acknowledging segments
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_read_ack(self):
+        """Points are read back per segment and deleted once acknowledged"""
+        spool = Spool(self.directory, segment_size=64)
+        spool.append([['temp', 1, 20.5, 'record']])
+        spool.append([['temp', 2, 21.5, 'record'], ['hum', 2, 'high', 'offset']])
+        # the second record didn't fit the first segment
+        self.assertEqual(len(spool), 2)
+        segment = spool.pending()[0]
+        self.assertEqual(spool.read(segment), [['temp', 1, 20.5, 'record']])
+        spool.ack(segment)
+        segment = spool.pending()[0]
+        self.assertEqual(spool.read(segment),
+                         [['temp', 2, 21.5, 'record'], ['hum', 2, 'high', 'offset']])
+        spool.ack(segment)
+        self.assertEqual(spool.pending(), [])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_reopen(self):
+        """Segments survive the spool being closed and reopened"""
+        spool = Spool(self.directory)
+        spool.append([['temp', 1, 1, 'record']])
+        spool.close()
+        spool = Spool(self.directory)
+        spool.append([['temp', 2, 2, 'record']])
+        segments = spool.pending()
+        self.assertEqual(len(segments), 1)
+        self.assertEqual(spool.read(segments[0]), [['temp', 1, 1, 'record']])
+        spool.ack(segments[0])
+        segments = spool.pending()
+        self.assertEqual(spool.read(segments[0]), [['temp', 2, 2, 'record']])
+
+    def test_torn_record(self):
+        """A record cut short by a crash ends the segment"""
+        spool = Spool(self.directory)
+        spool.append([['temp', 1, 1, 'record']])
+        spool.append([['temp', 2, 2, 'record']])
+        spool.close()
+        segment = spool.pending()[0]
+        path = os.path.join(self.directory, os.listdir(self.directory)[0])
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 3)
+        self.assertEqual(spool.read(segment), [['temp', 1, 1, 'record']])
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Test the Datastore write buffer"""
+from __future__ import unicode_literals
+import threading
+import time
+from unittest import TestCase
+
+from pyonep.writebuffer import WriteBuffer, POLICIES
+
+
+class TestWriteBuffer(TestCase):
+    """
+        Test write buffer policies
+    """
+
+    def values(self, items):
+        return [(item[0], item[2]) for item in items]
+
+    def test_coalesce(self):
+        """Live values of an alias coalesce, new aliases are dropped when full"""
+        buf = WriteBuffer(maxsize=2)
+        self.assertTrue(buf.write('a', 1, 0))
+        self.assertFalse(buf.write('a', 2, 0))
+        self.assertTrue(buf.write('b', 1, 0))
+        self.assertFalse(buf.write('c', 1, 0))
+        self.assertFalse(buf.write('a', 3, 0))
+        self.assertEqual(sorted(self.values(buf.swap())), [('a', 3), ('b', 1)])
+        self.assertEqual(buf.stats(), {'depth': 2, 'maxsize': 2, 'dropped': 1, 'coalesced': 2})
+
+    def test_drop_newest(self):
+        """Points that don't fit are dropped"""
+        buf = WriteBuffer(maxsize=3, policy=POLICIES.DROP_NEWEST)
+        self.assertTrue(buf.write('a', 1, 0))
+        self.assertTrue(buf.write('a', 2, 0))
+        self.assertFalse(buf.record('a', [[1, 3], [2, 4]]))
+        self.assertTrue(buf.record('b', [[1, 5]]))
+        self.assertFalse(buf.write('a', 6, 0))
+        self.assertEqual(len(buf), 3)
+        self.assertEqual(buf.stats()['dropped'], 3)
+
+    def test_drop_oldest(self):
+        """The oldest points are dropped to make room"""
+        buf = WriteBuffer(maxsize=3, policy=POLICIES.DROP_OLDEST)
+        for i in range(5):
+            buf.write('alias{0}'.format(i), i, 0)
+        self.assertEqual(sorted(self.values(buf.swap())),
+                         [('alias2', 2), ('alias3', 3), ('alias4', 4)])
+        self.assertEqual(buf.stats()['dropped'], 2)
+        # points being sent are not dropped
+        self.assertFalse(buf.write('alias5', 5, 0))
+        buf.release(3)
+        self.assertTrue(buf.record('alias6', [[i, i] for i in range(5)]))
+        self.assertEqual(self.values(buf.swap()), [('alias6', i) for i in range(2, 5)])
+
+    def test_block(self):
+        """Writers wait for room, up to timeout"""
+        buf = WriteBuffer(maxsize=1, policy=POLICIES.BLOCK, timeout=0.05)
+        self.assertTrue(buf.write('a', 1, 0))
+        start = time.time()
+        self.assertFalse(buf.write('b', 1, 0))
+        self.assertTrue(time.time() - start >= 0.05)
+
+        buf.timeout = 5
+        items = buf.swap()
+        timer = threading.Timer(0.05, buf.release, args=(len(items),))
+        timer.start()
+        self.assertTrue(buf.write('b', 2, 0))
+        self.assertEqual(self.values(buf.swap()), [('b', 2)])
+        self.assertEqual(buf.stats()['dropped'], 1)
+
+    def test_restore(self):
+        """Restored points keep their room and go before newer points"""
+        buf = WriteBuffer(maxsize=2, policy=POLICIES.DROP_NEWEST, shards=1)
+        buf.write('a', 1, 0)
+        items = buf.swap()
+        buf.write('a', 2, 0)
+        self.assertFalse(buf.write('a', 3, 0))
+        buf.restore(items)
+        self.assertEqual(self.values(buf.swap()), [('a', 1), ('a', 2)])
+        self.assertEqual(buf.depth(), 2)